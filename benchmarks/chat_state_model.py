@@ -0,0 +1,74 @@
+"""
+Memory and load time of chat data as JSON dict compared with binary ChatState.
+
+Builds a chat with many members (most with user IDs, like members remembered from messages)
+and reports serialized size, load time and memory of the loaded representation.
+
+Usage: python -m benchmarks.chat_state_model --members 50000 --repeat 10
+"""
+import argparse
+import json
+import random
+import string
+import timeit
+import tracemalloc
+
+from bot import models
+from bot.models import ChatState
+
+
+def build_chat_data(members: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    members_by_username = {}
+    for i in range(members):
+        username = rng.choice(string.ascii_letters) + ''.join(rng.choices(string.ascii_letters + string.digits, k=11))
+        members_by_username[username] = {models.MEMBER_ID: rng.randrange(10 ** 9, 10 ** 10)} if i % 10 else {}
+    return {
+        models.TGID: -1001234567890,
+        models.TITLE: 'Benchmark chat',
+        models.ENABLED: True,
+        models.BEGAN_AT: '2021-03-01T12:00:00',
+        models.MEMBERS_BY_USERNAME: members_by_username,
+    }
+
+
+def measure_memory(load, content) -> int:
+    """Return bytes allocated by load(content) and still held by its result."""
+    tracemalloc.start()
+    result = load(content)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    def build_contents(seed: int) -> (str, bytes):
+        # usernames are interned, so no other objects may hold them while memory is measured
+        chat_data = build_chat_data(args.members, seed=seed)
+        return json.dumps(chat_data), ChatState.from_chat_data(chat_data).encode()
+
+    json_content, binary_content = build_contents(seed=0)
+    assert ChatState.decode(binary_content).to_chat_data() == json.loads(json_content)
+
+    cases = {
+        'json dict': (False, lambda content: json.loads(content)),
+        'binary ChatState': (True, lambda content: ChatState.decode(content)),
+        'binary to dict': (True, lambda content: ChatState.decode(content).to_chat_data()),
+    }
+    print(f'{args.members} members')
+    print('representation       file KiB  load ms  memory KiB')
+    for seed, (name, (binary, load)) in enumerate(cases.items(), start=1):
+        content = binary_content if binary else json_content
+        seconds = min(timeit.repeat(lambda: load(content), number=1, repeat=args.repeat))
+        fresh_content = build_contents(seed=seed)[binary]
+        memory = measure_memory(load, fresh_content)
+        print(f'{name:<19}  {len(content) / 1024:>8.0f}  {seconds * 1000:>7.2f}  {memory / 1024:>10.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Local imitation of Telegram Bot API, which records every call instead of talking to Telegram."""
+import itertools
+import json
+import logging
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+TOKEN = '123456:FAKE-TOKEN'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Member Presence', 'username': 'member_presence_bot'}
+
+
+class _FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+    server: '_FakeBotApiHTTPServer'
+
+    def do_POST(self) -> None:
+        if self.path.startswith('/file/'):
+            self._send_file()
+            return
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            # multipart requests (file uploads) are recorded without data
+            data = {}
+        status, response = self.server.api.call(method=method, data=data)
+        content = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST
+
+    def _send_file(self) -> None:
+        content = self.server.api.files.get(self.path.rsplit('/', 1)[-1])
+        if content is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class _FakeBotApiHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # default listen backlog of 5 drops connections under concurrent requests
+    request_queue_size = 128
+
+    def __init__(self, address: tuple, api: 'FakeBotApi'):
+        super().__init__(address, _FakeBotApiRequestHandler)
+        self.api = api
+
+
+class FakeBotMethods:
+    """
+    Plausible results of Bot API methods.
+
+    Calls are recorded in `calls` as (monotonic time, method, data).
+    Method results can be overridden by putting callables into `methods`,
+    a callable receives request data and returns the result or raises `ApiError`.
+    getChatMember answers with ChatMember dicts put into `chat_members` by (chat ID, user ID),
+    other users are not found. getFile finds contents of files put into `files` by file ID,
+    which are downloaded by their ID as file path.
+    """
+
+    def __init__(self):
+        self.calls: List[Tuple[float, str, dict]] = []
+        self.methods: Dict[str, Callable[[dict], object]] = {
+            'getMe': lambda data: BOT_USER,
+            'sendMessage': self._send_message,
+            'editMessageText': self._send_message,
+            'getChatMember': self._get_chat_member,
+            'getFile': self._get_file,
+        }
+        self.chat_members: Dict[Tuple[int, int], dict] = {}
+        self.files: Dict[str, bytes] = {}
+        self._message_ids = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def call(self, method: str, data: dict) -> Tuple[int, dict]:
+        with self._condition:
+            self.calls.append((time.monotonic(), method, data))
+            self._condition.notify_all()
+        try:
+            result = self.methods.get(method, lambda data: True)(data)
+        except ApiError as error:
+            return error.status, error.response
+        return HTTPStatus.OK, {'ok': True, 'result': result}
+
+    def wait_for(self, predicate: Callable[[str, dict], bool], timeout: float = 10) -> Optional[float]:
+        """Wait for a call matching predicate and return its time, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        checked = 0
+        with self._condition:
+            while True:
+                for called_at, method, data in self.calls[checked:]:
+                    if predicate(method, data):
+                        return called_at
+                checked = len(self.calls)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    return None
+
+    def _send_message(self, data: dict) -> dict:
+        return {
+            'message_id': data.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(data['chat_id']), 'type': 'supergroup'},
+            'from': BOT_USER,
+            'text': data.get('text', ''),
+        }
+
+
+    def _get_chat_member(self, data: dict) -> dict:
+        chat_member = self.chat_members.get((int(data['chat_id']), int(data['user_id'])))
+        if chat_member is None:
+            raise ApiError(HTTPStatus.BAD_REQUEST, 'Bad Request: user not found')
+        return chat_member
+
+    def _get_file(self, data: dict) -> dict:
+        content = self.files.get(data['file_id'])
+        if content is None:
+            raise ApiError(HTTPStatus.BAD_REQUEST, 'Bad Request: invalid file_id')
+        return {
+            'file_id': data['file_id'],
+            'file_unique_id': data['file_id'],
+            'file_size': len(content),
+            'file_path': data['file_id'],
+        }
+
+
+class FakeBotApi(FakeBotMethods):
+    """
+    HTTP server that answers Bot API methods with plausible results, see `FakeBotMethods`.
+    Every response is delayed by `delay` seconds to imitate network round trip.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, delay: float = 0):
+        super().__init__()
+        self.delay = delay
+        self._httpd = _FakeBotApiHTTPServer(address=(host, port), api=self)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def call(self, method: str, data: dict) -> Tuple[int, dict]:
+        status, response = super().call(method=method, data=data)
+        if self.delay:
+            time.sleep(self.delay)
+        return status, response
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class RecordingRequest(Request):
+    """
+    Request for `telegram.Bot` which answers Bot API calls in process with `FakeBotMethods`,
+    so the bot can run without network. Error responses are raised as PTB would raise them.
+    """
+
+    def __init__(self, api: FakeBotMethods = None):
+        # connections are never opened, a large pool only keeps Updater from warning about its size
+        super().__init__(con_pool_size=32)
+        self.api = api or FakeBotMethods()
+
+    def post(self, url: str, data: dict, timeout: float = None) -> object:
+        status, response = self.api.call(method=url.rsplit('/', 1)[-1], data=data)
+        if response['ok']:
+            return response['result']
+        retry_after = response.get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            raise RetryAfter(retry_after)
+        if status == HTTPStatus.BAD_REQUEST:
+            raise BadRequest(response['description'])
+        raise TelegramError(response['description'])
+
+    def retrieve(self, url: str, timeout: float = None) -> bytes:
+        return self.api.files[url.rsplit('/', 1)[-1]]
+
+
+class ApiError(Exception):
+    """Raised by fake method implementations to respond with an error."""
+
+    def __init__(self, status: int, description: str, parameters: dict = None):
+        super().__init__(description)
+        self.status = status
+        self.response = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            self.response['parameters'] = parameters
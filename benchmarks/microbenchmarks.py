@@ -0,0 +1,258 @@
+"""
+Microbenchmarks of handlers, utils and storage, parameterized by chat size and message size.
+
+Every handler is called directly with an Update built from synthetic data and a CallbackContext
+of a dispatcher whose Bot answers requests in process. Chat data is prepared before every run
+and is not included in the measured time. Write-behind is running with a long interval,
+so handlers only mark chats dirty, and storage is measured by its own cases. Replies are queued
+by handlers and sent by the outbound queue in background, like in the bot.
+
+Results can be saved as a JSON baseline and compared with a baseline of another revision:
+    python -m benchmarks.microbenchmarks --save before.json
+    python -m benchmarks.microbenchmarks --compare before.json --threshold 1.2
+Comparison exits with code 1 if any case is slower than the baseline by more than the threshold.
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+from . import updates
+from .fake_telegram import RecordingRequest, TOKEN
+from .replay import prepare_environment
+from .webhook_latency import ADMIN_USERNAME
+
+CHAT_SIZES = (10, 1000, 10000, 100000)
+MESSAGE_SIZES = (10, 1000, 10000)
+
+CHAT_ID = -1000000000001
+ADMIN_ID = 1
+
+
+class Case(NamedTuple):
+    name: str
+    setup: Callable[[], tuple]
+    run: Callable
+
+
+def measure(case: Case, min_time: float, min_runs: int, max_runs: int) -> List[float]:
+    """
+    Run case until it took `min_time` seconds in total, at least `min_runs` times, and return run times.
+    Garbage collection is disabled while case runs, like in timeit, so objects made by setup do not slow it down.
+    """
+    times = []
+    while len(times) < max_runs and (len(times) < min_runs or sum(times) < min_time):
+        args = case.setup()
+        gc.collect()
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            case.run(*args)
+            times.append(time.perf_counter() - started_at)
+        finally:
+            gc.enable()
+    return times
+
+
+def build_chat_data(members: int) -> dict:
+    from bot import models
+    return {
+        models.TGID: CHAT_ID,
+        models.TITLE: 'Benchmark chat',
+        models.ENABLED: True,
+        models.BEGAN_AT: '2021-03-01T12:00:00',
+        models.MEMBERS_BY_USERNAME: {f'member_{i}': {models.MEMBER_ID: 100000 + i} for i in range(members)},
+    }
+
+
+def build_usernames(count: int, prefix: str = 'member') -> List[str]:
+    return [f'{prefix}_{i}' for i in range(count)]
+
+
+def iter_cases(dispatcher) -> Iterator[Case]:
+    from telegram import Update
+    from telegram.ext import CallbackContext
+    from bot import handlers, membership, storage, utils
+
+    bot = dispatcher.bot
+    chat = updates.build_chat(CHAT_ID)
+    admin = updates.build_user(ADMIN_ID, ADMIN_USERNAME)
+    caller = updates.build_user(2, 'calling_user')
+
+    def handler_setup(chat_data: dict, data: dict) -> Callable[[], tuple]:
+        update = Update.de_json(data, bot)
+        args = update.effective_message.text.split()[1:] if update.effective_message.text else []
+
+        def setup() -> tuple:
+            dispatcher.chat_data[CHAT_ID] = copy.deepcopy(chat_data)
+            # write-behind buffer holds a copy from the previous run, which would be freed during measured run
+            storage.schedule_save_chat_data(chat_id=CHAT_ID, chat_data=dispatcher.chat_data[CHAT_ID])
+            context = CallbackContext.from_update(update, dispatcher)
+            context.args = args
+            return update, context
+
+        return setup
+
+    def handler_case(name: str, callback: Callable, chat_size: int, data: dict) -> Case:
+        return Case(name=f'handlers.{name}[members={chat_size}]',
+                    setup=handler_setup(build_chat_data(chat_size), data), run=callback)
+
+    for chat_size in CHAT_SIZES:
+        roster = ' '.join(f'@{un}' for un in build_usernames(10, prefix='roster'))
+        simple_commands = [
+            ('command_help', handlers.command_help, admin, 'help', ()),
+            ('command_debug', handlers.command_debug, admin, 'debug', ()),
+            ('command_start', handlers.command_start, admin, 'start', ()),
+            ('command_check_in', handlers.command_check_in, caller, 'check_in', ()),
+            ('command_forget_me', handlers.command_forget_me, caller, 'forget_me', ()),
+            ('command_forget', handlers.command_forget, admin, 'forget', ('@member_0', '@member_1')),
+            ('command_remember', handlers.command_remember, admin, 'remember', roster.split()),
+            ('command_enable', handlers.command_enable, admin, 'enable', ()),
+            ('command_disable', handlers.command_disable, admin, 'disable', ()),
+            ('command_list', handlers.command_list, caller, 'list', ()),
+            ('command_mention_all', handlers.command_mention_all, admin, 'mention_all', ()),
+            ('command_whois', handlers.command_whois, admin, 'whois', ('@member_0',)),
+        ]
+        for name, callback, user, command, args in simple_commands:
+            yield handler_case(name, callback, chat_size, updates.build_command_update(chat, user, command, *args))
+
+        # update_members only buffers events, a batch of them is applied to chat data later
+        new_members = [updates.build_user(10 ** 6 + i, f'new_member_{i}') for i in range(5)]
+        yield handler_case('apply_membership_events', lambda update, context: handlers.apply_membership_events(
+            update, context.dispatcher, membership.events_from_update(update)), chat_size,
+            updates.build_new_members_update(chat, new_members[0], new_members))
+
+        for message_size in MESSAGE_SIZES:
+            # half of mentioned usernames are remembered
+            roster_text = '\n'.join(f'@member_{i * 2}' for i in range(message_size))
+            roster_message = updates.build_message_update(chat=chat, user=admin, text=roster_text)['message']
+            yield handler_case(f'command_check[message={message_size}]', handlers.command_check, chat_size,
+                               updates.build_command_update(chat, caller, 'check', reply_to_message=roster_message))
+
+    for message_size in MESSAGE_SIZES:
+        arguments = [f'@{un},' for un in build_usernames(message_size)]
+        yield Case(name=f'utils.extract_usernames_from_args[message={message_size}]',
+                   setup=lambda arguments=arguments: (arguments,),
+                   run=lambda arguments: utils.extract_usernames_from_args(arguments, clean=True))
+
+    for chat_size in CHAT_SIZES:
+        usernames = build_usernames(chat_size)
+        yield Case(name=f'utils.iter_pack[members={chat_size}]',
+                   setup=lambda usernames=usernames: (usernames,),
+                   run=lambda usernames: [list(pack) for pack in utils.iter_pack(usernames, size=20)])
+        yield Case(name=f'utils.iter_mention_messages[members={chat_size}]',
+                   setup=lambda usernames=usernames: (usernames,),
+                   run=lambda usernames: list(utils.iter_mention_messages(
+                       usernames, build_header=lambda count, number: f'<code>{count}</code> ({number})\n',
+                       footer='Click /check_in', max_mentions=20, max_length=4096)))
+
+    for chat_size in CHAT_SIZES:
+        # separate chat IDs, so pending chat data of handler cases is never restored instead of stored one
+        storage_chat_id = CHAT_ID - chat_size
+        chat_data = build_chat_data(chat_size)
+
+        def save_setup(chat_data: dict = chat_data) -> tuple:
+            # a changed chat is written every time, JSON storage skips identical contents
+            chat_data[handlers.CHAT_DATA.TITLE] = f'Benchmark chat {time.perf_counter()}'
+            return chat_data,
+
+        yield Case(name=f'storage.save_chat_data[members={chat_size}]', setup=save_setup,
+                   run=lambda chat_data, chat_id=storage_chat_id: storage.save_chat_data(chat_id, chat_data))
+        yield Case(name=f'storage.restore_chat_data[members={chat_size}]',
+                   setup=lambda chat_id=storage_chat_id: (chat_id,),
+                   run=lambda chat_id: storage.restore_chat_data(chat_id))
+
+
+def run_suite(selected: List[str], min_time: float, min_runs: int, max_runs: int) -> Dict[str, dict]:
+    from telegram import Bot
+    from bot import main, outbound, storage
+
+    bot = Bot(TOKEN, request=RecordingRequest())
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    bot.get_me()
+    storage.start_write_behind()
+    outbound.sender.start()
+
+    results = {}
+    print(f'{"case":<64}  {"median ms":>10}  {"min ms":>10}  runs')
+    for case in iter_cases(dispatcher):
+        if selected and not any(pattern in case.name for pattern in selected):
+            continue
+        times = measure(case, min_time=min_time, min_runs=min_runs, max_runs=max_runs)
+        results[case.name] = {'median': statistics.median(times), 'min': min(times), 'runs': len(times)}
+        print(f'{case.name:<64}  {results[case.name]["median"] * 1000:>10.3f}  '
+              f'{results[case.name]["min"] * 1000:>10.3f}  {len(times)}')
+    outbound.sender.stop()
+    return results
+
+
+def _revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[Tuple[str, float]]:
+    """Print ratios of medians to baseline and return cases slower than threshold."""
+    regressions = []
+    print(f'\n{"case":<64}  {"baseline ms":>11}  {"now ms":>10}  ratio')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median'] if baseline[name]['median'] else float('inf')
+        marker = '  SLOWER' if ratio > threshold else ''
+        print(f'{name:<64}  {baseline[name]["median"] * 1000:>11.3f}  {result["median"] * 1000:>10.3f}  '
+              f'{ratio:5.2f}{marker}')
+        if ratio > threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('cases', nargs='*', help='run only cases which names contain any of these strings')
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'journal', 'binary'], default='json')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds to spend in every case at least')
+    parser.add_argument('--min-runs', type=int, default=3)
+    parser.add_argument('--max-runs', type=int, default=1000)
+    parser.add_argument('--save', help='write results to a JSON baseline file')
+    parser.add_argument('--compare', help='compare results with a JSON baseline file')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_environment(data_dir=data_dir, backend=args.backend)
+        os.environ['TGBOT_STORAGE_FLUSH_INTERVAL'] = '3600'
+        results = run_suite(selected=args.cases, min_time=args.min_time, min_runs=args.min_runs,
+                            max_runs=args.max_runs)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({
+                'revision': _revision(),
+                'python': platform.python_version(),
+                'backend': args.backend,
+                'results': results,
+            }, fp, indent=2)
+        print(f'\nSaved baseline to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        print(f'\nBaseline: revision {baseline.get("revision") or "unknown"}, backend {baseline.get("backend")}')
+        if compare(results, baseline['results'], threshold=args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
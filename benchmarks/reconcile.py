@@ -0,0 +1,143 @@
+"""
+/reconcile of a large chat against a local fake Bot API server.
+
+Stores a chat with remembered members, of which some left the chat, some renamed themselves,
+some were never seen by Telegram and some have no user ID, then runs /reconcile in process
+with a Bot talking HTTP to the fake Bot API, which answers getChatMember with `--delay` latency.
+With `--interrupt` the session is stopped after the first saved chunk and started again,
+like after a restart. Reports calls per second and verifies the remembered members at the end.
+
+Usage: python -m benchmarks.reconcile --members 5000 --rate 200 --workers 8 --delay 0.02 --interrupt
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from . import updates
+from .fake_telegram import FakeBotApi, TOKEN
+from .replay import prepare_environment
+from .webhook_latency import ADMIN_USERNAME
+
+CHAT_ID = -1000000000001
+
+
+def build_chat(api: FakeBotApi, members: int, seed: int = 0) -> (dict, set):
+    """Return chat data and usernames which must stay remembered, and fill chat members of the fake API."""
+    from bot import models
+    rng = random.Random(seed)
+    remembered = {}
+    expected = set()
+    for i in range(members):
+        username, user_id = f'member_{i}', 100000 + i
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'Member {i}', 'username': username}
+        kind = rng.random()
+        if kind < 0.05:
+            # remembered with /remember, can not be checked
+            remembered[username] = {}
+            expected.add(username)
+            continue
+        remembered[username] = {models.MEMBER_ID: user_id}
+        if kind < 0.15:
+            api.chat_members[(CHAT_ID, user_id)] = {'status': 'left', 'user': user}
+        elif kind < 0.18:
+            api.chat_members[(CHAT_ID, user_id)] = {'status': 'kicked', 'user': user, 'until_date': 0}
+        elif kind < 0.20:
+            pass  # not found
+        elif kind < 0.25:
+            user = dict(user, username=f'renamed_{i}')
+            api.chat_members[(CHAT_ID, user_id)] = {'status': 'member', 'user': user}
+            expected.add(user['username'])
+        else:
+            api.chat_members[(CHAT_ID, user_id)] = {'status': 'member', 'user': user}
+            expected.add(username)
+    chat_data = {
+        models.TGID: CHAT_ID,
+        models.TITLE: 'Benchmark chat',
+        models.ENABLED: True,
+        models.BEGAN_AT: '2021-03-01T12:00:00',
+        models.MEMBERS_BY_USERNAME: remembered,
+    }
+    return chat_data, expected
+
+
+def run(members: int, delay: float, interrupt: bool) -> bool:
+    from telegram import Bot, Update
+    from telegram.utils.request import Request
+    from bot import main, reconcile, settings, storage
+
+    api = FakeBotApi(delay=delay)
+    api.start()
+    bot = Bot(TOKEN, base_url=api.base_url, request=Request(con_pool_size=settings.TGBOT_RECONCILE_WORKERS + 8))
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat_data, expected = build_chat(api, members)
+    storage.save_chat_data(chat_id=CHAT_ID, chat_data=chat_data)
+    main.start_background_tasks()
+    bot.get_me()
+
+    chat = updates.build_chat(CHAT_ID)
+    admin = updates.build_user(1, ADMIN_USERNAME)
+
+    def dispatch(*args: str) -> None:
+        dispatcher.process_update(Update.de_json(updates.build_command_update(chat, admin, 'reconcile', *args), bot))
+
+    def report_sent(method: str, data: dict) -> bool:
+        return method == 'sendMessage' and data.get('text', '').startswith('Reconcile ')
+
+    started_at = time.monotonic()
+    dispatch()
+    if interrupt:
+        # stop right after the first chunk is saved, and continue from the saved cursor
+        while not storage.restore_chat_data(CHAT_ID).get('reconcile', {}).get('cursor'):
+            time.sleep(0.01)
+        dispatch('stop')
+        while reconcile.reconciler.is_running(CHAT_ID):
+            time.sleep(0.01)
+        dispatch()
+    finished = api.wait_for(lambda method, data: report_sent(method, data) and 'finished' in data['text'],
+                            timeout=3600)
+    elapsed = (finished or time.monotonic()) - started_at
+    main.stop_background_tasks()
+    api.stop()
+
+    calls = sum(1 for _, method, _ in api.calls if method == 'getChatMember')
+    remembered = set(storage.restore_chat_data(CHAT_ID)[storage.MEMBERS_BY_USERNAME])
+    print(f'members: {members}')
+    print(f'getChatMember calls: {calls}')
+    print(f'seconds: {elapsed:.2f}')
+    print(f'calls per second: {calls / elapsed:.1f}')
+    print(f'remembered after reconcile: {len(remembered)}, expected: {len(expected)}')
+    for _, method, data in api.calls:
+        if report_sent(method, data):
+            print(data['text'].splitlines()[0])
+    if remembered != expected:
+        print(f'unexpected: {sorted(remembered - expected)[:10]}, missing: {sorted(expected - remembered)[:10]}')
+    return finished is not None and remembered == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=200, help='getChatMember calls per second')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0.02, help='seconds of fake Bot API response latency')
+    parser.add_argument('--interrupt', action='store_true', help='stop after the first chunk and continue')
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'journal', 'binary'], default='json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_environment(data_dir=data_dir, backend=args.backend)
+        os.environ.update({
+            'TGBOT_RECONCILE_RATE': str(args.rate),
+            'TGBOT_RECONCILE_WORKERS': str(args.workers),
+            'TGBOT_RECONCILE_CHUNK_SIZE': str(args.chunk_size),
+        })
+        ok = run(members=args.members, delay=args.delay, interrupt=args.interrupt)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
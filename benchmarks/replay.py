@@ -0,0 +1,263 @@
+"""
+Offline replay of Telegram updates through the real dispatcher and handlers.
+
+Updates are read from a JSONL file (one decoded update per line) and processed in this process
+by the bot from bot/main.py, with a Bot whose requests are answered in process and recorded.
+Reports updates per second, handler latency (from dispatch until the chat's handler finished,
+including waiting behind earlier updates of the chat; for joins and leaves, until their batch was applied),
+bytes written by the process and Bot API calls.
+
+Usage:
+    python -m benchmarks.replay generate --workload join-burst --updates 5000 --output join-burst.jsonl
+    python -m benchmarks.replay run join-burst.jsonl --backend sqlite
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Iterable, Iterator, List
+
+from . import updates
+from .fake_telegram import RecordingRequest, TOKEN
+from .webhook_latency import ADMIN_USERNAME, percentile
+
+WORKLOADS = ('join-burst', 'big-check', 'many-small-chats')
+
+
+def _setup_chat(chat: dict, admin: dict, usernames: List[str] = ()) -> List[dict]:
+    return [
+        updates.build_command_update(chat, admin, 'start', *(f'@{username}' for username in usernames)),
+        updates.build_command_update(chat, admin, 'enable'),
+    ]
+
+
+def generate_join_burst(total_updates: int, seed: int = 0) -> Iterator[dict]:
+    """A single chat where members join in bursts of 1-5 users, with some of them leaving."""
+    rng = random.Random(seed)
+    admin = updates.build_user(1, ADMIN_USERNAME)
+    chat = updates.build_chat(-1000000000001)
+    yield from _setup_chat(chat, admin)
+    user_ids = iter(range(100000, 10 ** 9))
+    joined = []
+    for _ in range(total_updates):
+        if joined and rng.random() < 0.1:
+            user = joined.pop(rng.randrange(len(joined)))
+            yield updates.build_left_member_update(chat, user, user)
+            continue
+        new_members = [updates.build_user(user_id, f'user_{user_id}') for user_id in
+                       (next(user_ids) for _ in range(rng.randint(1, 5)))]
+        joined.extend(new_members)
+        yield updates.build_new_members_update(chat, new_members[0], new_members)
+
+
+def generate_big_check(total_updates: int, roster_size: int = 5000, seed: int = 0) -> Iterator[dict]:
+    """A single chat where /check replies to a large roster, a tenth of which is not remembered."""
+    rng = random.Random(seed)
+    admin = updates.build_user(1, ADMIN_USERNAME)
+    chat = updates.build_chat(-1000000000002)
+    roster = [f'roster_user_{i}' for i in range(roster_size)]
+    present = [username for username in roster if rng.random() >= 0.1]
+    # remember present members in portions, as admins would do
+    yield updates.build_command_update(chat, admin, 'start')
+    yield updates.build_command_update(chat, admin, 'enable')
+    for i in range(0, len(present), 500):
+        yield updates.build_command_update(chat, admin, 'remember', *(f'@{un}' for un in present[i:i + 500]))
+    roster_message = updates.build_message_update(
+        chat=chat, user=admin, text='\n'.join(f'{i + 1}. @{un}' for i, un in enumerate(roster)))['message']
+    for i in range(total_updates):
+        user = updates.build_user(100000 + i, f'user_{100000 + i}')
+        yield updates.build_command_update(chat, user, 'check', reply_to_message=roster_message)
+
+
+def generate_many_small_chats(total_updates: int, chats: int = 1000, seed: int = 0) -> Iterator[dict]:
+    """Many chats of a few members, which check in, list members and check small rosters."""
+    rng = random.Random(seed)
+    admin = updates.build_user(1, ADMIN_USERNAME)
+    chat_list = [updates.build_chat(-1000000100000 - i) for i in range(chats)]
+    for chat in chat_list:
+        yield from _setup_chat(chat, admin, usernames=[f'member_{-chat["id"]}_{i}' for i in range(3)])
+    for i in range(total_updates):
+        chat = rng.choice(chat_list)
+        user = updates.build_user(100000 + i % 5000, f'user_{100000 + i % 5000}')
+        command = rng.choice(('check_in', 'check_in', 'list', 'check'))
+        if command == 'check':
+            roster = updates.build_message_update(
+                chat=chat, user=admin, text=' '.join(f'@user_{100000 + rng.randrange(5000)}' for _ in range(10)))
+            yield updates.build_command_update(chat, user, 'check', reply_to_message=roster['message'])
+        else:
+            yield updates.build_command_update(chat, user, command)
+
+
+def generate(workload: str, total_updates: int, seed: int = 0) -> Iterator[dict]:
+    if workload == 'join-burst':
+        return generate_join_burst(total_updates=total_updates, seed=seed)
+    elif workload == 'big-check':
+        return generate_big_check(total_updates=total_updates, seed=seed)
+    elif workload == 'many-small-chats':
+        return generate_many_small_chats(total_updates=total_updates, seed=seed)
+    else:
+        raise ValueError(f'Unknown workload: {workload}')
+
+
+def read_updates(filename: str) -> Iterator[dict]:
+    with open(filename) as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_updates(filename: str, update_list: Iterable[dict]) -> int:
+    written = 0
+    with open(filename, 'w') as fp:
+        for update in update_list:
+            fp.write(json.dumps(update) + '\n')
+            written += 1
+    return written
+
+
+def _bytes_written() -> int:
+    """Return bytes written by this process so far (Linux only, 0 elsewhere)."""
+    try:
+        with open('/proc/self/io') as fp:
+            for line in fp:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def replay(update_list: List[dict], rate: float = 0) -> dict:
+    """
+    Process updates with the bot and return measurements.
+    Bot settings are taken from environment, which must be prepared before the first call.
+    If `rate` is given, updates are dispatched at most `rate` per second instead of as fast as possible.
+    """
+    from telegram import Bot, Update
+    from bot import concurrency, handlers, main, membership
+
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    updater = main.build_updater(bot=bot)
+    dispatcher = updater.dispatcher
+    main.start_background_tasks()
+    bot.get_me()
+
+    decoded = [Update.de_json(data, bot) for data in update_list]
+    dispatched_at = {}
+    latencies = []
+    lock = threading.Lock()
+    all_done = threading.Event()
+    remaining = [len(decoded)]
+
+    def done(update_id: int) -> None:
+        finished_at = time.monotonic()
+        with lock:
+            latencies.append(finished_at - dispatched_at[update_id])
+            remaining[0] -= 1
+            if not remaining[0]:
+                all_done.set()
+
+    # ids of dispatched membership updates by chat, they are done when a batch with them is applied
+    pending_members = collections.defaultdict(collections.deque)
+    apply_membership_events = handlers.apply_membership_events
+
+    def apply_and_mark_done(update: Update, dispatcher, events) -> None:
+        try:
+            apply_membership_events(update, dispatcher, events)
+        finally:
+            # a batch is applied with its last update, so it holds all updates of the chat up to that one
+            chat_pending = pending_members[update.effective_chat.id]
+            while chat_pending and chat_pending[0] <= update.update_id:
+                done(chat_pending.popleft())
+
+    handlers.apply_membership_events = apply_and_mark_done
+    if not decoded:
+        all_done.set()
+    bytes_before = _bytes_written()
+    calls_before = len(request.api.calls)
+    started_at = time.monotonic()
+    for i, update in enumerate(decoded):
+        if rate:
+            delay = started_at + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        # membership events are applied later in batches, not by handlers of the update
+        batched = bool(membership.events_from_update(update))
+        with lock:
+            dispatched_at[update.update_id] = time.monotonic()
+            if batched:
+                pending_members[chat_id].append(update.update_id)
+        dispatcher.process_update(update)
+        if not batched:
+            # runs after handlers of the update, because tasks of a chat run in submission order
+            concurrency.chat_executor.submit(chat_id, done, update.update_id)
+    all_done.wait()
+    elapsed = time.monotonic() - started_at
+    handlers.apply_membership_events = apply_membership_events
+
+    # outgoing queue and storage are flushed here, so their work is counted too
+    main.stop_background_tasks()
+    methods = collections.Counter(method for _, method, _ in request.api.calls[calls_before:])
+    return {
+        'updates': len(decoded),
+        'seconds': elapsed,
+        'updates_per_second': len(decoded) / elapsed if elapsed else 0.0,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000 if latencies else 0.0,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+        'bytes_written': _bytes_written() - bytes_before,
+        'outgoing_messages': methods['sendMessage'],
+        'api_calls': dict(methods),
+    }
+
+
+def prepare_environment(data_dir: str, backend: str) -> None:
+    """Configure bot settings for replay, must be called before bot modules are imported."""
+    os.environ.update({
+        'TGBOT_APIKEY': TOKEN,
+        'TGBOT_ADMIN_USERNAMES': ADMIN_USERNAME,
+        'TGBOT_DATA_DIR': data_dir,
+        'TGBOT_STORAGE_BACKEND': backend,
+        # replies are not limited by Telegram here, so measure how fast the bot can produce them
+        'TGBOT_SEND_RATE': '1000000',
+        'TGBOT_CHAT_SEND_RATE': '1000000',
+        'TGBOT_CHAT_SEND_BURST': '1000000',
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic workload')
+    generate_parser.add_argument('--workload', choices=WORKLOADS, required=True)
+    generate_parser.add_argument('--updates', type=int, default=5000)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--output', required=True)
+
+    run_parser = subparsers.add_parser('run', help='replay updates from a JSONL file')
+    run_parser.add_argument('input')
+    run_parser.add_argument('--backend', choices=['json', 'sqlite', 'journal', 'binary'], default='json')
+    run_parser.add_argument('--rate', type=float, default=0, help='updates per second, as fast as possible if 0')
+    args = parser.parse_args()
+
+    if args.action == 'generate':
+        written = write_updates(args.output, generate(args.workload, total_updates=args.updates, seed=args.seed))
+        print(f'Wrote {written} updates to {args.output}')
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_environment(data_dir=data_dir, backend=args.backend)
+        result = replay(list(read_updates(args.input)), rate=args.rate)
+    for key, value in result.items():
+        print(f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
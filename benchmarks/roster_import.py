@@ -0,0 +1,122 @@
+"""
+/import of a large roster file, /export of the stored roster and the offline roster CLI.
+
+Writes a roster file of `--members` usernames (CSV with names and mentions, or one username per line),
+then runs /import in reply to it and /export in process, without network. Reports import time,
+storage writes and bytes, and verifies that the exported file lists all imported members and that
+manage_roster.py imports it back into another chat.
+
+Usage: python -m benchmarks.roster_import --members 10000 --format csv --backend json
+"""
+import argparse
+import csv
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import updates
+from .fake_telegram import RecordingRequest, TOKEN
+from .replay import prepare_environment
+from .webhook_latency import ADMIN_USERNAME
+
+CHAT_ID = -1000000000001
+OTHER_CHAT_ID = -1000000000002
+
+
+def build_roster_file(members: int, file_format: str) -> bytes:
+    fp = io.StringIO()
+    if file_format == 'csv':
+        writer = csv.writer(fp)
+        writer.writerow(['Name', 'Telegram', 'Team'])
+        for i in range(members):
+            writer.writerow([f'Member {i}', f'@member_{i}', f'Team {i % 7}'])
+    else:
+        for i in range(members):
+            fp.write(f'member_{i}\n')
+    return fp.getvalue().encode()
+
+
+def run(members: int, file_format: str, data_dir: str) -> bool:
+    from telegram import Bot, Update
+    from bot import main, metrics, storage
+
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    main.start_background_tasks()
+
+    admin = updates.build_user(1, ADMIN_USERNAME)
+    chat = updates.build_chat(CHAT_ID)
+
+    def dispatch(command: str, reply_to_message: dict = None) -> None:
+        dispatcher.process_update(Update.de_json(
+            updates.build_command_update(chat, admin, command, reply_to_message=reply_to_message), bot))
+
+    dispatch('start')
+    storage.flush_chat_data(CHAT_ID)
+    request.api.files['roster'] = build_roster_file(members, file_format)
+    document_message = updates.build_message_update(chat=chat, user=admin, text=None, document={
+        'file_id': 'roster',
+        'file_unique_id': 'roster',
+        'file_name': f'roster.{file_format}',
+        'file_size': len(request.api.files['roster']),
+    })['message']
+
+    writes_before = metrics.storage_duration.count(operation='write')
+    bytes_before = metrics.storage_bytes.value(operation='write')
+    started_at = time.monotonic()
+    dispatch('import', reply_to_message=document_message)
+    imported_at = request.api.wait_for(
+        lambda method, data: method == 'sendMessage' and data['text'].startswith('Remembered'), timeout=600)
+    storage.flush_chat_data(CHAT_ID)
+    writes = metrics.storage_duration.count(operation='write') - writes_before
+    written = metrics.storage_bytes.value(operation='write') - bytes_before
+
+    dispatch('export')
+    request.api.wait_for(lambda method, data: method == 'sendDocument', timeout=600)
+    main.stop_background_tasks()
+
+    exported = next(data for _, method, data in request.api.calls if method == 'sendDocument')['document']
+    exported_filename = os.path.join(data_dir, 'exported.csv')
+    with open(exported_filename, 'wb') as fp:
+        fp.write(exported.input_file_content)
+    exported_usernames = {row[0] for row in csv.reader(io.StringIO(exported.input_file_content.decode()))}
+    expected = {f'member_{i}' for i in range(members)}
+    print(f'members: {members}')
+    print(f'import seconds: {imported_at - started_at:.2f}')
+    print(f'storage writes: {writes}, bytes written: {int(written)}')
+    print(f'exported bytes: {len(exported.input_file_content)}')
+
+    # the offline CLI imports the exported file into another stored chat
+    storage.save_chat_data(chat_id=OTHER_CHAT_ID, chat_data=dict(
+        storage.restore_chat_data(CHAT_ID), **{storage.MEMBERS_BY_USERNAME: {}}))
+    storage.stop_write_behind()
+    subprocess.run([sys.executable, 'manage_roster.py', 'import', str(OTHER_CHAT_ID), exported_filename], check=True)
+    cli_output = subprocess.run(
+        [sys.executable, 'manage_roster.py', 'export', str(OTHER_CHAT_ID)], check=True, capture_output=True).stdout
+    cli_usernames = {row[0] for row in csv.reader(io.StringIO(cli_output.decode()))}
+
+    ok = expected <= exported_usernames and cli_usernames == exported_usernames
+    print(f'exported roster matches: {expected <= exported_usernames}, CLI roundtrip matches: {ok}')
+    return imported_at is not None and ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--format', choices=['csv', 'txt'], default='csv')
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'journal', 'binary'], default='json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_environment(data_dir=data_dir, backend=args.backend)
+        os.environ['TGBOT_SQLITE_PATH'] = os.path.join(data_dir, 'bot-data.sqlite3')
+        ok = run(members=args.members, file_format=args.format, data_dir=data_dir)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Throughput of supervisor mode (start_sharded.py) depending on number of worker processes.
+
+Runs the same webhook workload against 1, 2, 4... workers and prints updates per second for each.
+The default `check` workload is CPU-bound, so a single process is limited by GIL.
+
+Usage: python -m benchmarks.sharding_throughput --shards 1 2 4 --chats 16 --updates 2000
+"""
+import argparse
+
+from . import webhook_latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chats', type=int, default=16)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--command', choices=['check_in', 'check'], default='check')
+    args = parser.parse_args()
+
+    print('shards  updates/s  p50 ms  p99 ms')
+    for shards in args.shards:
+        result = webhook_latency.run(
+            chats=args.chats,
+            total_updates=args.updates,
+            concurrency=args.concurrency,
+            command=args.command,
+            script='start_sharded.py',
+            script_args=['webhook'],
+            extra_env={'TGBOT_SHARDS': str(shards)},
+        )
+        print(f'{shards:>6}  {result["updates_per_second"]:>9.1f}  '
+              f'{result["latency_p50_ms"]:>6.1f}  {result["latency_p99_ms"]:>6.1f}')
+
+
+if __name__ == '__main__':
+    main()
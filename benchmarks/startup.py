@@ -0,0 +1,90 @@
+"""
+Startup time of the bot process as the number of stored chats grows.
+
+Writes chats with `--members` members each straight into the storage backend, then starts fresh processes
+which read chat metadata and prepare the user index, like `main.start_background_tasks` does:
+the first start has no manifest and rebuilds it from all chats, the next one only reads the manifest.
+Also reports the first lookup across chats (e.g. /whois), which loads all chats lazily.
+
+Usage: python -m benchmarks.startup --chats 1000 5000 20000 --members 50 --backend json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from .replay import prepare_environment
+
+
+def write_chats(first: int, last: int, members: int) -> None:
+    from bot import models, storage
+    backend = storage.build_backend()
+    for i in range(first, last):
+        chat_id = -1000000000000 - i
+        backend.write(chat_id=chat_id, chat_data={
+            models.TGID: chat_id,
+            models.TITLE: f'Chat {i}',
+            models.ENABLED: True,
+            models.BEGAN_AT: '2021-03-01T12:00:00',
+            models.MEMBERS_BY_USERNAME: {
+                f'member_{i}_{j}': {models.MEMBER_ID: i * members + j} for j in range(members)
+            },
+        }, changed_usernames=None)
+    backend.close()
+
+
+def measure() -> None:
+    """Print startup and first lookup durations of this process as JSON."""
+    started_at = time.perf_counter()
+    from bot import storage
+    from bot.user_index import user_index
+    imported_at = time.perf_counter()
+    storage.load_manifest()
+    user_index.build()
+    started = time.perf_counter() - imported_at
+    user_index.user_id_of('member_0_0')
+    lookup = time.perf_counter() - imported_at - started
+    storage.stop_write_behind()
+    print(json.dumps({'import': imported_at - started_at, 'startup': started, 'first_lookup': lookup}))
+
+
+def run_process() -> dict:
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup', '--measure'], check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'journal', 'binary'], default='json')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure()
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_environment(data_dir=data_dir, backend=args.backend)
+        os.environ['TGBOT_SQLITE_PATH'] = os.path.join(data_dir, 'bot-data.sqlite3')
+        print(f'{"chats":>8} {"rebuild":>10} {"startup":>10} {"first lookup":>14}')
+        written = 0
+        for chats in sorted(args.chats):
+            write_chats(first=written, last=chats, members=args.members)
+            written = chats
+            # chats were written around the manifest, so it is rebuilt on the first start
+            for filename in os.listdir(data_dir):
+                if filename.startswith('chats-manifest'):
+                    os.unlink(os.path.join(data_dir, filename))
+            rebuild = run_process()
+            cold = run_process()
+            print(f'{chats:>8} {rebuild["startup"]:>9.3f}s {cold["startup"]:>9.3f}s {cold["first_lookup"]:>13.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Builders of synthetic Telegram updates as decoded JSON dicts."""
+import itertools
+import re
+import time
+from typing import List
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+_MENTION_PATTERN = re.compile(r'(?<!\w)@[a-zA-Z0-9_]{5,32}(?!\w)')
+
+
+def build_user(user_id: int, username: str = None) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+    if username:
+        user['username'] = username
+    return user
+
+
+def build_chat(chat_id: int, title: str = None) -> dict:
+    return {'id': chat_id, 'type': 'supergroup', 'title': title or f'Chat {chat_id}'}
+
+
+def build_mention_entities(text: str) -> List[dict]:
+    """Return mention entities of text, as Telegram would parse them (offsets are in UTF-16 code units)."""
+    return [
+        {
+            'type': 'mention',
+            'offset': len(text[:match.start()].encode('utf-16-le')) // 2,
+            'length': len(match.group(0).encode('utf-16-le')) // 2,
+        }
+        for match in _MENTION_PATTERN.finditer(text)
+    ]
+
+
+def build_message_update(chat: dict, user: dict, text: str, reply_to_message: dict = None, **fields) -> dict:
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': chat,
+        'from': user,
+        **fields,
+    }
+    if text is not None:
+        message['text'] = text
+        entities = build_mention_entities(text)
+        if text.startswith('/'):
+            entities.insert(0, {'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])})
+        if entities:
+            message['entities'] = entities
+    if reply_to_message is not None:
+        message['reply_to_message'] = reply_to_message
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def build_command_update(chat: dict, user: dict, command: str, *args: str, reply_to_message: dict = None) -> dict:
+    text = ' '.join((f'/{command}',) + args)
+    return build_message_update(chat=chat, user=user, text=text, reply_to_message=reply_to_message)
+
+
+def build_new_members_update(chat: dict, user: dict, new_members: List[dict]) -> dict:
+    return build_message_update(chat=chat, user=user, text=None, new_chat_members=new_members)
+
+
+def build_left_member_update(chat: dict, user: dict, left_member: dict) -> dict:
+    return build_message_update(chat=chat, user=user, text=None, left_chat_member=left_member)
+
+
+def build_callback_query_update(user: dict, message: dict, data: str) -> dict:
+    """Update of an inline keyboard button under the message being pressed."""
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': user,
+            'message': message,
+            'chat_instance': str(message['chat']['id']),
+            'data': data,
+        },
+    }
@@ -0,0 +1,74 @@
+"""
+Speed of extracting usernames from a large /check reply-to message.
+
+Compares the previous per-token regex extractor with the single-pass scanner,
+on plain text and on a message with mention entities parsed by Telegram.
+
+Usage: python -m benchmarks.username_extraction --usernames 5000 --repeat 20
+"""
+import argparse
+import random
+import re
+import string
+import timeit
+from typing import List
+
+from telegram import Message
+
+from bot.utils import extract_usernames_from_messages, iter_text_usernames, iter_unique
+from . import updates
+
+
+def _find_all_usernames(string: str) -> List[str]:
+    """Previous extractor, kept here as the baseline."""
+    tg_nick_pattern = r'.*\B@(?=\w{5,64}\b)[a-zA-Z0-9]+(?:_[a-zA-Z0-9]+)*.*'
+    return re.findall(tg_nick_pattern, string)
+
+
+def legacy_extract_usernames(text: str) -> List[str]:
+    arguments = text.replace('\n', ' ').split(' ')
+    return [
+        full_username_list[0][1:]
+        for full_username_list in (_find_all_usernames(arg) for arg in arguments)
+        if full_username_list
+    ]
+
+
+def build_roster_text(usernames: int, seed: int = 0) -> str:
+    """Return a pasted roster: one member per line with a name, a username and some noise."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(usernames):
+        username = rng.choice(string.ascii_letters) + ''.join(rng.choices(string.ascii_letters + string.digits, k=11))
+        lines.append(f'{i + 1}. Member {i} @{username} joined, email member{i}@example.com')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--usernames', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    text = build_roster_text(args.usernames)
+    update = updates.build_message_update(chat=updates.build_chat(-1), user=updates.build_user(1), text=text)
+    message = Message.de_json(update['message'], bot=None)
+
+    expected = set(legacy_extract_usernames(text))
+    assert set(iter_text_usernames(text)) == expected
+    assert set(extract_usernames_from_messages(message)) == expected
+
+    cases = {
+        'legacy per-token regex': lambda: set(legacy_extract_usernames(text)),
+        'single-pass text scan': lambda: set(iter_unique(iter_text_usernames(text))),
+        'mention entities': lambda: set(extract_usernames_from_messages(message)),
+    }
+    print(f'{args.usernames} usernames, {len(text)} characters')
+    print('extractor                 ms per message')
+    for name, function in cases.items():
+        seconds = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print(f'{name:<24}  {seconds * 1000:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
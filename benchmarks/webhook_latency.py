@@ -0,0 +1,181 @@
+"""
+End-to-end latency of webhook mode against a fake Bot API.
+
+Starts a fake Bot API server and the bot (start_webhook.py) in a subprocess pointed at it,
+POSTs /check_in updates to the webhook and measures time until the bot replies to each of them.
+
+Usage: python -m benchmarks.webhook_latency --chats 10 --updates 1000 --concurrency 20
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from . import updates
+from .fake_telegram import FakeBotApi, TOKEN
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_USERNAME = 'admin_user'
+SECRET_TOKEN = 'benchmark-secret'
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Bot did not start listening on port {port}')
+
+
+def start_bot(api: FakeBotApi, data_dir: str, port: int, script: str = 'start_webhook.py',
+              script_args: list = (), extra_env: dict = None) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        'TGBOT_APIKEY': TOKEN,
+        'TGBOT_API_BASE_URL': api.base_url,
+        'TGBOT_ADMIN_USERNAMES': ADMIN_USERNAME,
+        'TGBOT_DATA_DIR': data_dir,
+        'TGBOT_WEBHOOK_LISTEN': '127.0.0.1',
+        'TGBOT_WEBHOOK_PORT': str(port),
+        'TGBOT_WEBHOOK_PATH': '/webhook',
+        'TGBOT_WEBHOOK_SECRET_TOKEN': SECRET_TOKEN,
+        'TGBOT_WEBHOOK_URL': '',
+        # replies are not limited by Telegram here, so measure how fast the bot can produce them
+        'TGBOT_SEND_RATE': '1000000',
+        'TGBOT_CHAT_SEND_RATE': '1000000',
+        'TGBOT_CHAT_SEND_BURST': '1000000',
+        'LOG_LEVEL': 'WARNING',
+        **(extra_env or {}),
+    }
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, script), *script_args], env=env, cwd=BASE_DIR)
+    _wait_for_port(port)
+    return process
+
+
+def post_update(port: int, update: dict) -> int:
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}/webhook',
+        data=json.dumps(update).encode(),
+        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN},
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+def send_and_wait_reply(api: FakeBotApi, port: int, update: dict, timeout: float = 30) -> float:
+    """Post update to the webhook and return seconds until the bot replied to it."""
+    message = update['message']
+    chat_id, message_id = message['chat']['id'], message['message_id']
+    started_at = time.monotonic()
+    post_update(port=port, update=update)
+    replied_at = api.wait_for(
+        lambda method, data: (
+            method == 'sendMessage'
+            and int(data.get('chat_id', 0)) == chat_id
+            and int(data.get('reply_to_message_id', 0)) == message_id
+        ),
+        timeout=timeout,
+    )
+    if replied_at is None:
+        raise TimeoutError(f'No reply to message {message_id} in chat {chat_id}')
+    return replied_at - started_at
+
+
+def build_workload(chats: int, total_updates: int, command: str = 'check_in', roster_size: int = 500) -> tuple:
+    """
+    Build /start updates for every chat and workload updates spread over chats.
+    `check_in` workload is cheap for the bot, `check` workload replies to a roster of `roster_size` usernames
+    and makes the bot parse it on every update. Roster users are remembered on /start,
+    so the bot replies with a single message and the fake Bot API does not become a bottleneck.
+    """
+    admin = updates.build_user(1, ADMIN_USERNAME)
+    chat_list = [updates.build_chat(-1000000000000 - i) for i in range(chats)]
+    roster_usernames = [f'@roster_user_{i}' for i in range(roster_size)] if command == 'check' else []
+    setup = [updates.build_command_update(chat, admin, 'start', *roster_usernames) for chat in chat_list]
+    roster = '\n'.join(roster_usernames)
+    workload = []
+    for i in range(total_updates):
+        chat = chat_list[i % chats]
+        user = updates.build_user(1000 + i, f'user_{1000 + i}')
+        if command == 'check':
+            roster_message = updates.build_message_update(chat=chat, user=admin, text=roster)['message']
+            workload.append(updates.build_command_update(chat, user, 'check', reply_to_message=roster_message))
+        else:
+            workload.append(updates.build_command_update(chat, user, command))
+    return setup, workload
+
+
+def run(chats: int, total_updates: int, concurrency: int, command: str = 'check_in', api_delay: float = 0,
+        script: str = 'start_webhook.py', script_args: list = (), extra_env: dict = None) -> dict:
+    api = FakeBotApi(delay=api_delay)
+    api.start()
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        process = start_bot(api=api, data_dir=data_dir, port=port, script=script, script_args=script_args,
+                            extra_env=extra_env)
+        try:
+            setup, workload = build_workload(chats=chats, total_updates=total_updates, command=command)
+            for update in setup:
+                send_and_wait_reply(api=api, port=port, update=update)
+
+            started_at = time.monotonic()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = list(executor.map(lambda update: send_and_wait_reply(api, port, update), workload))
+            elapsed = time.monotonic() - started_at
+        finally:
+            process.terminate()
+            process.wait()
+            api.stop()
+
+    return {
+        'updates': len(latencies),
+        'seconds': elapsed,
+        'updates_per_second': len(latencies) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'latency_max_ms': max(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--command', choices=['check_in', 'check'], default='check_in')
+    parser.add_argument('--api-delay-ms', type=float, default=0, help='delay of every fake Bot API response')
+    args = parser.parse_args()
+
+    result = run(
+        chats=args.chats,
+        total_updates=args.updates,
+        concurrency=args.concurrency,
+        command=args.command,
+        api_delay=args.api_delay_ms / 1000,
+    )
+    for key, value in result.items():
+        print(f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import hashlib
+import os
+from typing import Dict, Iterable, Optional, Set
+
+from . import metrics
+from .models import ChatState
+from .storage import TGBOT_DATA_DIR, list_data_dir_chat_ids, load_chat_data_file, _write_atomically
+
+
+def build_chat_state_filename(chat_id: str or int) -> str:
+    return os.path.join(TGBOT_DATA_DIR, f'chat-state_{chat_id}.bin')
+
+
+def load_chat_state(chat_id: int or str) -> Optional[ChatState]:
+    """Return chat state from its binary file, or None if there is no such file."""
+    filename = build_chat_state_filename(chat_id=chat_id)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as fp:
+        content = fp.read()
+    metrics.storage_bytes.inc(len(content), operation='read')
+    return ChatState.decode(content)
+
+
+class BinaryStorage:
+    """
+    Storage backend that keeps one binary chat state file per chat in data directory.
+
+    A chat that has only a JSON file written by JSON backend is loaded from it,
+    and is converted into binary file on the first write.
+    """
+
+    def __init__(self):
+        self._digests: Dict[int or str, bytes] = {}
+
+    def load(self, chat_id: int or str) -> dict:
+        state = load_chat_state(chat_id=chat_id)
+        if state is not None:
+            return state.to_chat_data()
+        return load_chat_data_file(chat_id=chat_id)
+
+    def iter_chat_ids(self) -> Iterable[int]:
+        return list_data_dir_chat_ids(r'chat-state_(-?\d+)\.bin') | list_data_dir_chat_ids(r'chat-data_(-?\d+)\.json')
+
+    def write(self, chat_id: int or str, chat_data: dict, changed_usernames: Optional[Set[str]]) -> bool:
+        """
+        Write chat data unless it is identical to the last written one. Return True if file was written.
+        Whole file is rewritten, so changed usernames are ignored.
+        """
+        content = ChatState.from_chat_data(chat_data).encode()
+        digest = hashlib.sha1(content).digest()
+        if self._digests.get(chat_id) == digest:
+            return False
+        _write_atomically(build_chat_state_filename(chat_id=chat_id), content)
+        metrics.storage_bytes.inc(len(content), operation='write')
+        self._digests[chat_id] = digest
+        return True
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,140 @@
+import collections
+import logging
+import threading
+from typing import Callable, Dict, Hashable, Iterator, List, MutableMapping
+
+from . import concurrency
+from . import settings
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+CHAT_DATA_SIZE = 1024
+""" Approximate memory taken by chat data without members, in bytes. """
+
+MEMBER_SIZE = 400
+""" Approximate memory taken by one remembered member, in bytes. """
+
+
+def estimate_chat_data_size(chat_data: dict) -> int:
+    return CHAT_DATA_SIZE + MEMBER_SIZE * len(chat_data.get(storage.MEMBERS_BY_USERNAME, ()))
+
+
+class ChatDataCache(MutableMapping):
+    """
+    Chat data of recently active chats, used in place of dispatcher's `chat_data` defaultdict.
+
+    Like defaultdict, it returns a new empty dict for a chat that is not cached, and handlers
+    restore it from storage. When there are more than `max_chats` chats or their approximate size
+    exceeds `max_bytes`, least recently used chats are evicted after their pending data is flushed.
+    Chats for which `is_busy` returns True (e.g. with queued updates) are never evicted.
+    Zero limit means no limit.
+    """
+
+    def __init__(self, max_chats: int, max_bytes: int, is_busy: Callable[[Hashable], bool],
+                 on_evict: Callable[[Hashable], None]):
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.is_busy = is_busy
+        self.on_evict = on_evict
+        self._data: 'collections.OrderedDict[Hashable, dict]' = collections.OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._total_size = 0
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, chat_id: Hashable) -> dict:
+        with self._lock:
+            chat_data = self._data.get(chat_id)
+            if chat_data is None:
+                self._counters['misses'] += 1
+                chat_data = self._data[chat_id] = {}
+            else:
+                self._counters['hits'] += 1
+                self._data.move_to_end(chat_id)
+            # size is re-estimated on access, changes made by handlers are accounted on the next update
+            self._resize(chat_id, estimate_chat_data_size(chat_data))
+            evicted = self._take_evicted(keep=chat_id)
+        self._flush_evicted(evicted)
+        return chat_data
+
+    def __setitem__(self, chat_id: Hashable, chat_data: dict) -> None:
+        with self._lock:
+            self._data[chat_id] = chat_data
+            self._data.move_to_end(chat_id)
+            self._resize(chat_id, estimate_chat_data_size(chat_data))
+            evicted = self._take_evicted(keep=chat_id)
+        self._flush_evicted(evicted)
+
+    def __delitem__(self, chat_id: Hashable) -> None:
+        with self._lock:
+            del self._data[chat_id]
+            self._total_size -= self._sizes.pop(chat_id)
+
+    def __contains__(self, chat_id: object) -> bool:
+        with self._lock:
+            return chat_id in self._data
+
+    def get(self, chat_id: Hashable, default: dict = None) -> dict:
+        """Return cached chat data or default, without creating an entry."""
+        with self._lock:
+            return self._data.get(chat_id, default)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _resize(self, chat_id: Hashable, size: int) -> None:
+        self._total_size += size - self._sizes.get(chat_id, 0)
+        self._sizes[chat_id] = size
+
+    def _is_full(self, chats: int, size: int) -> bool:
+        return (self.max_chats and chats > self.max_chats) or (self.max_bytes and size > self.max_bytes)
+
+    def _take_evicted(self, keep: Hashable) -> List[Hashable]:
+        """Remove least recently used chats until cache fits its limits, and return their IDs."""
+        chats, size = len(self._data), self._total_size
+        if not self._is_full(chats, size):
+            return []
+        evicted = []
+        for chat_id in self._data:
+            if not self._is_full(chats, size):
+                break
+            if chat_id == keep or self.is_busy(chat_id):
+                continue
+            evicted.append(chat_id)
+            chats -= 1
+            size -= self._sizes[chat_id]
+        for chat_id in evicted:
+            del self._data[chat_id]
+            self._total_size -= self._sizes.pop(chat_id)
+        self._counters['evictions'] += len(evicted)
+        return evicted
+
+    def _flush_evicted(self, evicted: List[Hashable]) -> None:
+        for chat_id in evicted:
+            try:
+                self.on_evict(chat_id)
+            except Exception:
+                logger.exception(f'Could not flush evicted chat {chat_id}.')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'chats': len(self._data),
+                'bytes': self._total_size,
+                'hits': self._counters['hits'],
+                'misses': self._counters['misses'],
+                'evictions': self._counters['evictions'],
+            }
+
+
+chat_data_cache = ChatDataCache(
+    max_chats=settings.TGBOT_CHAT_CACHE_SIZE,
+    max_bytes=settings.TGBOT_CHAT_CACHE_BYTES,
+    is_busy=lambda chat_id: concurrency.chat_executor.queue_depth(chat_id) > 0,
+    on_evict=storage.flush_chat_data,
+)
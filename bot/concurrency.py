@@ -0,0 +1,100 @@
+import collections
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ChatExecutor:
+    """
+    Run tasks on a thread pool, one at a time per key and in the order they were submitted.
+
+    Tasks with different keys run in parallel. Each pool task runs a single queued task of a key
+    and then resubmits the key, so a busy key can not occupy a worker while other keys are waiting.
+    """
+
+    def __init__(self, workers: int):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-worker')
+        self._queues: Dict[Hashable, Deque[Tuple[Callable, tuple]]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> None:
+        with self._lock:
+            tasks = self._queues.get(key)
+            if tasks is not None:
+                # worker is already scheduled for this key and will pick the task up
+                tasks.append((fn, args))
+                return
+            self._queues[key] = collections.deque([(fn, args)])
+        self._pool.submit(self._run_next, key)
+
+    def call(self, key: Hashable, fn: Callable, *args) -> Future:
+        """Submit task like `submit` does, and return a future of its result."""
+        future = Future()
+
+        def run() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args))
+            except BaseException as error:
+                future.set_exception(error)
+
+        self.submit(key, run)
+        return future
+
+    def _run_next(self, key: Hashable) -> None:
+        while True:
+            with self._lock:
+                fn, args = self._queues[key][0]
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception(f'Task of {key} failed.')
+            with self._lock:
+                tasks = self._queues[key]
+                tasks.popleft()
+                if not tasks:
+                    del self._queues[key]
+                    return
+            try:
+                self._pool.submit(self._run_next, key)
+                return
+            except RuntimeError:
+                # pool is shutting down, finish tasks of this key in current worker
+                continue
+
+    def queue_depth(self, key: Hashable) -> int:
+        """Return number of tasks of the key which are queued or running."""
+        with self._lock:
+            return len(self._queues.get(key, ()))
+
+    def queue_depths(self) -> Dict[Hashable, int]:
+        with self._lock:
+            return {key: len(tasks) for key, tasks in self._queues.items()}
+
+    def shutdown(self) -> None:
+        """Wait for all submitted tasks to finish."""
+        self._pool.shutdown(wait=True)
+
+
+chat_executor = ChatExecutor(workers=settings.TGBOT_WORKERS)
+
+
+def run_serialized_per_chat(callback: Callable[[Update, CallbackContext], None]) -> Callable:
+    """Wrap handler callback to run it on chat executor instead of the dispatcher thread."""
+
+    @functools.wraps(callback)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        chat_executor.submit(chat_id, callback, update, context)
+
+    return wrapper
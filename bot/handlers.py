@@ -1,12 +1,30 @@
+import bisect
 import datetime
+import html
 import logging
-
-from telegram import Update, User
-from telegram.ext import CallbackContext
-
+import tempfile
+from typing import Callable, Collection, List, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardMarkup, InputFile, ParseMode, Update, User
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, Dispatcher
+
+from . import chat_cache
+from . import concurrency
+from . import membership
+from . import metrics
+from . import models
+from . import outbound
+from . import pagination
+from . import profiling
+from . import reports
+from . import roster_io
+from .reconcile import CheckResult, MemberCheck, reconciler
 from . import settings
 from . import storage
-from .utils import extract_usernames_from_args, iter_pack
+from .roster_cache import roster_cache
+from .user_index import user_index
+from .utils import extract_usernames_from_args, extract_usernames_from_messages, html_text_length, iter_mention_messages
 
 # Enable logging
 logging.basicConfig(
@@ -42,40 +60,62 @@ Available commands:
 /disable - (admin only) tell me to stop tracking users (it's enabled by default)
 /enable - (admin only) tell me to start tracking users
 /mention_all - (admin only) mention all users from memory
+/whois - (admin only) show tracked chats where mentioned users are remembered
+/reconcile - (admin only) check remembered users with Telegram and forget those who left
+/profile - (admin only) profile the bot for a while and send the top of the profile
+/schedule - (admin only) in reply to a roster, report missing roster members daily at given UTC time
+/import - (admin only) in reply to a CSV or text file, remember all users listed in it
+/export - (admin only) send all chat members in my memory as a CSV file
 
 Note: Admin only commands can be executed only by pre-defined admins.
 '''
 
 
 class CHAT_DATA:
-    BEGAN_AT = 'began_at'
-    MEMBERS_BY_USERNAME = 'members_by_username'
-    ENABLED = 'enabled'
-    TITLE = 'title'
-    TGID = 'tgid'
+    BEGAN_AT = models.BEGAN_AT
+    MEMBERS_BY_USERNAME = storage.MEMBERS_BY_USERNAME
+    ENABLED = models.ENABLED
+    TITLE = models.TITLE
+    TGID = models.TGID
+    RECONCILE = 'reconcile'
+    """ Progress of /reconcile: last checked username, counts of check results and samples of changes. """
+    REPORT = models.REPORT
+
+
+RECONCILE_REPORT_LIMIT = 50
+""" Number of forgotten and renamed members listed in /reconcile report, others are only counted. """
+
+
+def _load_chat_data(chat_id: int, chat_data: dict) -> bool:
+    """Fill empty chat data from storage. Return False if data is not present nor in memory nor in storage."""
+    if not chat_data:
+        from_file = storage.restore_chat_data(chat_id=chat_id)
+        if CHAT_DATA.BEGAN_AT not in from_file:
+            return False
+        chat_data.update(from_file)
+    # index members of the chat by user ID before handler changes them
+    user_index.index_chat(chat_id=chat_id, chat_data=chat_data)
+    return True
 
 
 def _restore_chat_data(update: Update, context: CallbackContext, create: bool = False) -> bool:
     """Return False if data is not present nor in memory nor in storage."""
-    if not context.chat_data:
-        from_file = storage.restore_chat_data(chat_id=update.effective_chat.id)
-        if CHAT_DATA.BEGAN_AT in from_file:
-            context.chat_data.update(from_file)
-        elif create:
-            context.chat_data.update({
-                CHAT_DATA.MEMBERS_BY_USERNAME: {},
-                CHAT_DATA.BEGAN_AT: datetime.datetime.utcnow().isoformat(),
-                CHAT_DATA.ENABLED: False,
-                CHAT_DATA.TITLE: update.effective_chat.title,
-                CHAT_DATA.TGID: update.effective_chat.id,
-            })
-        else:
-            return False
+    if _load_chat_data(chat_id=update.effective_chat.id, chat_data=context.chat_data):
+        return True
+    if not create:
+        return False
+    context.chat_data.update({
+        CHAT_DATA.MEMBERS_BY_USERNAME: {},
+        CHAT_DATA.BEGAN_AT: datetime.datetime.utcnow().isoformat(),
+        CHAT_DATA.ENABLED: False,
+        CHAT_DATA.TITLE: update.effective_chat.title,
+        CHAT_DATA.TGID: update.effective_chat.id,
+    })
     return True
 
 
 def _save_chat_data(update: Update, context: CallbackContext) -> None:
-    storage.save_chat_data(chat_id=update.effective_chat.id, chat_data=context.chat_data)
+    storage.schedule_save_chat_data(chat_id=update.effective_chat.id, chat_data=context.chat_data)
 
 
 def _enable_tracking(update: Update, context: CallbackContext) -> None:
@@ -86,11 +126,40 @@ def _disable_tracking(update: Update, context: CallbackContext) -> None:
     context.chat_data[CHAT_DATA.ENABLED] = False
 
 
-def _remember_chat_member(username: str, user_data: dict, context: CallbackContext) -> None:
-    context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME][username] = user_data
+def _remember_chat_member(username: str, user_data: dict, context: CallbackContext) -> bool:
+    """
+    Store chat member data in chat data.
+    Return True if chat data was changed, otherwise return False (if the same data was already stored).
+    """
+    members = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME]
+    if username in members and members[username] == user_data:
+        return False
+    chat_id = context.chat_data[CHAT_DATA.TGID]
+    user_id = user_data.get(models.MEMBER_ID)
+    if user_id is not None:
+        # user was remembered with another username before renaming
+        old_username = user_index.username_in_chat(user_id=user_id, chat_id=chat_id)
+        if old_username is not None and old_username != username:
+            _forget_chat_member(username=old_username, context=context)
+    if username in members:
+        _unindex_chat_member(chat_id=chat_id, username=username, user_data=members[username])
+    members[username] = user_data
+    storage.note_member_change(chat_id=chat_id, username=username)
+    if user_id is not None:
+        user_index.add(chat_id=chat_id, username=username, user_id=user_id)
+    return True
+
 
+def _unindex_chat_member(chat_id: int, username: str, user_data: dict) -> None:
+    user_id = user_data.get(models.MEMBER_ID)
+    if user_id is not None and user_index.username_in_chat(user_id=user_id, chat_id=chat_id) == username:
+        user_index.discard(chat_id=chat_id, user_id=user_id)
 
-def _remember_user(user: User, context: CallbackContext) -> None:
+
+def _remember_user(user: User, context: CallbackContext) -> bool:
+    if not user.username:
+        # users without username can not be mentioned
+        return False
     return _remember_chat_member(
         username=user.username,
         user_data={
@@ -103,11 +172,10 @@ def _remember_user(user: User, context: CallbackContext) -> None:
 def _remember_caller(update: Update, context: CallbackContext) -> bool:
     """
     Remember command caller in chat data, and if it was not in chat data yet, return True.
-    Otherwise, return False.
+    Otherwise (or if the caller has no username to remember), return False.
     """
     if update.effective_user.username not in context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME]:
-        _remember_user(user=update.effective_user, context=context)
-        return True
+        return _remember_user(user=update.effective_user, context=context)
     else:
         return False
 
@@ -118,16 +186,367 @@ def _forget_chat_member(username: str, context: CallbackContext) -> bool:
     Return True if data was removed, otherwise return False (if username was not in chat data).
     """
     try:
-        context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].pop(username)
+        user_data = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].pop(username)
     except KeyError:
         return False
     else:
+        chat_id = context.chat_data[CHAT_DATA.TGID]
+        storage.note_member_change(chat_id=chat_id, username=username)
+        _unindex_chat_member(chat_id=chat_id, username=username, user_data=user_data)
         return True
 
 
+def _forget_user(user: User, context: CallbackContext) -> bool:
+    """
+    Forget chat member by user ID as well as by username,
+    so users who renamed themselves or removed their username are forgotten too.
+    """
+    changed = False
+    username = user_index.username_in_chat(user_id=user.id, chat_id=context.chat_data[CHAT_DATA.TGID])
+    if username is not None:
+        changed |= _forget_chat_member(username=username, context=context)
+    if user.username:
+        changed |= _forget_chat_member(username=user.username, context=context)
+    return changed
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    """Format histogram bucket bound, which is None if nothing was observed."""
+    if seconds is None:
+        return '-'
+    return f'<{seconds * 1000:g}ms' if seconds != float('inf') else '>10s'
+
+
 def command_help(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
-    update.message.reply_text(HELP)
+    outbound.sender.enqueue_reply(update.effective_message, HELP)
+
+
+PROFILE_USAGE = (
+    'Usage:\n'
+    '/profile sample [seconds] - sample stacks of all threads\n'
+    '/profile updates <fraction> [seconds] - run a fraction (0-1] of updates under cProfile\n'
+    '/profile stop - finish running session now'
+)
+
+
+def _send_profile(bot, chat_id: int, result: tuple) -> None:
+    path, summary = result
+    text = f'Profile is written to <code>{html.escape(path)}</code>\n<pre>{{}}</pre>'
+    room = settings.TGBOT_MAX_MESSAGE_LENGTH - len(text) - 16
+    # summary lines are cut at the end, and long lines are cut too, so that the message fits
+    lines = []
+    for line in summary.splitlines():
+        line = html.escape(line[:200])
+        if len(line) + 1 > room:
+            break
+        lines.append(line)
+        room -= len(line) + 1
+    outbound.sender.enqueue(chat_id=chat_id, send=bot.send_message, kwargs={
+        'chat_id': chat_id,
+        'text': text.format('\n'.join(lines)),
+        'parse_mode': ParseMode.HTML,
+    })
+
+
+def _finish_profiling(context: CallbackContext) -> None:
+    """Job callback which stops profiling session when its time is over."""
+    chat_id, session = context.job.context
+    result = profiling.profiler.stop(top=settings.TGBOT_PROFILE_TOP, session=session)
+    if result is not None:
+        _send_profile(context.bot, chat_id, result)
+
+
+def command_profile(update: Update, context: CallbackContext) -> None:
+    """Start or stop a profiling session, its summary is sent to the chat when it is finished."""
+    args = context.args or []
+    if args[:1] == ['stop']:
+        result = profiling.profiler.stop(top=settings.TGBOT_PROFILE_TOP)
+        if result is None:
+            outbound.sender.enqueue_reply(update.effective_message, 'No profiling session is running.')
+        else:
+            _send_profile(context.bot, update.effective_chat.id, result)
+        return
+
+    try:
+        if args[:1] == ['sample'] and len(args) <= 2:
+            mode, fraction = profiling.SAMPLING, 1.0
+            seconds = float(args[1]) if len(args) > 1 else settings.TGBOT_PROFILE_SECONDS
+        elif args[:1] == ['updates'] and 2 <= len(args) <= 3:
+            mode, fraction = profiling.UPDATES, float(args[1])
+            seconds = float(args[2]) if len(args) > 2 else settings.TGBOT_PROFILE_SECONDS
+        else:
+            raise ValueError(args)
+        if not 0 < fraction <= 1 or not 0 < seconds:
+            raise ValueError(args)
+    except ValueError:
+        outbound.sender.enqueue_reply(update.effective_message, PROFILE_USAGE)
+        return
+
+    session = profiling.profiler.start(
+        mode=mode, seconds=seconds, fraction=fraction, sample_interval=settings.TGBOT_PROFILE_SAMPLE_INTERVAL)
+    if session is None:
+        running = profiling.profiler.session
+        outbound.sender.enqueue_reply(
+            update.effective_message,
+            f'Profiling ({running.mode}) is already running since {running.started_at:%H:%M:%S}, '
+            f'stop it with /profile stop.')
+        return
+    context.job_queue.run_once(_finish_profiling, when=seconds, context=(update.effective_chat.id, session))
+    outbound.sender.enqueue_reply(update.effective_message, f'Profiling ({mode}) started for {seconds:g} seconds.')
+
+
+def _take_reconcile_chunk(update: Update, dispatcher: Dispatcher, usernames: List[str],
+                          size: int) -> List[Tuple[str, Optional[int]]]:
+    """
+    Return next remembered members after reconcile cursor, with user IDs found in user index if unknown.
+    `usernames` is the sorted snapshot of members taken when the session started, so a chunk is found
+    without scanning all members; members remembered later are checked by the next session.
+    """
+    context = CallbackContext.from_update(update, dispatcher)
+    if not _restore_chat_data(update=update, context=context):
+        return []
+    progress = context.chat_data.get(CHAT_DATA.RECONCILE)
+    if progress is None:
+        return []
+    cursor = progress['cursor']
+    members = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME]
+    index = 0 if cursor is None else bisect.bisect_right(usernames, cursor)
+    chunk = []
+    while index < len(usernames) and len(chunk) < size:
+        username = usernames[index]
+        index += 1
+        # members forgotten since the session started are skipped
+        if username in members:
+            chunk.append((username, members[username].get(models.MEMBER_ID) or user_index.user_id_of(username)))
+    return chunk
+
+
+def _apply_reconcile_checks(update: Update, dispatcher: Dispatcher, checks: List[MemberCheck]) -> None:
+    """Forget members who left, update renamed ones, and move reconcile cursor past the checked members."""
+    context = CallbackContext.from_update(update, dispatcher)
+    if not _restore_chat_data(update=update, context=context):
+        return
+    progress = context.chat_data.get(CHAT_DATA.RECONCILE)
+    if progress is None:
+        return
+    members = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME]
+    counts = progress['counts']
+    for check in checks:
+        counts[check.result.value] = counts.get(check.result.value, 0) + 1
+        user_data = members.get(check.username)
+        # skip members which were forgotten or remembered again while they were checked
+        if user_data is None or user_data.get(models.MEMBER_ID) not in (None, check.user_id):
+            continue
+        if check.result == CheckResult.PRESENT and user_data.get(models.MEMBER_ID) is None:
+            _remember_chat_member(username=check.username, user_data={models.MEMBER_ID: check.user_id},
+                                  context=context)
+        elif check.result == CheckResult.LEFT:
+            _forget_chat_member(username=check.username, context=context)
+            if len(progress['left']) < RECONCILE_REPORT_LIMIT:
+                progress['left'].append(check.username)
+        elif check.result == CheckResult.RENAMED:
+            _forget_chat_member(username=check.username, context=context)
+            if check.new_username:
+                _remember_chat_member(username=check.new_username, user_data={models.MEMBER_ID: check.user_id},
+                                      context=context)
+            if len(progress['renamed']) < RECONCILE_REPORT_LIMIT:
+                progress['renamed'].append([check.username, check.new_username])
+    progress['cursor'] = max(check.username for check in checks)
+    _save_chat_data(update=update, context=context)
+
+
+def _format_reconcile_progress(progress: dict) -> str:
+    counts = progress['counts']
+    lines = [
+        f'Checked <code>{sum(counts.values())}</code> remembered members: '
+        f'<code>{counts.get(CheckResult.PRESENT.value, 0)}</code> present, '
+        f'<code>{counts.get(CheckResult.LEFT.value, 0)}</code> left, '
+        f'<code>{counts.get(CheckResult.RENAMED.value, 0)}</code> renamed, '
+        f'<code>{counts.get(CheckResult.UNVERIFIABLE.value, 0)}</code> without known user ID, '
+        f'<code>{counts.get(CheckResult.ERROR.value, 0)}</code> could not be checked.',
+    ]
+    # usernames are not mentioned, so users are not notified by the report
+    if progress['left']:
+        lines.append('Forgotten: ' + ', '.join(f'<code>{html.escape(un)}</code>' for un in progress['left']))
+    if progress['renamed']:
+        lines.append('Renamed: ' + ', '.join(
+            f'<code>{html.escape(old)}</code> → ' + (f'<code>{html.escape(new)}</code>' if new else 'no username')
+            for old, new in progress['renamed']))
+    return '\n'.join(lines)
+
+
+def _finish_reconcile(update: Update, dispatcher: Dispatcher, completed: bool) -> None:
+    """Report reconcile results, and drop its progress if all members were checked."""
+    context = CallbackContext.from_update(update, dispatcher)
+    if not _restore_chat_data(update=update, context=context):
+        return
+    progress = context.chat_data.get(CHAT_DATA.RECONCILE)
+    if progress is None:
+        return
+    if completed:
+        del context.chat_data[CHAT_DATA.RECONCILE]
+        _save_chat_data(update=update, context=context)
+        header = 'Reconcile finished.'
+    else:
+        header = 'Reconcile stopped, call /reconcile to continue it.'
+    outbound.sender.enqueue_reply(
+        update.effective_message, f'{header}\n{_format_reconcile_progress(progress)}', parse_mode=ParseMode.HTML)
+
+
+def command_reconcile(update: Update, context: CallbackContext) -> None:
+    """Check remembered members with getChatMember in background, and forget those who left the chat."""
+    if not _restore_chat_data(update=update, context=context):
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
+        return
+
+    chat_id = update.effective_chat.id
+    if context.args[:1] == ['stop']:
+        if reconciler.stop(chat_id):
+            outbound.sender.enqueue_reply(
+                update.effective_message, 'Reconcile will stop after the members being checked now.')
+        else:
+            outbound.sender.enqueue_reply(update.effective_message, 'Reconcile is not running in this chat.')
+        return
+    progress = context.chat_data.get(CHAT_DATA.RECONCILE)
+    if reconciler.is_running(chat_id):
+        outbound.sender.enqueue_reply(
+            update.effective_message, f'Reconcile is running.\n{_format_reconcile_progress(progress)}',
+            parse_mode=ParseMode.HTML)
+        return
+
+    if progress is None or context.args[:1] == ['restart']:
+        progress = context.chat_data[CHAT_DATA.RECONCILE] = {
+            'cursor': None,
+            'counts': {},
+            'left': [],
+            'renamed': [],
+        }
+        _save_chat_data(update=update, context=context)
+        reply_text = 'Reconcile started'
+    else:
+        reply_text = f'Reconcile continues after {progress["cursor"]}'
+    usernames = sorted(context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME])
+    reconciler.start(
+        bot=context.bot,
+        chat_id=chat_id,
+        take_chunk=lambda size: _take_reconcile_chunk(update, context.dispatcher, usernames, size),
+        apply_checks=lambda checks: _apply_reconcile_checks(update, context.dispatcher, checks),
+        finish=lambda completed: _finish_reconcile(update, context.dispatcher, completed),
+    )
+    outbound.sender.enqueue_reply(update.effective_message, f'{reply_text}, {len(usernames)} members are remembered.')
+
+
+SCHEDULE_USAGE = (
+    'Usage:\n'
+    '/schedule HH:MM - in reply to a roster message (or with mentioned users), '
+    'mention missing roster members daily at given UTC time\n'
+    '/schedule off - stop daily reports\n'
+    '/schedule - show scheduled report'
+)
+
+
+def _format_next_report(chat_id: int) -> str:
+    run_at = reports.report_scheduler.next_run_of(chat_id)
+    return f', next one at {run_at.astimezone(datetime.timezone.utc):%Y-%m-%d %H:%M} UTC' if run_at else ''
+
+
+def command_schedule(update: Update, context: CallbackContext) -> None:
+    """Schedule, show or cancel daily report of roster members who are missing."""
+    if not _restore_chat_data(update=update, context=context):
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
+        return
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    report = context.chat_data.get(CHAT_DATA.REPORT)
+
+    if not args:
+        if report is None:
+            outbound.sender.enqueue_reply(update.effective_message, f'No report is scheduled.\n{SCHEDULE_USAGE}')
+        else:
+            outbound.sender.enqueue_reply(
+                update.effective_message,
+                f'Missing members of {len(report[models.REPORT_ROSTER])} in the roster are reported daily '
+                f'at {report[models.REPORT_TIME]} UTC{_format_next_report(chat_id)}.')
+        return
+
+    if args == ['off']:
+        reports.report_scheduler.cancel(chat_id)
+        if context.chat_data.pop(CHAT_DATA.REPORT, None) is None:
+            outbound.sender.enqueue_reply(update.effective_message, 'No report is scheduled.')
+            return
+        _save_chat_data(update=update, context=context)
+        outbound.sender.enqueue_reply(update.effective_message, 'Daily report is stopped.')
+        return
+
+    report_time = reports.parse_report_time(args[0])
+    # roster is parsed once here, every report only compares it with remembered members
+    roster = roster_cache.usernames(update.effective_message.reply_to_message).union(
+        extract_usernames_from_messages(update.effective_message))
+    if report_time is None or not roster:
+        outbound.sender.enqueue_reply(update.effective_message, SCHEDULE_USAGE)
+        return
+
+    context.chat_data[CHAT_DATA.REPORT] = {
+        models.REPORT_TIME: f'{report_time:%H:%M}',
+        models.REPORT_ROSTER: sorted(roster, key=str.lower),
+        models.REPORT_SENT_AT: None,
+    }
+    _save_chat_data(update=update, context=context)
+    reports.report_scheduler.schedule(chat_id=chat_id, report_time=report_time)
+    outbound.sender.enqueue_reply(
+        update.effective_message,
+        f'Missing members of {len(roster)} in the roster will be reported daily '
+        f'at {report_time:%H:%M} UTC{_format_next_report(chat_id)}.')
+
+
+def send_scheduled_report(dispatcher: Dispatcher, chat_id: int) -> None:
+    """Job callback of a due report, the report is made on chat executor between updates of the chat."""
+    concurrency.chat_executor.submit(chat_id, _send_report, dispatcher, chat_id)
+
+
+def _send_report(dispatcher: Dispatcher, chat_id: int) -> None:
+    chat_data = dispatcher.chat_data[chat_id]
+    if not _load_chat_data(chat_id=chat_id, chat_data=chat_data) or not chat_data.get(CHAT_DATA.REPORT):
+        reports.report_scheduler.cancel(chat_id)
+        return
+    if not chat_data[CHAT_DATA.ENABLED]:
+        return
+
+    report = chat_data[CHAT_DATA.REPORT]
+    roster = report[models.REPORT_ROSTER]
+    members = chat_data[CHAT_DATA.MEMBERS_BY_USERNAME]
+    missing_usernames = [username for username in roster if username not in members]
+
+    def send(text: str) -> None:
+        outbound.sender.enqueue(chat_id=chat_id, send=dispatcher.bot.send_message, kwargs={
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': ParseMode.HTML,
+        })
+
+    if missing_usernames:
+        report_messages = iter_mention_messages(
+            usernames=missing_usernames,
+            build_header=lambda mentions_count, message_number: (
+                f'Daily report: following <code>{mentions_count}</code> roster members '
+                f'(<code>{len(missing_usernames)}</code> of <code>{len(roster)}</code>) are missing: '
+                f'(message <code>{message_number}</code>)\n'
+            ),
+            footer=(
+                f'If <b>You</b> got mentioned by this message, '
+                f'please, click on /check_in command.'
+            ),
+            max_mentions=settings.TGBOT_MAX_MENTIONS_PER_MESSAGE,
+            max_length=settings.TGBOT_MAX_MESSAGE_LENGTH,
+        )
+        for text in report_messages:
+            send(text)
+    else:
+        send(f'Daily report: all <code>{len(roster)}</code> roster members are present!')
+
+    report[models.REPORT_SENT_AT] = datetime.datetime.utcnow().isoformat()
+    storage.schedule_save_chat_data(chat_id=chat_id, chat_data=chat_data)
 
 
 def command_debug(update: Update, context: CallbackContext) -> None:
@@ -137,6 +556,50 @@ def command_debug(update: Update, context: CallbackContext) -> None:
         f'Chat ID: `{chat.id}`\n'
         f'Chat type: `{chat.type}`\n'
         f'Chat title: `{chat.title}`\n'
+        f'Queued updates: `{concurrency.chat_executor.queue_depth(chat.id)}` in this chat, '
+        f'`{sum(concurrency.chat_executor.queue_depths().values())}` in total\n'
+    )
+    send_stats = outbound.sender.stats()
+    text += (
+        f'Outgoing messages: `{outbound.sender.queue_length(chat.id)}` queued in this chat, '
+        f'`{send_stats["queued"]}` in total, `{send_stats["sent"]}` sent, '
+        f'`{send_stats["failed"]}` failed, `{send_stats["retried"]}` retried\n'
+        f'Send latency: p50 `{send_stats["latency_p50"]:.2f}s`, p99 `{send_stats["latency_p99"]:.2f}s`\n'
+    )
+    metrics_summary = metrics.summary()
+    text += (
+        f'Updates: `{metrics_summary["updates"]}`, errors: `{metrics_summary["errors"]}`, '
+        f'handler time p50 `{_format_seconds(metrics_summary["handler_p50"])}`, '
+        f'p99 `{_format_seconds(metrics_summary["handler_p99"])}`\n'
+        f'Storage: `{metrics_summary["storage_written_bytes"] // 1024}` KiB written, '
+        f'write time p99 `{_format_seconds(metrics_summary["storage_write_p99"])}`\n'
+    )
+    text += (
+        f'Membership events: `{membership.membership_batcher.pending(chat.id)}` pending in this chat, '
+        f'`{membership.membership_batcher.events_applied}` applied in '
+        f'`{membership.membership_batcher.batches_applied}` batches\n'
+    )
+    roster_stats = roster_cache.stats()
+    text += (
+        f'Parsed rosters: `{roster_stats["rosters"]}`, `{roster_stats["hits"]}` hits, '
+        f'`{roster_stats["misses"]}` misses\n'
+    )
+    index_stats = user_index.stats()
+    text += (
+        f'Indexed users: `{index_stats["users"]}`, '
+        f'`{index_stats["pending_chats"]}` chats not indexed yet\n'
+    )
+    manifest = [entry for _, entry in storage.iter_chat_manifest()]
+    text += (
+        f'Stored chats: `{len(manifest)}`, `{sum(1 for entry in manifest if entry.enabled)}` enabled, '
+        f'`{sum(entry.members for entry in manifest)}` members remembered, '
+        f'`{reports.report_scheduler.scheduled()}` daily reports scheduled\n'
+    )
+    cache_stats = chat_cache.chat_data_cache.stats()
+    text += (
+        f'Chats in memory: `{cache_stats["chats"]}` (~`{cache_stats["bytes"] // 1024}` KiB), '
+        f'`{cache_stats["hits"]}` hits, `{cache_stats["misses"]}` misses, '
+        f'`{cache_stats["evictions"]}` evictions\n'
     )
     if chat.type in {chat.GROUP, chat.SUPERGROUP}:
         try:
@@ -149,13 +612,13 @@ def command_debug(update: Update, context: CallbackContext) -> None:
                 text += f'No data for this chat yet.'
         except Exception:
             text += f'Could not retrieve additional chat data.\n'
-    update.message.reply_markdown(text)
+    outbound.sender.enqueue_reply(update.effective_message, text, parse_mode=ParseMode.MARKDOWN)
 
 
 def command_start(update: Update, context: CallbackContext) -> None:
     """Remember mentioned users as if they are in chat."""
     if update.effective_user.username not in settings.TGBOT_ADMIN_USERNAMES:
-        update.effective_message.reply_text(f'Bot can be activated only by pre-defined admin.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Bot can be activated only by pre-defined admin.')
         return
 
     if not _restore_chat_data(update=update, context=context, create=True):
@@ -187,90 +650,87 @@ def command_start(update: Update, context: CallbackContext) -> None:
         'click on /forget_me command.\n'
     )
 
-    update.effective_message.reply_html(reply_html)
+    outbound.sender.enqueue_reply(update.effective_message, reply_html, parse_mode=ParseMode.HTML)
 
 
 def command_check(update: Update, context: CallbackContext) -> None:
     """Check presence of users listed in message, reply to which calls the command."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
-
-    _remember_caller(update=update, context=context)
-
-    _save_chat_data(update=update, context=context)
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    # potential usernames from reply-to message
-    if update.effective_message.reply_to_message:
-        reply_to_msg_text = update.effective_message.reply_to_message.text
-        reply_to_potential_mentions = reply_to_msg_text.replace('\n', ' ').split(' ')
-    else:
-        reply_to_potential_mentions = []
+    if _remember_caller(update=update, context=context):
+        _save_chat_data(update=update, context=context)
 
-    mentioned_usernames = set(extract_usernames_from_args(
-        arguments=context.args + reply_to_potential_mentions,
-        clean=True,
-    ))
-    present_usernames = set(context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].keys())
-    missing_usernames = mentioned_usernames.difference(present_usernames)
+    # usernames from command arguments and from reply-to message, which is parsed once for repeated checks
+    mentioned_usernames = roster_cache.usernames(update.effective_message.reply_to_message).union(
+        extract_usernames_from_messages(update.effective_message))
+    # members dict is the set of present usernames, lookups cost only as much as mentioned usernames
+    missing_usernames = mentioned_usernames.difference(context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME])
 
     if missing_usernames:
-        username_packs = list(iter_pack(missing_usernames, size=settings.TGBOT_MAX_MENTIONS_PER_MESSAGE))
-        for i, usernames_pack in enumerate(username_packs):
-            mentions = [f'@{un}' for un in usernames_pack]
-            reply_html = (
-                f'Following <code>{len(mentions)}</code> chat members '
+        reply_messages = iter_mention_messages(
+            usernames=missing_usernames,
+            build_header=lambda mentions_count, message_number: (
+                f'Following <code>{mentions_count}</code> chat members '
                 f'(<code>{len(missing_usernames)}</code> in total) are missing: '
-                f'(message <code>{i + 1}</code> of <code>{len(username_packs)}</code>)\n'
-            )
-            reply_html += ' '.join(mentions) + '\n'
-            reply_html += (
+                f'(message <code>{message_number}</code>)\n'
+            ),
+            footer=(
                 f'If <b>You</b> got mentioned by this message, '
                 f'please, click on /check_in command.'
-            )
-            update.effective_message.reply_html(reply_html)
+            ),
+            max_mentions=settings.TGBOT_MAX_MENTIONS_PER_MESSAGE,
+            max_length=settings.TGBOT_MAX_MESSAGE_LENGTH,
+        )
+        for reply_html in reply_messages:
+            outbound.sender.enqueue_reply(update.effective_message, reply_html, parse_mode=ParseMode.HTML)
     else:
         reply_text = f'All mentioned users are present!'
-        update.effective_message.reply_text(reply_text)
+        outbound.sender.enqueue_reply(update.effective_message, reply_text)
 
 
 def command_check_in(update: Update, context: CallbackContext) -> None:
     """Remember that user that called a command is a member of chat."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
     caller_is_new = _remember_caller(update=update, context=context)
 
-    _save_chat_data(update=update, context=context)
+    if caller_is_new:
+        _save_chat_data(update=update, context=context)
 
     if caller_is_new:
         reply_msg = f'Ok, now I will remember that you are in this chat.'
+    elif not update.effective_user.username:
+        reply_msg = f'Users without a username can not be mentioned, set one in Telegram settings first.'
     else:
         reply_msg = f'Don\'t worry, I remember that you are here :)'
-    update.effective_message.reply_text(reply_msg)
+    outbound.sender.enqueue_reply(update.effective_message, reply_msg)
 
 
 def command_forget_me(update: Update, context: CallbackContext) -> None:
     """Forget chat member who called this command."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
     caller_was_in_memory = _forget_chat_member(update.effective_user.username, context=context)
 
-    _save_chat_data(update=update, context=context)
+    if caller_was_in_memory:
+        _save_chat_data(update=update, context=context)
 
     if caller_was_in_memory:
         reply_msg = 'Ok, now I don\'t know who You are.'
     else:
         reply_msg = 'I already don\'t know who You are.'
-    update.effective_message.reply_text(reply_msg)
+    outbound.sender.enqueue_reply(update.effective_message, reply_msg)
 
 
 def command_forget(update: Update, context: CallbackContext) -> None:
     """Forget mentioned users."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    _remember_caller(update=update, context=context)
+    changed = _remember_caller(update=update, context=context)
 
     mentioned_usernames = set(extract_usernames_from_args(arguments=context.args, clean=True))
 
@@ -286,7 +746,8 @@ def command_forget(update: Update, context: CallbackContext) -> None:
         else:
             mismatched_usernames.add(username)
 
-    _save_chat_data(update=update, context=context)
+    if changed or forgot_usernames:
+        _save_chat_data(update=update, context=context)
 
     reply_msg = ''
     if forgot_usernames:
@@ -297,7 +758,8 @@ def command_forget(update: Update, context: CallbackContext) -> None:
         reply_msg += 'Not going to forget You that simple. Use /forget_me command for this.'
     if not reply_msg:
         reply_msg += 'Can not recognise any valid username.'
-    update.effective_message.reply_text(
+    outbound.sender.enqueue_reply(
+        update.effective_message,
         reply_msg,
     )
 
@@ -305,9 +767,9 @@ def command_forget(update: Update, context: CallbackContext) -> None:
 def command_remember(update: Update, context: CallbackContext) -> None:
     """Remember mentioned users as if they are in chat."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    _remember_caller(update=update, context=context)
+    changed = _remember_caller(update=update, context=context)
 
     mentioned_usernames = set(extract_usernames_from_args(arguments=context.args, clean=True))
 
@@ -315,94 +777,289 @@ def command_remember(update: Update, context: CallbackContext) -> None:
         for username in mentioned_usernames:
             if username in context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].keys():
                 continue
-            _remember_chat_member(username=username, user_data={}, context=context)
+            changed |= _remember_chat_member(username=username, user_data={}, context=context)
         reply_msg = f'Successfully remembered following chat members: ' + ' '.join(mentioned_usernames)
     else:
         reply_msg = f'No users mentioned - done nothing.'
 
-    _save_chat_data(update=update, context=context)
+    if changed:
+        _save_chat_data(update=update, context=context)
+
+    outbound.sender.enqueue_reply(update.effective_message, reply_msg)
+
 
-    update.effective_message.reply_text(reply_msg)
+def command_import(update: Update, context: CallbackContext) -> None:
+    """Remember users listed in a CSV or text file, reply to which calls the command."""
+    if not _restore_chat_data(update=update, context=context):
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
+        return
+
+    reply_to = update.effective_message.reply_to_message
+    document = reply_to.document if reply_to is not None else None
+    if document is None:
+        outbound.sender.enqueue_reply(
+            update.effective_message, 'Reply with /import to a CSV or text file with usernames.')
+        return
+    if document.file_size and document.file_size > settings.TGBOT_IMPORT_MAX_BYTES:
+        outbound.sender.enqueue_reply(
+            update.effective_message,
+            f'The file is too large, at most {settings.TGBOT_IMPORT_MAX_BYTES // 1024} KiB can be imported.')
+        return
+
+    members = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME]
+    imported = listed = 0
+    with tempfile.TemporaryFile() as fp:
+        try:
+            context.bot.get_file(document.file_id).download(out=fp)
+        except TelegramError as error:
+            outbound.sender.enqueue_reply(update.effective_message, f'Could not download the file: {error.message}')
+            return
+        fp.seek(0)
+        # the file is parsed row by row and members are added as they are read
+        for username, user_id in roster_io.iter_roster_file(fp):
+            listed += 1
+            member_data = roster_io.imported_member_data(stored=members.get(username), user_id=user_id)
+            if member_data is not None:
+                imported += _remember_chat_member(username=username, user_data=member_data, context=context)
+
+    # all imported members are written at once
+    if imported:
+        _save_chat_data(update=update, context=context)
+    outbound.sender.enqueue_reply(
+        update.effective_message,
+        f'Remembered {imported} new or changed members of {listed} listed in the file, '
+        f'{len(members)} members are remembered.')
+
+
+def command_export(update: Update, context: CallbackContext) -> None:
+    """Send remembered members of the chat as a CSV file, which /import accepts."""
+    if not _restore_chat_data(update=update, context=context):
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
+        return
+
+    chat_id = update.effective_chat.id
+    with tempfile.TemporaryFile() as fp:
+        exported = roster_io.write_roster_csv(members=context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME], fp=fp)
+        fp.seek(0)
+        # the file is read here, it is closed before the queued document is sent
+        document = InputFile(fp, filename=f'members_{chat_id}.csv')
+    outbound.sender.enqueue(chat_id=chat_id, send=update.effective_message.reply_document, kwargs={
+        'document': document,
+        'caption': f'{exported} members are remembered.',
+    })
 
 
 def command_list(update: Update, context: CallbackContext) -> None:
     """Remember mentioned users as if they are in chat."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    _remember_caller(update=update, context=context)
+    if _remember_caller(update=update, context=context):
+        _save_chat_data(update=update, context=context)
 
-    _save_chat_data(update=update, context=context)
+    snapshot = _add_snapshot(
+        chat_id=update.effective_chat.id,
+        usernames=context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].keys(),
+        render_text=_render_list_text,
+        page_size=settings.TGBOT_LIST_PAGE_SIZE,
+    )
+    reply_msg, reply_markup = _render_list_page(snapshot=snapshot, page=0)
+    outbound.sender.enqueue_reply(update.effective_message, reply_msg, reply_markup=reply_markup)
+
+
+def _add_snapshot(chat_id: int, usernames: Collection[str], render_text: Callable[..., str],
+                  page_size: int) -> pagination.Snapshot:
+    """Snapshot roster split into pages of at most page size usernames which fit into the message length limit."""
+    total = len(usernames)
+    # text of a page of empty usernames with the longest numbers is what takes room besides usernames on any page
+    empty_page = render_text(usernames=[''] * page_size, total=total, page=total, pages=total)
+    return pagination.roster_snapshots.add(
+        chat_id=chat_id,
+        usernames=usernames,
+        page_size=page_size,
+        max_page_length=settings.TGBOT_MAX_MESSAGE_LENGTH - html_text_length(empty_page),
+    )
+
+
+def _render_list_text(usernames: Sequence[str], total: int, page: int, pages: int) -> str:
+    return (
+        f'Listing chat members in my memory (page {page + 1} of {pages}, {total} in total):\n* '
+        + '\n* '.join(usernames)
+    )
+
+
+def _render_list_page(snapshot: pagination.Snapshot, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    if not snapshot.usernames:
+        return 'There are no chat members in my memory yet.', None
+    pages = pagination.count_pages(snapshot)
+    page = min(page, pages - 1)
+    usernames = pagination.get_page(snapshot, page=page)
+    text = _render_list_text(usernames=usernames, total=len(snapshot.usernames), page=page, pages=pages)
+    return text, pagination.build_list_keyboard(snapshot, page=page, pages=pages)
 
-    all_usernames = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].keys()
-    reply_msg = f'Listing all chat members in my memory:\n* ' + '\n* '.join(all_usernames)
-    update.effective_message.reply_text(reply_msg)
+
+def command_whois(update: Update, context: CallbackContext) -> None:
+    """Show tracked chats where mentioned users (or users with given IDs) are remembered."""
+    if not context.args:
+        outbound.sender.enqueue_reply(update.effective_message, 'Usage: /whois @username or /whois <user ID>')
+        return
+
+    lines = []
+    for arg in context.args:
+        if arg.isdigit():
+            user_id = int(arg)
+        else:
+            usernames = extract_usernames_from_args(arguments=[arg], clean=True)
+            if not usernames:
+                continue
+            user_id = user_index.user_id_of(usernames[0])
+            if user_id is None:
+                lines.append(f'{arg}: unknown user')
+                continue
+        chats = user_index.chats_of(user_id)
+        lines.append(f'{arg} (ID {user_id}) is remembered in {len(chats)} chats:')
+        for chat_id, username in sorted(chats.items()):
+            entry = storage.get_chat_manifest(chat_id=chat_id)
+            title = (entry and entry.title) or chat_id
+            lines.append(f'* {title} (ID {chat_id}) as @{username}')
+    outbound.sender.enqueue_reply(update.effective_message, '\n'.join(lines) or 'No usernames or user IDs given.')
 
 
 def command_mention_all(update: Update, context: CallbackContext) -> None:
     """Mention all users from memory."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    _remember_caller(update=update, context=context)
+    if _remember_caller(update=update, context=context):
+        _save_chat_data(update=update, context=context)
 
-    _save_chat_data(update=update, context=context)
+    # only the first message is sent now, next ones are sent when an admin clicks the button under the previous one
+    snapshot = _add_snapshot(
+        chat_id=update.effective_chat.id,
+        usernames=context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].keys(),
+        render_text=_render_mention_text,
+        page_size=settings.TGBOT_MAX_MENTIONS_PER_MESSAGE,
+    )
+    if not snapshot.usernames:
+        outbound.sender.enqueue_reply(update.effective_message, 'There are no chat members in my memory yet.')
+        return
+    pagination.roster_snapshots.claim_page(snapshot, page=0)
+    reply_html, reply_markup = _render_mention_page(snapshot=snapshot, page=0)
+    outbound.sender.enqueue_reply(
+        update.effective_message, reply_html, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+def _render_mention_text(usernames: Sequence[str], total: int, page: int, pages: int) -> str:
+    return (
+        f'Mentioning <code>{len(usernames)}</code> chat members '
+        f'(<code>{total}</code> in total): '
+        f'(message <code>{page + 1}</code> of <code>{pages}</code>)\n'
+        + ' '.join(f'@{username}' for username in usernames) + '\n'
+        + f'If <b>You</b> want to get mentioned by messages like this one, '
+          f'please, click on /check_in command.'
+    )
 
-    all_usernames = context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME].keys()
-    username_packs = list(iter_pack(all_usernames, size=settings.TGBOT_MAX_MENTIONS_PER_MESSAGE))
-    for i, usernames_pack in enumerate(username_packs):
-        mentions = [f'@{un}' for un in usernames_pack]
-        reply_html = (
-            f'Mentioning <code>{len(mentions)}</code> chat members '
-            f'(<code>{len(all_usernames)}</code> in total): '
-            f'(message <code>{i + 1}</code> of <code>{len(username_packs)}</code>)\n'
-        )
-        reply_html += ' '.join(mentions) + '\n'
-        reply_html += (
-            f'If <b>You</b> want to get mentioned by messages like this one, '
-            f'please, click on /check_in command.'
-        )
-        update.effective_message.reply_html(reply_html)
+
+def _render_mention_page(snapshot: pagination.Snapshot, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Render a message of /mention_all, pages of the snapshot fit into both mentions count and length limits."""
+    pages = pagination.count_pages(snapshot)
+    usernames = pagination.get_page(snapshot, page=page)
+    text = _render_mention_text(usernames=usernames, total=len(snapshot.usernames), page=page, pages=pages)
+    return text, pagination.build_mention_keyboard(snapshot, page=page, pages=pages)
+
+
+def callback_page(update: Update, context: CallbackContext) -> None:
+    """Show another page of /list by editing its message, or send the next message of /mention_all."""
+    query = update.callback_query
+    kind, snapshot_id, page = pagination.parse_callback_data(query.data)
+    chat_id = update.effective_chat.id
+    if kind == pagination.MENTION and query.from_user.username not in settings.TGBOT_ADMIN_USERNAMES:
+        query.answer('Only admins can mention all users.')
+        return
+
+    snapshot = pagination.roster_snapshots.get(snapshot_id=snapshot_id, chat_id=chat_id)
+    if snapshot is None:
+        # roster was dropped from memory, pages of current members would not match messages sent already
+        query.answer('This list has expired, run the command again.')
+        return
+
+    if kind == pagination.LIST:
+        text, reply_markup = _render_list_page(snapshot=snapshot, page=page)
+        outbound.sender.enqueue(chat_id=chat_id, send=query.edit_message_text, kwargs={
+            'text': text,
+            'reply_markup': reply_markup,
+        })
+        query.answer()
+        return
+
+    pages = pagination.count_pages(snapshot)
+    if page >= pages or not pagination.roster_snapshots.claim_page(snapshot, page=page):
+        query.answer('These users were mentioned already.')
+        return
+    # mentions added by editing a message are not notified, so every page is a new message,
+    # and the button is removed from the previous one
+    outbound.sender.enqueue(chat_id=chat_id, send=query.edit_message_reply_markup, kwargs={'reply_markup': None})
+    text, reply_markup = _render_mention_page(snapshot=snapshot, page=page)
+    outbound.sender.enqueue(chat_id=chat_id, send=context.bot.send_message, kwargs={
+        'chat_id': chat_id,
+        'text': text,
+        'parse_mode': ParseMode.HTML,
+        'reply_markup': reply_markup,
+    })
+    query.answer()
 
 
 def command_enable(update: Update, context: CallbackContext) -> None:
     """Enable users tracking."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    _remember_caller(update=update, context=context)
+    changed = _remember_caller(update=update, context=context)
 
     if context.chat_data[CHAT_DATA.ENABLED]:
         reply_text = 'User tracking already enabled.'
     else:
         _enable_tracking(update=update, context=context)
+        changed = True
         reply_text = f'User tracking successfully enabled.'
 
-    _save_chat_data(update=update, context=context)
+    if changed:
+        _save_chat_data(update=update, context=context)
 
-    update.effective_message.reply_text(reply_text)
+    outbound.sender.enqueue_reply(update.effective_message, reply_text)
 
 
 def command_disable(update: Update, context: CallbackContext) -> None:
     """Disable users tracking."""
     if not _restore_chat_data(update=update, context=context):
-        update.effective_message.reply_text(f'Initialise me with /start command first.')
+        outbound.sender.enqueue_reply(update.effective_message, f'Initialise me with /start command first.')
 
-    _remember_caller(update=update, context=context)
+    changed = _remember_caller(update=update, context=context)
 
     if not context.chat_data[CHAT_DATA.ENABLED]:
         reply_text = 'User tracking already disabled.'
     else:
         _disable_tracking(update=update, context=context)
+        changed = True
         reply_text = f'User tracking successfully disabled.'
 
-    _save_chat_data(update=update, context=context)
+    if changed:
+        _save_chat_data(update=update, context=context)
 
-    update.effective_message.reply_text(reply_text)
+    outbound.sender.enqueue_reply(update.effective_message, reply_text)
 
 
 def update_members(update: Update, context: CallbackContext) -> None:
-    """Remember new chat users."""
+    """Remember new chat users and forget left ones, events are applied in batches per chat."""
+    events = membership.events_from_update(update)
+    if events:
+        membership.membership_batcher.add(
+            update=update, dispatcher=context.dispatcher, events=events, apply=apply_membership_events)
+
+
+def apply_membership_events(update: Update, dispatcher: Dispatcher, events: List[membership.MembershipEvent]) -> None:
+    """Apply a batch of membership events of the update's chat and save chat data once."""
+    context = CallbackContext.from_update(update, dispatcher)
     if not _restore_chat_data(update=update, context=context):
         return
 
@@ -411,15 +1068,14 @@ def update_members(update: Update, context: CallbackContext) -> None:
         return
 
     if CHAT_DATA.MEMBERS_BY_USERNAME not in context.chat_data:
-        context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME] = []
-
-    # remember new members
-    for user in update.message.new_chat_members:
-        _remember_user(user=user, context=context)
+        context.chat_data[CHAT_DATA.MEMBERS_BY_USERNAME] = {}
 
-    # FIXME - sometimes, it doesn't react as intended
-    # forget left members
-    if update.message.left_chat_member:
-        _forget_chat_member(username=update.message.left_chat_member.username, context=context)
+    changed = False
+    for event in events:
+        if event.joined:
+            changed |= _remember_user(user=event.user, context=context)
+        else:
+            changed |= _forget_user(user=event.user, context=context)
 
-    _save_chat_data(update=update, context=context)
+    if changed:
+        _save_chat_data(update=update, context=context)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Iterable, Optional, Set
+
+from . import metrics
+from .storage import (
+    MEMBERS_BY_USERNAME, TGBOT_DATA_DIR, build_chat_data_filename, list_data_dir_chat_ids, load_chat_data_file,
+    _write_atomically,
+)
+
+logger = logging.getLogger(__name__)
+
+
+JOURNAL_GENERATION = 'journal_generation'
+""" Snapshot key with generation of the journal that continues it. """
+
+
+def build_chat_journal_filename(chat_id: str or int, generation: int) -> str:
+    return os.path.join(TGBOT_DATA_DIR, f'chat-journal_{chat_id}_{generation}.jsonl')
+
+
+class JournalStorage:
+    """
+    Storage backend that keeps a snapshot and an append-only journal per chat.
+
+    Snapshot is the same chat-data_<id>.json file as written by JSON backend.
+    Every change is appended to chat-journal_<id>_<generation>.jsonl as a small record:
+        {"chat": {...}} - chat data without members,
+        {"set": "username", "data": {...}} - member remembered,
+        {"del": "username"} - member forgotten.
+    Once journal grows past `compact_records` records, it is folded into a new snapshot
+    that points to the next journal generation, and the old journal is removed.
+    Crash at any point leaves either the old snapshot with its journal, or the new snapshot;
+    a record which was being appended is incomplete and is skipped on load.
+    """
+
+    def __init__(self, compact_records: int):
+        self.compact_records = compact_records
+        self._digests: Dict[int or str, bytes] = {}
+        self._journal_lengths: Dict[int or str, int] = {}
+        self._generations: Dict[int or str, int] = {}
+
+    def load(self, chat_id: int or str) -> dict:
+        chat_data = load_chat_data_file(chat_id=chat_id)
+        generation = chat_data.pop(JOURNAL_GENERATION, 0)
+
+        records = 0
+        journal_filename = build_chat_journal_filename(chat_id=chat_id, generation=generation)
+        if os.path.exists(journal_filename):
+            read_size = 0
+            with open(journal_filename, 'rb') as fp:
+                for line in fp:
+                    read_size += len(line)
+                    if not line.endswith(b'\n'):
+                        # the last record is incomplete if process crashed while appending it (or it is being
+                        # appended right now), it is not truncated here as loads are not serialized with writes
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete record followed by records appended after restart, see `write`
+                        logger.warning(f'Skipped broken record in {journal_filename}')
+                        continue
+                    self._apply_record(chat_data=chat_data, record=record)
+                    records += 1
+            metrics.storage_bytes.inc(read_size, operation='read')
+        self._journal_lengths[chat_id] = records
+        self._generations[chat_id] = generation
+        return chat_data
+
+    def iter_chat_ids(self) -> Iterable[int]:
+        # a new chat has only a journal until its first compaction
+        return (list_data_dir_chat_ids(r'chat-data_(-?\d+)\.json')
+                | list_data_dir_chat_ids(r'chat-journal_(-?\d+)_0\.jsonl'))
+
+    @staticmethod
+    def _apply_record(chat_data: dict, record: dict) -> None:
+        if 'chat' in record:
+            members = chat_data.get(MEMBERS_BY_USERNAME, {})
+            chat_data.clear()
+            chat_data.update(record['chat'])
+            chat_data[MEMBERS_BY_USERNAME] = members
+        elif 'set' in record:
+            chat_data.setdefault(MEMBERS_BY_USERNAME, {})[record['set']] = record['data']
+        elif 'del' in record:
+            chat_data.setdefault(MEMBERS_BY_USERNAME, {}).pop(record['del'], None)
+
+    def write(self, chat_id: int or str, chat_data: dict, changed_usernames: Optional[Set[str]]) -> bool:
+        """
+        Append records of changed chat data and members to the journal.
+        Write a new snapshot instead if changed usernames are not known or journal is too long.
+        Return True if anything was written.
+        """
+        if changed_usernames is None or self._journal_lengths.get(chat_id, 0) >= self.compact_records:
+            self.compact(chat_id=chat_id, chat_data=chat_data)
+            return True
+
+        records = []
+        content = json.dumps({key: value for key, value in chat_data.items() if key != MEMBERS_BY_USERNAME})
+        digest = hashlib.sha1(content.encode()).digest()
+        if self._digests.get(chat_id) != digest:
+            records.append(f'{{"chat": {content}}}\n')
+        members = chat_data.get(MEMBERS_BY_USERNAME, {})
+        for username in changed_usernames:
+            user_data = members.get(username)
+            if user_data is None:
+                records.append(json.dumps({'del': username}) + '\n')
+            else:
+                records.append(json.dumps({'set': username, 'data': user_data}) + '\n')
+        if not records:
+            return False
+
+        generation = self._generations.setdefault(chat_id, 0)
+        content = ''.join(records).encode()
+        with open(build_chat_journal_filename(chat_id=chat_id, generation=generation), 'a+b') as fp:
+            # only the writer appends, so a journal which does not end with a new line has an incomplete record
+            # left by a crash; it is ended, so the record is skipped on load and dropped by the next compaction
+            size = fp.seek(0, os.SEEK_END)
+            if size:
+                fp.seek(size - 1)
+                if fp.read(1) != b'\n':
+                    content = b'\n' + content
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        metrics.storage_bytes.inc(len(content), operation='write')
+        self._digests[chat_id] = digest
+        self._journal_lengths[chat_id] = self._journal_lengths.get(chat_id, 0) + len(records)
+        return True
+
+    def compact(self, chat_id: int or str, chat_data: dict) -> None:
+        """Write chat data as a new snapshot and remove the journal it replaces."""
+        generation = self._generations.get(chat_id, 0)
+        content = json.dumps({**chat_data, JOURNAL_GENERATION: generation + 1}).encode()
+        _write_atomically(build_chat_data_filename(chat_id=chat_id), content)
+        metrics.storage_bytes.inc(len(content), operation='write')
+        self._generations[chat_id] = generation + 1
+        try:
+            os.unlink(build_chat_journal_filename(chat_id=chat_id, generation=generation))
+        except FileNotFoundError:
+            pass
+        self._digests[chat_id] = hashlib.sha1(
+            json.dumps({key: value for key, value in chat_data.items() if key != MEMBERS_BY_USERNAME}).encode()
+        ).digest()
+        self._journal_lengths[chat_id] = 0
+
+    def close(self) -> None:
+        pass
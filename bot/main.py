@@ -1,9 +1,30 @@
 import logging
+import queue
+import signal
+import threading
+from typing import Optional
+
+from telegram import Bot, Update
+from telegram.ext import (
+    Updater, CommandHandler, MessageHandler, Filters, Dispatcher, JobQueue, TypeHandler, CallbackQueryHandler,
+    ChatMemberHandler,
+)
+from telegram.utils.request import Request
 
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-
+from . import chat_cache
+from . import concurrency
 from . import handlers
+from . import membership
+from . import metrics
+from . import outbound
+from . import pagination
+from . import profiling
+from . import reconcile
+from . import reports
 from . import settings
+from . import storage
+from .user_index import user_index
+from .webhook import ALLOWED_UPDATES, QUEUE_TIMEOUT, WebhookServer, register_webhook
 
 # Enable logging
 logging.basicConfig(
@@ -12,23 +33,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DISPATCHER_WORKERS = 4
+""" Threads of dispatcher's own pool, used by job queue callbacks; handlers run on chat executor. """
+
+_metrics_server: Optional[metrics.MetricsServer] = None
+
 
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
 
 
-def main():
-    """Start the bot."""
-
+def register_handlers(dispatcher: Dispatcher) -> None:
     filter_admins = Filters.user(username=settings.TGBOT_ADMIN_USERNAMES)
     filter_groups = Filters.chat_type.supergroup | Filters.chat_type.group
 
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(settings.TGBOT_APIKEY)
-
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
-
     # on different commands - answer in Telegram
     dispatcher.add_handler(CommandHandler("help", handlers.command_help))
     dispatcher.add_handler(CommandHandler("start", handlers.command_help, filters=Filters.chat_type.private))
@@ -50,18 +68,178 @@ def main():
     dispatcher.add_handler(CommandHandler("list", handlers.command_list, filters=filter_groups))
     dispatcher.add_handler(
         CommandHandler("mention_all", handlers.command_mention_all, filters=filter_admins & filter_groups))
+    dispatcher.add_handler(CallbackQueryHandler(handlers.callback_page, pattern=pagination.CALLBACK_PATTERN))
+
+    dispatcher.add_handler(CommandHandler("whois", handlers.command_whois, filters=filter_admins))
+    dispatcher.add_handler(
+        CommandHandler("reconcile", handlers.command_reconcile, filters=filter_admins & filter_groups))
+    dispatcher.add_handler(CommandHandler("profile", handlers.command_profile, filters=filter_admins))
+    dispatcher.add_handler(
+        CommandHandler("schedule", handlers.command_schedule, filters=filter_admins & filter_groups))
+    dispatcher.add_handler(CommandHandler("import", handlers.command_import, filters=filter_admins & filter_groups))
+    dispatcher.add_handler(CommandHandler("export", handlers.command_export, filters=filter_admins & filter_groups))
+
+    # process updates of different chats in parallel, keeping updates of one chat in order,
+    # record duration of every handler, and profile handlers while /profile session is running
+    for group_handlers in dispatcher.handlers.values():
+        for handler in group_handlers:
+            handler.callback = concurrency.run_serialized_per_chat(
+                metrics.instrument_handler(profiling.profiler.wrap(handler.callback)))
+
+    # on noncommand i.e message: membership events are only buffered in the dispatcher thread,
+    # and are applied in batches on chat executor
+    dispatcher.add_handler(MessageHandler(
+        Filters.status_update.new_chat_members | Filters.status_update.left_chat_member, handlers.update_members))
+    dispatcher.add_handler(ChatMemberHandler(handlers.update_members, chat_member_types=ChatMemberHandler.CHAT_MEMBER))
+
+    # count every update before other handlers, in the dispatcher thread
+    dispatcher.add_handler(TypeHandler(Update, metrics.count_update), group=-2)
+    # apply buffered membership events of a chat before its other updates are handled
+    dispatcher.add_handler(TypeHandler(Update, membership.membership_batcher.flush_before_update), group=-1)
+
+
+def build_updater(bot: Bot = None) -> Updater:
+    """Create Updater with bounded update queue and all handlers registered."""
+    if bot is None:
+        bot = Bot(
+            settings.TGBOT_APIKEY,
+            base_url=settings.TGBOT_API_BASE_URL,
+            request=Request(con_pool_size=max(settings.TGBOT_WORKERS, DISPATCHER_WORKERS) + 4),
+        )
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(
+        bot,
+        queue.Queue(maxsize=settings.TGBOT_UPDATE_QUEUE_SIZE),
+        workers=DISPATCHER_WORKERS,
+        job_queue=job_queue,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    # keep only recently active chats in memory
+    dispatcher.chat_data = chat_cache.chat_data_cache
+
+    register_handlers(dispatcher)
+
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def start_background_tasks(shard: int = None, job_queue: JobQueue = None) -> None:
+    """
+    Start background work of the bot process, or of the worker process of given shard in supervisor mode.
+    Daily reports are scheduled only if job queue is given.
+    """
+    global _metrics_server
+    # Read metadata of stored chats, their members are indexed by user ID when chats are loaded
+    storage.load_manifest()
+    user_index.build()
+    # Schedule daily reports of stored chats
+    if job_queue is not None:
+        reports.report_scheduler.start(job_queue=job_queue, send_report=handlers.send_scheduled_report, schedules={
+            chat_id: reports.parse_report_time(entry.report_time)
+            for chat_id, entry in storage.iter_chat_manifest() if entry.report_time
+        })
+    # Serve metrics
+    if settings.TGBOT_METRICS_PORT:
+        _metrics_server = metrics.MetricsServer(
+            listen=settings.TGBOT_METRICS_LISTEN,
+            port=settings.TGBOT_METRICS_PORT + (shard or 0),
+        )
+        _metrics_server.start()
+    # Start writing chat data in background
+    storage.start_write_behind()
+    # Start applying membership events in batches
+    membership.membership_batcher.start()
+    # Start sending queued messages
+    outbound.sender.start()
+
+
+def stop_background_tasks() -> None:
+    global _metrics_server
+    reports.report_scheduler.stop()
+    # Finish updates which are already dispatched to workers
+    membership.membership_batcher.stop()
+    reconcile.reconciler.stop_all()
+    concurrency.chat_executor.shutdown()
+    # Send messages queued by them
+    outbound.sender.stop()
+    # Write chat data that is left after the bot stopped
+    storage.stop_write_behind()
+    # Write profile of the session which was not finished
+    profiling.profiler.stop(top=settings.TGBOT_PROFILE_TOP)
+    if _metrics_server is not None:
+        _metrics_server.stop()
+        _metrics_server = None
+
+
+def main():
+    """Start the bot."""
+
+    # Create the Updater and pass it your bot's token.
+    updater = build_updater()
 
-    # on noncommand i.e message
-    dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, handlers.update_members))
+    start_background_tasks(job_queue=updater.job_queue)
 
     # Start the Bot
-    updater.start_polling()
+    updater.start_polling(allowed_updates=ALLOWED_UPDATES)
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    stop_background_tasks()
+
+
+def main_webhook():
+    """Start the bot with embedded webhook server instead of polling."""
+
+    updater = build_updater()
+    dispatcher = updater.dispatcher
+
+    def handle_update(data: dict) -> bool:
+        try:
+            dispatcher.update_queue.put(Update.de_json(data, dispatcher.bot), timeout=QUEUE_TIMEOUT)
+        except queue.Full:
+            logger.warning('Update queue is full, update is rejected.')
+            return False
+        return True
+
+    server = WebhookServer(
+        listen=settings.TGBOT_WEBHOOK_LISTEN,
+        port=settings.TGBOT_WEBHOOK_PORT,
+        path=settings.TGBOT_WEBHOOK_PATH,
+        secret_token=settings.TGBOT_WEBHOOK_SECRET_TOKEN,
+        handle_update=handle_update,
+    )
+
+    start_background_tasks(job_queue=updater.job_queue)
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    server.start()
+
+    if settings.TGBOT_WEBHOOK_URL:
+        register_webhook(
+            bot=updater.bot,
+            url=settings.TGBOT_WEBHOOK_URL,
+            secret_token=settings.TGBOT_WEBHOOK_SECRET_TOKEN,
+            max_connections=settings.TGBOT_WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+
+    # Run the bot until the process receives SIGINT or SIGTERM
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+
+    server.stop()
+    dispatcher.stop()
+    updater.job_queue.stop()
+    dispatcher_thread.join()
+
+    stop_background_tasks()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,192 @@
+"""
+Batched processing of chat members joining and leaving.
+
+Membership events come from service messages (new_chat_members, left_chat_member) and, if the bot
+is a chat admin, from chat_member updates. Events of a chat
+are buffered for a short window and applied as one batch, so a raid or a bulk invite restores
+and saves chat data once instead of once per service message.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from telegram import Update, User
+from telegram.ext import Dispatcher
+
+from . import concurrency
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+PRESENT_STATUSES = {'creator', 'administrator', 'member'}
+""" Statuses of users who are in the chat, restricted users are in the chat if their `is_member` is set. """
+
+
+class MembershipEvent(NamedTuple):
+    user: User
+    joined: bool
+
+
+def is_present(chat_member) -> bool:
+    if chat_member.status == 'restricted':
+        return bool(chat_member.is_member)
+    return chat_member.status in PRESENT_STATUSES
+
+
+def events_from_update(update: Update) -> List[MembershipEvent]:
+    """Return membership events of the update, in the order they happened."""
+    events = []
+    message = update.effective_message
+    if message is not None:
+        events.extend(MembershipEvent(user=user, joined=True) for user in message.new_chat_members)
+        if message.left_chat_member:
+            events.append(MembershipEvent(user=message.left_chat_member, joined=False))
+    chat_member = update.chat_member
+    if chat_member is not None:
+        was_present = is_present(chat_member.old_chat_member)
+        now_present = is_present(chat_member.new_chat_member)
+        if was_present != now_present:
+            events.append(MembershipEvent(user=chat_member.new_chat_member.user, joined=now_present))
+    return events
+
+
+def is_membership_update(update: Update) -> bool:
+    message = update.effective_message
+    return (
+        update.chat_member is not None
+        or (message is not None and bool(message.new_chat_members or message.left_chat_member))
+    )
+
+
+def collapse_events(events: List[MembershipEvent]) -> List[MembershipEvent]:
+    """
+    Return the last event of every user, in the order of those last events.
+    A user who joined and left within a batch has left, and a user who left and joined again is present.
+    """
+    last_events: Dict[int, MembershipEvent] = {}
+    for event in events:
+        # re-insert, so the order follows the last events
+        last_events.pop(event.user.id, None)
+        last_events[event.user.id] = event
+    return list(last_events.values())
+
+
+class _Batch(NamedTuple):
+    events: List[MembershipEvent]
+    # the latest update of the chat, its chat is used to restore and save chat data
+    update: Update
+    dispatcher: Dispatcher
+    apply: Callable[[Update, Dispatcher, List[MembershipEvent]], None]
+    due: float
+
+
+class MembershipBatcher:
+    """
+    Buffer membership events per chat for `window` seconds and apply them as one batch.
+
+    Events are buffered in the dispatcher thread, and batches are applied on the chat executor,
+    so they are serialized with handlers of the chat. Before any other update of a chat is dispatched,
+    its pending batch is submitted (see `flush_before_update`), so handlers never see chat data
+    which misses earlier joins and leaves.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._batches: Dict[int, _Batch] = {}
+        # (time when batch is due, seq, chat ID)
+        self._deadlines: List[Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.batches_applied = 0
+        self.events_applied = 0
+
+    def add(self, update: Update, dispatcher: Dispatcher, events: List[MembershipEvent],
+            apply: Callable[[Update, Dispatcher, List[MembershipEvent]], None]) -> None:
+        """Buffer events of the update, or submit them right away if batching is disabled."""
+        chat_id = update.effective_chat.id
+        due = time.monotonic() + self.window
+        with self._condition:
+            if self.window > 0 and self._thread is not None:
+                batch = self._batches.get(chat_id)
+                if batch is None:
+                    self._batches[chat_id] = _Batch(
+                        events=list(events), update=update, dispatcher=dispatcher, apply=apply, due=due)
+                    heapq.heappush(self._deadlines, (due, next(self._seq), chat_id))
+                    self._condition.notify()
+                else:
+                    batch.events.extend(events)
+                    self._batches[chat_id] = batch._replace(update=update)
+                return
+        batch = _Batch(events=list(events), update=update, dispatcher=dispatcher, apply=apply, due=due)
+        concurrency.chat_executor.submit(chat_id, self._apply, batch)
+
+    def flush(self, chat_id: int) -> None:
+        """Submit pending batch of the chat to the chat executor now."""
+        with self._condition:
+            batch = self._batches.pop(chat_id, None)
+        if batch is not None:
+            concurrency.chat_executor.submit(chat_id, self._apply, batch)
+
+    def flush_before_update(self, update: Update, context) -> None:
+        """Handler callback which submits pending batch of the chat before other updates of the chat."""
+        if update.effective_chat is not None and not is_membership_update(update):
+            self.flush(update.effective_chat.id)
+
+    def pending(self, chat_id: int = None) -> int:
+        """Return number of buffered events of the chat, or of all chats."""
+        with self._condition:
+            if chat_id is not None:
+                batch = self._batches.get(chat_id)
+                return len(batch.events) if batch is not None else 0
+            return sum(len(batch.events) for batch in self._batches.values())
+
+    def _apply(self, batch: _Batch) -> None:
+        events = collapse_events(batch.events)
+        batch.apply(batch.update, batch.dispatcher, events)
+        self.batches_applied += 1
+        self.events_applied += len(batch.events)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.monotonic()
+                    if self._deadlines and self._deadlines[0][0] <= now:
+                        _, _, chat_id = heapq.heappop(self._deadlines)
+                        batch = self._batches.get(chat_id)
+                        # batch could be flushed earlier by another update of the chat and a new one started
+                        if batch is not None and batch.due <= now:
+                            break
+                        continue
+                    self._condition.wait(self._deadlines[0][0] - now if self._deadlines else None)
+            self.flush(chat_id)
+
+    def start(self) -> None:
+        with self._condition:
+            self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='membership', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop background thread and submit all pending batches to the chat executor."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            chat_ids = list(self._batches)
+            self._deadlines = []
+        for chat_id in chat_ids:
+            self.flush(chat_id)
+
+
+membership_batcher = MembershipBatcher(window=settings.TGBOT_MEMBERSHIP_BATCH_WINDOW)
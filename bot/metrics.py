@@ -0,0 +1,251 @@
+"""
+Counters and latency histograms of the bot, rendered in Prometheus text format.
+
+Metrics are plain in-process objects guarded by a lock each, so recording a value costs
+about a microsecond and instrumentation can stay enabled under load.
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+""" Upper bounds of latency histogram buckets, in seconds. """
+
+UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query',
+                'chosen_inline_result', 'callback_query', 'shipping_query', 'pre_checkout_query', 'poll',
+                'poll_answer', 'my_chat_member', 'chat_member')
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Return value for given labels, or sum over all label values which are not given."""
+        with self._lock:
+            return sum(
+                value for key, value in self._values.items()
+                if all(labels.get(name, item) == item for name, item in zip(self.labels, key))
+            )
+
+    def render(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> (counts per bucket with the last one for +Inf, sum of observed values)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def _merged_counts(self, labels: Dict[str, str]) -> List[int]:
+        merged = [0] * (len(self.buckets) + 1)
+        with self._lock:
+            for key, (counts, _) in self._values.items():
+                if all(labels.get(name, item) == item for name, item in zip(self.labels, key)):
+                    merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def count(self, **labels: str) -> int:
+        return sum(self._merged_counts(labels))
+
+    def quantile(self, fraction: float, **labels: str) -> Optional[float]:
+        """
+        Return upper bound of the bucket containing given quantile, over all label values which are not given.
+        Return None if nothing was observed, and infinity if quantile is beyond the largest bucket.
+        """
+        counts = self._merged_counts(labels)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.labels, key, extra=f'le="{le}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+updates_total = registry.register(Counter(
+    'tgbot_updates_total', 'Updates received by the dispatcher.', labels=('type',)))
+handler_duration = registry.register(Histogram(
+    'tgbot_handler_duration_seconds', 'Time spent in handler callbacks.', labels=('handler',)))
+errors_total = registry.register(Counter(
+    'tgbot_errors_total', 'Exceptions raised by handlers, storage and outgoing messages.', labels=('source',)))
+storage_duration = registry.register(Histogram(
+    'tgbot_storage_duration_seconds', 'Time spent reading and writing chat data.', labels=('operation',)))
+storage_bytes = registry.register(Counter(
+    'tgbot_storage_bytes_total', 'Bytes of chat data read and written by storage backends.', labels=('operation',)))
+storage_write_retries_total = registry.register(Counter(
+    'tgbot_storage_write_retries_total', 'Chat data writes retried because chat data changed while being written.'))
+outgoing_messages_total = registry.register(Counter(
+    'tgbot_outgoing_messages_total', 'Queued outgoing messages by send result.', labels=('result',)))
+send_duration = registry.register(Histogram(
+    'tgbot_send_duration_seconds', 'Time spent in Bot API calls sending queued messages.'))
+
+
+def count_update(update: Update, context: CallbackContext) -> None:
+    """Handler callback that counts updates by type."""
+    for update_type in UPDATE_TYPES:
+        if getattr(update, update_type, None) is not None:
+            break
+    else:
+        update_type = 'other'
+    updates_total.inc(type=update_type)
+
+
+def instrument_handler(callback: Callable[[Update, CallbackContext], None]) -> Callable:
+    """Wrap handler callback to record its duration and exceptions."""
+    name = getattr(callback, '__name__', repr(callback))
+
+    @functools.wraps(callback)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        started_at = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            errors_total.inc(source=name)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started_at, handler=name)
+
+    return wrapper
+
+
+def summary() -> dict:
+    """Return a few aggregated values for humans."""
+    return {
+        'updates': int(updates_total.value()),
+        'errors': int(errors_total.value()),
+        'handler_p50': handler_duration.quantile(0.5),
+        'handler_p99': handler_duration.quantile(0.99),
+        'storage_write_p99': storage_duration.quantile(0.99, operation='write'),
+        'storage_written_bytes': int(storage_bytes.value(operation='write')),
+        'outgoing_messages': int(outgoing_messages_total.value(result='sent')),
+    }
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        content = registry.render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class MetricsServer:
+    """HTTP server which serves all metrics at /metrics."""
+
+    def __init__(self, listen: str, port: int):
+        self._httpd = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info(f'Metrics are served on {self._httpd.server_address}')
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,196 @@
+"""
+Compact typed representation of chat data and its binary serialization.
+
+Handlers work with chat data as a plain dict (that is what `context.chat_data` is),
+`ChatState` is the form used to store and load it.
+"""
+import json
+import struct
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional
+
+from .storage import MEMBERS_BY_USERNAME
+
+BEGAN_AT = 'began_at'
+ENABLED = 'enabled'
+TITLE = 'title'
+TGID = 'tgid'
+REPORT = 'report'
+""" Scheduled daily report: report time (HH:MM, UTC), roster usernames and time of the last sent report. """
+REPORT_TIME = 'time'
+REPORT_ROSTER = 'roster'
+REPORT_SENT_AT = 'sent_at'
+
+MEMBER_ID = 'id'
+
+FORMAT_MAGIC = b'TGCS'
+FORMAT_VERSION = 1
+
+NO_ID = -2 ** 63
+""" Stored in place of a missing chat or user ID. """
+
+_NO_STRING = 0xFFFFFFFF
+""" Stored in place of length of a missing string. """
+
+_HEADER = struct.Struct('<4sBqbI')
+""" Magic, format version, chat ID, enabled flag (-1 if missing), number of members. """
+
+_LENGTH = struct.Struct('<I')
+
+_USERNAME_SEPARATOR = '\n'
+
+
+class Member:
+    __slots__ = ('username', 'user_id')
+
+    def __init__(self, username: str, user_id: Optional[int] = None):
+        self.username = username
+        self.user_id = user_id
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Member):
+            return NotImplemented
+        return self.username == other.username and self.user_id == other.user_id
+
+    def __repr__(self) -> str:
+        return f'Member({self.username!r}, {self.user_id!r})'
+
+    def to_member_data(self) -> dict:
+        return {} if self.user_id is None else {MEMBER_ID: self.user_id}
+
+
+class ChatState:
+    """
+    Chat data with members held in two parallel arrays: interned usernames and user IDs.
+    Chat data keys which are not known to the model are kept as they are in `extra`.
+    """
+
+    __slots__ = ('chat_id', 'title', 'enabled', 'began_at', 'extra', '_member_count',
+                 '_usernames', '_user_ids')
+
+    def __init__(self, chat_id: Optional[int] = None, title: Optional[str] = None, enabled: Optional[bool] = None,
+                 began_at: Optional[str] = None, extra: Dict[str, object] = None):
+        self.chat_id = chat_id
+        self.title = title
+        self.enabled = enabled
+        self.began_at = began_at
+        self.extra = extra or {}
+        self._member_count = 0
+        self._usernames: List[str] = []
+        self._user_ids = array('q')
+
+    @property
+    def member_count(self) -> int:
+        return self._member_count
+
+    def _decode_members(self, encoded: memoryview) -> None:
+        ids_size = self._member_count * self._user_ids.itemsize
+        self._user_ids = array('q')
+        self._user_ids.frombytes(encoded[:ids_size])
+        if sys.byteorder != 'little':
+            self._user_ids.byteswap()
+        usernames, _ = _unpack_string(encoded, ids_size)
+        self._usernames = [sys.intern(username) for username in usernames.split(_USERNAME_SEPARATOR)] \
+            if self._member_count else []
+
+    def add_member(self, member: Member) -> None:
+        """Append a member, usernames are not checked for duplicates."""
+        if _USERNAME_SEPARATOR in member.username:
+            raise ValueError(f'Invalid username: {member.username!r}')
+        self._usernames.append(sys.intern(member.username))
+        self._user_ids.append(NO_ID if member.user_id is None else member.user_id)
+        self._member_count += 1
+
+    def iter_members(self) -> Iterator[Member]:
+        for username, user_id in zip(self._usernames, self._user_ids):
+            yield Member(username=username, user_id=None if user_id == NO_ID else user_id)
+
+    @classmethod
+    def from_chat_data(cls, chat_data: dict) -> 'ChatState':
+        extra = dict(chat_data)
+        state = cls(
+            chat_id=extra.pop(TGID, None),
+            title=extra.pop(TITLE, None),
+            enabled=extra.pop(ENABLED, None),
+            began_at=extra.pop(BEGAN_AT, None),
+        )
+        for username, member_data in extra.pop(MEMBERS_BY_USERNAME, {}).items():
+            unknown_keys = set(member_data) - {MEMBER_ID}
+            if unknown_keys:
+                raise ValueError(f'Member {username} has data that can not be stored: {sorted(unknown_keys)}')
+            state.add_member(Member(username=username, user_id=member_data.get(MEMBER_ID)))
+        state.extra = extra
+        return state
+
+    def to_chat_data(self) -> dict:
+        chat_data = dict(self.extra)
+        for key, value in ((TGID, self.chat_id), (TITLE, self.title), (ENABLED, self.enabled),
+                           (BEGAN_AT, self.began_at)):
+            if value is not None:
+                chat_data[key] = value
+        chat_data[MEMBERS_BY_USERNAME] = {member.username: member.to_member_data() for member in self.iter_members()}
+        return chat_data
+
+    def encode(self) -> bytes:
+        """
+        Serialize state into version 1 binary format:
+            header (see _HEADER), title, began at, extra keys as JSON,
+            user IDs as little-endian int64 array, usernames separated by new lines.
+        Strings are prefixed with uint32 length.
+        """
+        user_ids = array('q', self._user_ids)
+        if sys.byteorder != 'little':
+            user_ids.byteswap()
+        return b''.join((
+            _HEADER.pack(
+                FORMAT_MAGIC,
+                FORMAT_VERSION,
+                NO_ID if self.chat_id is None else self.chat_id,
+                -1 if self.enabled is None else int(self.enabled),
+                self._member_count,
+            ),
+            _pack_string(self.title),
+            _pack_string(self.began_at),
+            _pack_string(json.dumps(self.extra) if self.extra else None),
+            user_ids.tobytes(),
+            _pack_string(_USERNAME_SEPARATOR.join(self._usernames)),
+        ))
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'ChatState':
+        buffer = memoryview(data)
+        magic, version, chat_id, enabled, member_count = _HEADER.unpack_from(buffer)
+        if magic != FORMAT_MAGIC:
+            raise ValueError('Not a chat state')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported chat state format version: {version}')
+        offset = _HEADER.size
+        title, offset = _unpack_string(buffer, offset)
+        began_at, offset = _unpack_string(buffer, offset)
+        extra, offset = _unpack_string(buffer, offset)
+        state = cls(
+            chat_id=None if chat_id == NO_ID else chat_id,
+            title=title,
+            enabled=None if enabled == -1 else bool(enabled),
+            began_at=began_at,
+            extra=json.loads(extra) if extra is not None else None,
+        )
+        state._member_count = member_count
+        state._decode_members(buffer[offset:])
+        return state
+
+
+def _pack_string(value: Optional[str]) -> bytes:
+    if value is None:
+        return _LENGTH.pack(_NO_STRING)
+    encoded = value.encode()
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(buffer: memoryview, offset: int) -> (Optional[str], int):
+    length, = _LENGTH.unpack_from(buffer, offset)
+    offset += _LENGTH.size
+    if length == _NO_STRING:
+        return None, offset
+    return str(buffer[offset:offset + length], 'utf-8'), offset + length
@@ -0,0 +1,232 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from telegram import Message, ReplyMarkup
+from telegram.error import RetryAfter
+
+from . import metrics
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+SENDER_THREADS = 4
+
+STOP_TIMEOUT = 30
+""" Seconds to wait for queued messages to be sent on shutdown. """
+
+LATENCY_SAMPLES = 1000
+
+
+class TokenBucket:
+    """Allow `rate` events per second on average, and bursts of up to `capacity` events."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Return seconds until next event is allowed, 0 if it is allowed now."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outgoing(NamedTuple):
+    send: Callable
+    kwargs: dict
+    enqueued_at: float
+
+
+class OutboundQueue:
+    """
+    Queue of outgoing messages, sent by background threads within Telegram flood limits.
+
+    Global and per-chat token buckets limit the rate of sends. Messages of one chat are sent one at a time
+    in the order they were queued. A chat that gets `RetryAfter` error is paused for the requested time,
+    and the message is sent again.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: int, threads: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.threads = threads
+        self._global_bucket = TokenBucket(rate=rate, capacity=rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._pending: Dict[int, Deque[_Outgoing]] = {}
+        # chats with pending messages which are not being sent right now: (time when chat can send, seq, chat ID)
+        self._ready: List[Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+        self._latencies: Deque[float] = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._counters = collections.Counter()
+
+    def enqueue(self, chat_id: int, send: Callable, kwargs: dict) -> None:
+        """Queue `send(**kwargs)` call, it is executed in a background thread."""
+        now = time.monotonic()
+        with self._condition:
+            messages = self._pending.get(chat_id)
+            if messages is None:
+                messages = self._pending[chat_id] = collections.deque()
+                heapq.heappush(self._ready, (now, next(self._seq), chat_id))
+                self._condition.notify()
+            messages.append(_Outgoing(send=send, kwargs=kwargs, enqueued_at=now))
+
+    def enqueue_reply(self, message: Message, text: str, parse_mode: str = None,
+                      reply_markup: ReplyMarkup = None) -> None:
+        """Queue a text reply to the message."""
+        self.enqueue(chat_id=message.chat_id, send=message.bot.send_message, kwargs={
+            'chat_id': message.chat_id,
+            'text': text,
+            'parse_mode': parse_mode,
+            'reply_to_message_id': message.message_id,
+            'allow_sending_without_reply': True,
+            'reply_markup': reply_markup,
+        })
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 2 * len(self._pending) + 1000:
+                # forget buckets of idle chats, a new bucket is full anyway
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items()
+                    if key in self._pending or not value.is_full(now)
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+        return bucket
+
+    def _take_next(self) -> Optional[Tuple[int, _Outgoing]]:
+        """Wait until a message can be sent and return it with its chat ID, or None if queue is stopped."""
+        with self._condition:
+            while True:
+                if not self._ready:
+                    if self._stopping and not self._pending:
+                        return None
+                    self._condition.wait()
+                    continue
+                ready_at, _, chat_id = self._ready[0]
+                now = time.monotonic()
+                delay = max(ready_at - now, self._global_bucket.delay(now))
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._ready)
+                chat_bucket = self._chat_bucket(chat_id=chat_id, now=now)
+                chat_delay = chat_bucket.delay(now)
+                if chat_delay > 0:
+                    heapq.heappush(self._ready, (now + chat_delay, next(self._seq), chat_id))
+                    continue
+                self._global_bucket.take(now)
+                chat_bucket.take(now)
+                # chat stays out of ready heap until the message is sent, to keep order of its messages
+                return chat_id, self._pending[chat_id].popleft()
+
+    def _release(self, chat_id: int, result: str, retry: _Outgoing = None, delay: float = 0) -> None:
+        """Count send result and make chat ready to send its next message, or the message to retry after delay."""
+        metrics.outgoing_messages_total.inc(result=result)
+        with self._condition:
+            self._counters[result] += 1
+            messages = self._pending[chat_id]
+            if retry is not None:
+                messages.appendleft(retry)
+            if messages:
+                heapq.heappush(self._ready, (time.monotonic() + delay, next(self._seq), chat_id))
+                self._condition.notify()
+            else:
+                del self._pending[chat_id]
+                if self._stopping and not self._pending:
+                    self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            taken = self._take_next()
+            if taken is None:
+                return
+            chat_id, outgoing = taken
+            started_at = time.perf_counter()
+            try:
+                outgoing.send(**outgoing.kwargs)
+            except RetryAfter as error:
+                logger.warning(f'Flood limit in chat {chat_id}, retrying in {error.retry_after} seconds.')
+                self._release(chat_id=chat_id, result='retried', retry=outgoing, delay=error.retry_after)
+            except Exception:
+                logger.exception(f'Could not send message to chat {chat_id}.')
+                metrics.errors_total.inc(source='outbound')
+                self._release(chat_id=chat_id, result='failed')
+            else:
+                metrics.send_duration.observe(time.perf_counter() - started_at)
+                self._latencies.append(time.monotonic() - outgoing.enqueued_at)
+                self._release(chat_id=chat_id, result='sent')
+
+    def start(self) -> None:
+        """Start background threads, unless they are already running."""
+        if any(thread.is_alive() for thread in self._threads):
+            return
+        self._stopping = False
+        self._threads = []
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f'outbound-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Send queued messages, waiting at most STOP_TIMEOUT seconds, and stop background threads."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if any(thread.is_alive() for thread in self._threads):
+            logger.warning(f'{self.queue_length()} outgoing messages were not sent before shutdown.')
+        self._threads = []
+
+    def queue_length(self, chat_id: int = None) -> int:
+        """Return number of messages waiting to be sent, in given chat or in total."""
+        with self._condition:
+            if chat_id is not None:
+                return len(self._pending.get(chat_id, ()))
+            return sum(len(messages) for messages in self._pending.values())
+
+    def stats(self) -> dict:
+        with self._condition:
+            latencies = sorted(self._latencies)
+            counters = dict(self._counters)
+        return {
+            'queued': self.queue_length(),
+            'sent': counters.get('sent', 0),
+            'failed': counters.get('failed', 0),
+            'retried': counters.get('retried', 0),
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
+
+
+sender = OutboundQueue(
+    rate=settings.TGBOT_SEND_RATE,
+    chat_rate=settings.TGBOT_CHAT_SEND_RATE / 60,
+    chat_burst=settings.TGBOT_CHAT_SEND_BURST,
+    threads=SENDER_THREADS,
+)
@@ -0,0 +1,150 @@
+"""
+Pages of chat rosters shown by /list and /mention_all with inline keyboard buttons.
+
+A roster is snapshotted as a sorted tuple of usernames when the command is called and split into pages
+by both number and length of usernames, and pages are rendered from the snapshot only when a button asks
+for them. Callback data of a button names the snapshot and the page, so the snapshot outlives chat data
+changes; if it was dropped from memory (or the bot restarted), the button only answers that it has expired,
+as pages of a fresh snapshot would not match messages sent already.
+"""
+import collections
+import secrets
+import threading
+from typing import Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from . import settings
+
+LIST = 'list'
+MENTION = 'mention'
+
+CALLBACK_PATTERN = rf'^({LIST}|{MENTION}):[0-9a-f]+:\d+$'
+""" Callback data of page buttons: kind, snapshot ID and page number. """
+
+
+class Snapshot(NamedTuple):
+    snapshot_id: str
+    chat_id: int
+    usernames: Tuple[str, ...]
+    # offsets of first usernames of pages
+    page_starts: Tuple[int, ...]
+    # pages of /mention_all that were sent already, so a double click does not mention anyone twice
+    sent_pages: Set[int]
+
+
+def build_callback_data(kind: str, snapshot_id: str, page: int) -> str:
+    return f'{kind}:{snapshot_id}:{page}'
+
+
+def parse_callback_data(data: str) -> Tuple[str, str, int]:
+    kind, snapshot_id, page = data.split(':')
+    return kind, snapshot_id, int(page)
+
+
+def split_pages(usernames: Tuple[str, ...], page_size: int, max_length: int) -> Tuple[int, ...]:
+    """
+    Return offsets of first usernames of pages, which have at most `page_size` usernames
+    of at most `max_length` characters together (usernames are ASCII, so UTF-16 length is the same).
+    A username longer than `max_length` alone still gets its own page.
+    """
+    page_starts = []
+    count = length = 0
+    for offset, username in enumerate(usernames):
+        if not page_starts or count >= page_size or length + len(username) > max_length:
+            page_starts.append(offset)
+            count = length = 0
+        count += 1
+        length += len(username)
+    return tuple(page_starts)
+
+
+def count_pages(snapshot: Snapshot) -> int:
+    return max(1, len(snapshot.page_starts))
+
+
+def get_page(snapshot: Snapshot, page: int) -> Tuple[str, ...]:
+    if page >= len(snapshot.page_starts):
+        return ()
+    end = snapshot.page_starts[page + 1] if page + 1 < len(snapshot.page_starts) else len(snapshot.usernames)
+    return snapshot.usernames[snapshot.page_starts[page]:end]
+
+
+class RosterSnapshots:
+    """
+    Recently created roster snapshots. Least recently used ones are dropped when there are more
+    than `max_snapshots` of them or they hold more than `max_usernames` usernames together.
+    """
+
+    def __init__(self, max_snapshots: int, max_usernames: int):
+        self.max_snapshots = max_snapshots
+        self.max_usernames = max_usernames
+        self._snapshots: 'collections.OrderedDict[str, Snapshot]' = collections.OrderedDict()
+        self._total_usernames = 0
+        self._lock = threading.Lock()
+
+    def add(self, chat_id: int, usernames: Iterable[str], page_size: int, max_page_length: int) -> Snapshot:
+        """Snapshot sorted usernames split into pages, see `split_pages`."""
+        usernames = tuple(sorted(usernames, key=str.lower))
+        snapshot = Snapshot(
+            snapshot_id=secrets.token_hex(4),
+            chat_id=chat_id,
+            usernames=usernames,
+            page_starts=split_pages(usernames, page_size=page_size, max_length=max_page_length),
+            sent_pages=set(),
+        )
+        with self._lock:
+            self._snapshots[snapshot.snapshot_id] = snapshot
+            self._total_usernames += len(snapshot.usernames)
+            # the new snapshot is kept even if it is larger than the limit alone
+            while len(self._snapshots) > 1 and (
+                    len(self._snapshots) > self.max_snapshots or self._total_usernames > self.max_usernames):
+                _, dropped = self._snapshots.popitem(last=False)
+                self._total_usernames -= len(dropped.usernames)
+        return snapshot
+
+    def get(self, snapshot_id: str, chat_id: int) -> Optional[Snapshot]:
+        with self._lock:
+            snapshot = self._snapshots.get(snapshot_id)
+            if snapshot is None or snapshot.chat_id != chat_id:
+                return None
+            self._snapshots.move_to_end(snapshot_id)
+            return snapshot
+
+    def claim_page(self, snapshot: Snapshot, page: int) -> bool:
+        """Mark page as sent, return False if it was sent already."""
+        with self._lock:
+            if page in snapshot.sent_pages:
+                return False
+            snapshot.sent_pages.add(page)
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'snapshots': len(self._snapshots), 'usernames': self._total_usernames}
+
+
+def build_list_keyboard(snapshot: Snapshot, page: int, pages: int) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(
+            '« Prev', callback_data=build_callback_data(LIST, snapshot.snapshot_id, page - 1)))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(
+            'Next »', callback_data=build_callback_data(LIST, snapshot.snapshot_id, page + 1)))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def build_mention_keyboard(snapshot: Snapshot, page: int, pages: int) -> Optional[InlineKeyboardMarkup]:
+    if page + 1 >= pages:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        f'Mention next ({page + 2} of {pages}) »',
+        callback_data=build_callback_data(MENTION, snapshot.snapshot_id, page + 1),
+    )]])
+
+
+roster_snapshots = RosterSnapshots(
+    max_snapshots=settings.TGBOT_PAGE_SNAPSHOTS,
+    max_usernames=settings.TGBOT_PAGE_SNAPSHOT_USERNAMES,
+)
@@ -0,0 +1,239 @@
+"""
+Profiling sessions started at runtime by admins.
+
+Two modes are supported:
+* sampling - a background thread takes stacks of all threads every few milliseconds, which costs
+  almost nothing for handlers, and counts how often every function is seen on a stack;
+* updates - a given fraction of handler calls runs under cProfile, one call at a time,
+  which gives exact call counts and times of those calls.
+
+Aggregated profile is written into the data directory, and a top-N summary is returned as text.
+"""
+import collections
+import cProfile
+import datetime
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+from typing import Callable, Counter, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+SAMPLING = 'sampling'
+UPDATES = 'updates'
+
+_Frame = Tuple[str, int, str]
+""" Function of a stack frame: filename, first line number and name. """
+
+IDLE_FUNCTIONS = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'readinto'),
+}
+""" Innermost functions of threads waiting for work, their samples are counted as idle and not reported. """
+
+
+def _format_function(function: _Frame) -> str:
+    filename, line, name = function
+    return f'{os.path.basename(filename)}:{line}({name})'
+
+
+class ProfilingSession:
+    """A single profiling session, its results are aggregated in memory until it is stopped."""
+
+    def __init__(self, mode: str, seconds: float, fraction: float = 1.0, sample_interval: float = 0.005):
+        if mode not in (SAMPLING, UPDATES):
+            raise ValueError(f'Unknown profiling mode: {mode}')
+        self.mode = mode
+        self.seconds = seconds
+        self.fraction = fraction
+        self.sample_interval = sample_interval
+        self.started_at = datetime.datetime.now()
+        self.samples = 0
+        self.idle_samples = 0
+        self.profiled_calls = 0
+        self.skipped_calls = 0
+        # sampling mode: stack (outermost frame first) -> times seen
+        self._stacks: Counter[Tuple[_Frame, ...]] = collections.Counter()
+        # updates mode: merged cProfile statistics
+        self._stats: Optional[pstats.Stats] = None
+        # cProfile can not profile several threads at once, so sampled calls are profiled one at a time
+        self._profile_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.mode == SAMPLING:
+            self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self) -> None:
+        own_thread_id = threading.get_ident()
+        while not self._stopped.wait(self.sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if not stack or (os.path.basename(stack[0][0]), stack[0][2]) in IDLE_FUNCTIONS:
+                    self.idle_samples += 1
+                    continue
+                stack.reverse()
+                self._stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def run(self, callback: Callable, *args):
+        """Run callback, under cProfile if the call is sampled and no other call is being profiled."""
+        if random.random() >= self.fraction:
+            return callback(*args)
+        if not self._profile_lock.acquire(blocking=False):
+            self.skipped_calls += 1
+            return callback(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(callback, *args)
+            finally:
+                with self._stats_lock:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+                    self.profiled_calls += 1
+        finally:
+            self._profile_lock.release()
+
+    def save(self, directory: str) -> str:
+        """Write aggregated profile to the directory and return its path."""
+        os.makedirs(directory, exist_ok=True)
+        timestamp = self.started_at.strftime('%Y%m%d-%H%M%S')
+        if self.mode == SAMPLING:
+            # collapsed stacks, the input format of flame graph tools
+            path = os.path.join(directory, f'profile_{timestamp}.stacks')
+            with open(path, 'w') as fp:
+                for stack, count in self._stacks.most_common():
+                    fp.write(';'.join(_format_function(function) for function in stack) + f' {count}\n')
+        else:
+            # readable with `python -m pstats` and snakeviz
+            path = os.path.join(directory, f'profile_{timestamp}.pstats')
+            with self._stats_lock:
+                if self._stats is not None:
+                    self._stats.dump_stats(path)
+                else:
+                    open(path, 'wb').close()
+        return path
+
+    def summary(self, top: int) -> str:
+        """Return top functions by time as text."""
+        if self.mode == SAMPLING:
+            return self._sampling_summary(top)
+        return self._updates_summary(top)
+
+    def _sampling_summary(self, top: int) -> str:
+        # a function is counted once per stack, even if it is recursive
+        total = collections.Counter()
+        own = collections.Counter()
+        for stack, count in self._stacks.items():
+            for function in set(stack):
+                total[function] += count
+            own[stack[-1]] += count
+        busy_samples = sum(own.values())
+        lines = [f'{self.samples} samples of all threads every {self.sample_interval * 1000:g}ms, '
+                 f'{busy_samples} thread stacks were busy and {self.idle_samples} idle',
+                 f'{"own":>6} {"total":>6}  function']
+        samples = busy_samples or 1
+        for function, count in own.most_common(top):
+            lines.append(f'{count / samples:6.1%} {total[function] / samples:6.1%}  {_format_function(function)}')
+        return '\n'.join(lines)
+
+    def _updates_summary(self, top: int) -> str:
+        header = f'{self.profiled_calls} handler calls profiled, {self.skipped_calls} skipped while another one was'
+        with self._stats_lock:
+            if self._stats is None:
+                return header
+            stream = io.StringIO()
+            self._stats.stream = stream
+            # directories are stripped in place, so the summary is made after the profile is saved
+            self._stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        # skip the preamble with totals and the directory of stats files
+        lines = [line for line in stream.getvalue().splitlines() if line.strip()]
+        start = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+        return '\n'.join([header] + [line.strip() for line in lines[start:]])
+
+
+class Profiler:
+    """Holder of the current profiling session, at most one session runs at a time."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._session: Optional[ProfilingSession] = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> Optional[ProfilingSession]:
+        return self._session
+
+    def start(self, mode: str, seconds: float, fraction: float = 1.0,
+              sample_interval: float = 0.005) -> Optional[ProfilingSession]:
+        """Start a session and return it, or return None if another session is running."""
+        with self._lock:
+            if self._session is not None:
+                return None
+            session = ProfilingSession(mode=mode, seconds=seconds, fraction=fraction, sample_interval=sample_interval)
+            session.start()
+            self._session = session
+        logger.info(f'Started {mode} profiling for {seconds}s.')
+        return session
+
+    def stop(self, top: int, session: ProfilingSession = None) -> Optional[Tuple[str, str]]:
+        """
+        Stop current session, or only the given one if it is still current, save it and return its path and summary.
+        Return None if there is no such session.
+        """
+        with self._lock:
+            if self._session is None or (session is not None and self._session is not session):
+                return None
+            session, self._session = self._session, None
+        session.stop()
+        path = session.save(self.directory)
+        logger.info(f'Stopped {session.mode} profiling, profile is written to {path}.')
+        return path, session.summary(top)
+
+    def wrap(self, callback: Callable[[Update, CallbackContext], None]) -> Callable:
+        """Wrap handler callback so that its calls are profiled while an updates session is running."""
+
+        @functools.wraps(callback)
+        def wrapper(update: Update, context: CallbackContext) -> None:
+            session = self._session
+            if session is None or session.mode != UPDATES:
+                return callback(update, context)
+            return session.run(callback, update, context)
+
+        return wrapper
+
+
+profiler = Profiler(directory=settings.TGBOT_DATA_DIR)
+
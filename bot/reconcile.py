@@ -0,0 +1,193 @@
+"""
+Verification of remembered chat members with getChatMember.
+
+The bot only sees members joining and leaving while it tracks a chat, and members remembered
+with /remember have no user ID at all, so remembered members drift from real ones.
+A reconcile session checks remembered members of a chat in chunks, ordered by username:
+chunks are taken from and applied to chat data on the chat executor, serialized with handlers,
+and members of a chunk are checked by a shared pool of workers within a global rate limit.
+Progress is kept in chat data after every chunk, so an interrupted session continues where it stopped.
+"""
+import enum
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from . import concurrency
+from . import membership
+from . import settings
+from .outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+""" Attempts to check a member, when Telegram asks to retry later. """
+
+
+class CheckResult(str, enum.Enum):
+    PRESENT = 'present'
+    LEFT = 'left'
+    RENAMED = 'renamed'
+    UNVERIFIABLE = 'unverifiable'
+    ERROR = 'error'
+
+
+class MemberCheck(NamedTuple):
+    username: str
+    user_id: Optional[int]
+    result: CheckResult
+    # current username of renamed members, None if they removed their username
+    new_username: Optional[str] = None
+
+
+class _Session(NamedTuple):
+    chat_id: int
+    cancelled: threading.Event
+    thread: threading.Thread
+
+
+class Reconciler:
+    """
+    Run reconcile sessions, at most one per chat, with `workers` threads checking members
+    of all chats at most `rate` times per second together.
+    """
+
+    def __init__(self, workers: int, rate: float, chunk_size: int):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._bucket = TokenBucket(rate=rate, capacity=rate)
+        self._bucket_lock = threading.Lock()
+        self._paused_until = 0.0
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._sessions: Dict[int, _Session] = {}
+        self._lock = threading.Lock()
+
+    def is_running(self, chat_id: int) -> bool:
+        with self._lock:
+            return chat_id in self._sessions
+
+    def start(self, bot: Bot, chat_id: int,
+              take_chunk: Callable[[int], List[Tuple[str, Optional[int]]]],
+              apply_checks: Callable[[List[MemberCheck]], None],
+              finish: Callable[[bool], None]) -> bool:
+        """
+        Start a session of the chat, return False if one is running already.
+
+        `take_chunk(size)` returns next (username, user ID) pairs to check, or an empty list if all were checked,
+        `apply_checks(checks)` applies results and stores progress, and `finish(completed)` is called at the end
+        with `completed` False if the session was stopped. All of them run on the chat executor.
+        """
+        with self._lock:
+            if chat_id in self._sessions:
+                return False
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reconcile')
+            cancelled = threading.Event()
+            thread = threading.Thread(
+                target=self._run, args=(bot, chat_id, cancelled, take_chunk, apply_checks, finish),
+                name=f'reconcile-{chat_id}', daemon=True)
+            self._sessions[chat_id] = _Session(chat_id=chat_id, cancelled=cancelled, thread=thread)
+        thread.start()
+        return True
+
+    def stop(self, chat_id: int) -> bool:
+        """Stop session of the chat after its current chunk, return False if there is no session."""
+        with self._lock:
+            session = self._sessions.get(chat_id)
+        if session is None:
+            return False
+        session.cancelled.set()
+        return True
+
+    def stop_all(self) -> None:
+        """Stop all sessions and wait for them, unfinished chunks are checked again by the next session."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.cancelled.set()
+        for session in sessions:
+            session.thread.join()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _run(self, bot: Bot, chat_id: int, cancelled: threading.Event,
+             take_chunk: Callable, apply_checks: Callable, finish: Callable) -> None:
+        completed = False
+        try:
+            while not cancelled.is_set():
+                members = concurrency.chat_executor.call(chat_id, take_chunk, self.chunk_size).result()
+                if not members:
+                    completed = True
+                    break
+                checks = list(self._pool.map(
+                    lambda member: self.check_member(bot, chat_id, *member, cancelled=cancelled), members))
+                if cancelled.is_set():
+                    # some members were not checked, the chunk is checked again next time
+                    break
+                concurrency.chat_executor.call(chat_id, apply_checks, checks).result()
+        except Exception:
+            logger.exception(f'Reconcile of chat {chat_id} failed.')
+        finally:
+            with self._lock:
+                del self._sessions[chat_id]
+            try:
+                concurrency.chat_executor.call(chat_id, finish, completed).result()
+            except Exception:
+                logger.exception(f'Could not finish reconcile of chat {chat_id}.')
+
+    def _wait_for_call(self, cancelled: threading.Event) -> bool:
+        """Wait until a call is allowed by rate limit and take it, return False if session was cancelled."""
+        while not cancelled.is_set():
+            with self._bucket_lock:
+                now = time.monotonic()
+                delay = max(self._bucket.delay(now), self._paused_until - now)
+                if delay <= 0:
+                    self._bucket.take(now)
+                    return True
+            cancelled.wait(delay)
+        return False
+
+    def check_member(self, bot: Bot, chat_id: int, username: str, user_id: Optional[int],
+                     cancelled: threading.Event) -> MemberCheck:
+        if user_id is None:
+            return MemberCheck(username=username, user_id=None, result=CheckResult.UNVERIFIABLE)
+        for _ in range(MAX_ATTEMPTS):
+            if not self._wait_for_call(cancelled):
+                break
+            try:
+                chat_member = bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            except RetryAfter as error:
+                logger.warning(f'Flood limit while checking members, pausing for {error.retry_after} seconds.')
+                with self._bucket_lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + error.retry_after)
+                continue
+            except BadRequest as error:
+                # users who never were in the chat are not found
+                if 'user not found' in error.message.lower():
+                    return MemberCheck(username=username, user_id=user_id, result=CheckResult.LEFT)
+                logger.warning(f'Could not check member {user_id} of chat {chat_id}: {error.message}')
+                break
+            except TelegramError as error:
+                logger.warning(f'Could not check member {user_id} of chat {chat_id}: {error.message}')
+                break
+            if not membership.is_present(chat_member):
+                return MemberCheck(username=username, user_id=user_id, result=CheckResult.LEFT)
+            if chat_member.user.username != username:
+                return MemberCheck(username=username, user_id=user_id, result=CheckResult.RENAMED,
+                                   new_username=chat_member.user.username)
+            return MemberCheck(username=username, user_id=user_id, result=CheckResult.PRESENT)
+        return MemberCheck(username=username, user_id=user_id, result=CheckResult.ERROR)
+
+
+reconciler = Reconciler(
+    workers=settings.TGBOT_RECONCILE_WORKERS,
+    rate=settings.TGBOT_RECONCILE_RATE,
+    chunk_size=settings.TGBOT_RECONCILE_CHUNK_SIZE,
+)
@@ -0,0 +1,142 @@
+"""
+Daily presence reports scheduled per chat on the job queue.
+
+A report compares a roster, parsed once when the report is scheduled and kept in chat data,
+with remembered members, and mentions roster members who are missing.
+Reports of all chats scheduled for the same time are spread over `spread` seconds by chat ID,
+with up to `jitter` random seconds added to every run, so thousands of chats scheduled for the same hour
+do not load their data and queue their messages at the same moment.
+"""
+import datetime
+import logging
+import random
+import re
+import threading
+from typing import Callable, Dict, Optional
+
+import pytz
+from apscheduler.jobstores.base import JobLookupError
+from telegram.ext import CallbackContext, Dispatcher, Job, JobQueue
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+TIME_PATTERN = r'([01]?\d|2[0-3]):([0-5]\d)'
+""" Report time in UTC, HH:MM. """
+
+
+def parse_report_time(text: str) -> Optional[datetime.time]:
+    match = re.fullmatch(TIME_PATTERN, text)
+    if not match:
+        return None
+    return datetime.time(hour=int(match.group(1)), minute=int(match.group(2)))
+
+
+def spread_offset(chat_id: int, spread: float) -> float:
+    """Return seconds by which reports of the chat are delayed, the same for every run and evenly spread."""
+    # multiplicative hashing, so consecutive chat IDs are far apart in the spread window
+    return (chat_id * 2654435761) % 2 ** 32 / 2 ** 32 * spread
+
+
+def next_run(chat_id: int, report_time: datetime.time, now: datetime.datetime,
+             spread: float, jitter: float, rng: random.Random) -> datetime.datetime:
+    """Return UTC time of the next report of the chat after now."""
+    run_at = datetime.datetime.combine(now.date(), report_time, tzinfo=pytz.utc)
+    run_at += datetime.timedelta(seconds=spread_offset(chat_id, spread))
+    if run_at <= now:
+        run_at += datetime.timedelta(days=1)
+    return run_at + datetime.timedelta(seconds=rng.uniform(0, jitter))
+
+
+class ReportScheduler:
+    """
+    Keep one job per chat with a scheduled report, each job schedules the next run of its chat.
+
+    `send_report(dispatcher, chat_id)` is called by jobs when reports are due,
+    it is expected to hand the report over to the chat executor.
+    """
+
+    def __init__(self, spread: float, jitter: float, rng: random.Random = None):
+        self.spread = spread
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self._job_queue: Optional[JobQueue] = None
+        self._send_report: Optional[Callable[[Dispatcher, int], None]] = None
+        self._jobs: Dict[int, Job] = {}
+        self._lock = threading.Lock()
+
+    def start(self, job_queue: JobQueue, send_report: Callable[[Dispatcher, int], None],
+              schedules: Dict[int, datetime.time]) -> None:
+        """Schedule reports of chats by their report times."""
+        self._job_queue = job_queue
+        self._send_report = send_report
+        for chat_id, report_time in schedules.items():
+            self.schedule(chat_id=chat_id, report_time=report_time)
+        logger.info(f'Scheduled reports of {len(schedules)} chats')
+
+    def schedule(self, chat_id: int, report_time: datetime.time) -> Optional[datetime.datetime]:
+        """Schedule daily report of the chat instead of its current one, return time of the next run."""
+        if self._job_queue is None:
+            return None
+        run_at = next_run(
+            chat_id=chat_id,
+            report_time=report_time,
+            now=datetime.datetime.now(pytz.utc),
+            spread=self.spread,
+            jitter=self.jitter,
+            rng=self.rng,
+        )
+        with self._lock:
+            job = self._jobs.pop(chat_id, None)
+            if job is not None:
+                self._remove(job)
+            self._jobs[chat_id] = self._job_queue.run_once(
+                self._run, when=run_at, context=(chat_id, report_time), name=f'report-{chat_id}')
+        return run_at
+
+    def cancel(self, chat_id: int) -> bool:
+        """Cancel report of the chat, return False if it was not scheduled."""
+        with self._lock:
+            job = self._jobs.pop(chat_id, None)
+        if job is None:
+            return False
+        self._remove(job)
+        return True
+
+    @staticmethod
+    def _remove(job: Job) -> None:
+        try:
+            job.schedule_removal()
+        except JobLookupError:
+            # job has run already
+            pass
+
+    def next_run_of(self, chat_id: int) -> Optional[datetime.datetime]:
+        with self._lock:
+            job = self._jobs.get(chat_id)
+        return job.next_t if job is not None else None
+
+    def scheduled(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def stop(self) -> None:
+        """Forget scheduled reports, their jobs stop with the job queue."""
+        with self._lock:
+            self._jobs.clear()
+            self._job_queue = None
+
+    def _run(self, context: CallbackContext) -> None:
+        chat_id, report_time = context.job.context
+        with self._lock:
+            if self._jobs.get(chat_id) is not context.job:
+                # report was cancelled or rescheduled meanwhile
+                return
+            del self._jobs[chat_id]
+        # next run is scheduled first, so a failed report does not stop the schedule
+        self.schedule(chat_id=chat_id, report_time=report_time)
+        self._send_report(context.dispatcher, chat_id)
+
+
+report_scheduler = ReportScheduler(spread=settings.TGBOT_REPORT_SPREAD, jitter=settings.TGBOT_REPORT_JITTER)
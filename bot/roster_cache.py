@@ -0,0 +1,65 @@
+import collections
+import datetime
+import threading
+from typing import FrozenSet, Hashable, Optional, Tuple
+
+from telegram import Message
+
+from . import settings
+from .utils import extract_usernames_from_messages
+
+
+class RosterCache:
+    """
+    Usernames mentioned in recently checked roster messages, so repeated /check replies
+    to the same message do not parse its text again.
+
+    Messages are identified by chat ID, message ID and edit date, so an edited roster is parsed again.
+    Least recently used rosters are dropped when there are more than `max_size` of them, zero disables the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._rosters: 'collections.OrderedDict[Hashable, FrozenSet[str]]' = collections.OrderedDict()
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def build_key(message: Message) -> Tuple[int, int, Optional[datetime.datetime]]:
+        return message.chat_id, message.message_id, message.edit_date
+
+    def usernames(self, message: Optional[Message]) -> FrozenSet[str]:
+        """Return usernames mentioned in the message, or an empty set if message is None."""
+        if message is None:
+            return frozenset()
+        if not self.max_size:
+            return frozenset(extract_usernames_from_messages(message))
+
+        key = self.build_key(message)
+        with self._lock:
+            usernames = self._rosters.get(key)
+            if usernames is not None:
+                self._rosters.move_to_end(key)
+                self._counters['hits'] += 1
+                return usernames
+            self._counters['misses'] += 1
+
+        # parsed outside of the lock, a roster parsed twice concurrently is stored once
+        usernames = frozenset(extract_usernames_from_messages(message))
+        with self._lock:
+            self._rosters[key] = usernames
+            self._rosters.move_to_end(key)
+            while len(self._rosters) > self.max_size:
+                self._rosters.popitem(last=False)
+        return usernames
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rosters': len(self._rosters),
+                'hits': self._counters['hits'],
+                'misses': self._counters['misses'],
+            }
+
+
+roster_cache = RosterCache(max_size=settings.TGBOT_ROSTER_CACHE_SIZE)
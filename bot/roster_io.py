@@ -0,0 +1,84 @@
+"""
+Roster files: import of usernames from CSV or plain text files, and export of remembered members as CSV.
+
+Files are read and written row by row, so a roster of any size is never held in memory as text.
+"""
+import codecs
+import csv
+import io
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+from .models import MEMBER_ID
+from .utils import iter_text_usernames
+
+EXPORT_HEADER = ['username', 'user_id']
+
+ENCODING = 'utf-8-sig'
+""" Encoding of roster files, a byte order mark written by spreadsheet editors is skipped. """
+
+EXPORT_CHUNK_LENGTH = 64 * 1024
+""" Exported CSV rows are encoded and written into the file in chunks of about this many characters. """
+
+
+def _parse_username(cell: str) -> Optional[str]:
+    """Return username if the cell is a single username with or without "@", otherwise None."""
+    username = cell.strip().lstrip('@')
+    return username if next(iter_text_usernames(f'@{username}'), None) == username else None
+
+
+def iter_roster_members(lines: Iterable[str]) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Yield (username, user ID or None) from lines of a roster file, every username once.
+
+    A row which starts with a username (e.g. exported by /export, or one username per line) gives
+    that username and the user ID from the second column if there is one. From other rows,
+    every "@username" mentioned anywhere in the row is taken.
+    """
+    seen = set()
+    for row in csv.reader(lines):
+        if not row or row == EXPORT_HEADER:
+            continue
+        username = _parse_username(row[0])
+        if username is not None:
+            user_id = row[1].strip() if len(row) > 1 else ''
+            members = [(username, int(user_id) if user_id.isdigit() else None)]
+        else:
+            members = [(username, None) for username in iter_text_usernames(' '.join(row))]
+        for username, user_id in members:
+            if username not in seen:
+                seen.add(username)
+                yield username, user_id
+
+
+def iter_roster_file(fp: BinaryIO) -> Iterator[Tuple[str, Optional[int]]]:
+    """Yield members from a binary roster file, see `iter_roster_members`."""
+    # lines are decoded one by one, so the file only needs to be iterable
+    return iter_roster_members(codecs.iterdecode(fp, ENCODING, errors='replace'))
+
+
+def imported_member_data(stored: Optional[dict], user_id: Optional[int]) -> Optional[dict]:
+    """Return data of an imported member to store, or None if stored data of the member is up to date."""
+    if stored is None:
+        return {} if user_id is None else {MEMBER_ID: user_id}
+    if user_id is None or stored.get(MEMBER_ID) == user_id:
+        return None
+    return dict(stored, **{MEMBER_ID: user_id})
+
+
+def write_roster_csv(members: Dict[str, dict], fp: BinaryIO) -> int:
+    """
+    Write remembered members sorted by username into a binary file as CSV rows, return their number.
+    Rows are encoded by the chunk, so the file only needs `write` (not every file object can be wrapped into text).
+    """
+    chunk = io.StringIO()
+    writer = csv.writer(chunk)
+    writer.writerow(EXPORT_HEADER)
+    for username in sorted(members, key=str.lower):
+        user_id = members[username].get(MEMBER_ID)
+        writer.writerow([username, '' if user_id is None else user_id])
+        if chunk.tell() >= EXPORT_CHUNK_LENGTH:
+            fp.write(chunk.getvalue().encode())
+            chunk.seek(0)
+            chunk.truncate()
+    fp.write(chunk.getvalue().encode())
+    return len(members)
@@ -12,10 +12,142 @@ LOG_LEVEL = env.str('LOG_LEVEL', default='INFO')
 
 TGBOT_APIKEY = env.str('TGBOT_APIKEY')
 
+TGBOT_API_BASE_URL = env.str('TGBOT_API_BASE_URL', default=None)
+""" Bot API URL prefix, token is appended to it. Defaults to https://api.telegram.org/bot """
+
+TGBOT_DATA_DIR = env.str('TGBOT_DATA_DIR', default=os.path.join(BASE_DIR, 'bot_data'))
+
 TGBOT_ADMIN_USERNAMES = env.str('TGBOT_ADMIN_USERNAMES').replace('@', '').split(',')
 
-TGBOT_MAX_MENTIONS_PER_MESSAGE = 20
+TGBOT_MAX_MENTIONS_PER_MESSAGE = env.int('TGBOT_MAX_MENTIONS_PER_MESSAGE', default=20)
 """ Telegram sets limit to 50 mentions in one message, 
 otherwise notifications wont be sent.
 https://limits.tginfo.me/en
 """
+
+TGBOT_MAX_MESSAGE_LENGTH = 4096
+""" Telegram limit of message text length after entities parsing. """
+
+TGBOT_LIST_PAGE_SIZE = env.int('TGBOT_LIST_PAGE_SIZE', default=50)
+""" Usernames on a page of /list, other pages are shown with inline keyboard buttons. """
+
+TGBOT_PAGE_SNAPSHOTS = env.int('TGBOT_PAGE_SNAPSHOTS', default=1000)
+""" Number of recent /list and /mention_all rosters kept for their page buttons. """
+
+TGBOT_PAGE_SNAPSHOT_USERNAMES = env.int('TGBOT_PAGE_SNAPSHOT_USERNAMES', default=1000000)
+""" Maximum number of usernames in kept rosters together, buttons of dropped rosters answer that they expired. """
+
+TGBOT_STORAGE_FLUSH_INTERVAL = env.float('TGBOT_STORAGE_FLUSH_INTERVAL', default=5.0)
+""" Seconds between background writes of changed chat data.
+Set to 0 to write chat data synchronously on every change.
+"""
+
+TGBOT_STORAGE_BACKEND = env.str('TGBOT_STORAGE_BACKEND', default='json')
+""" Where chat data is stored: 
+"json" - one file per chat in bot_data directory,
+"sqlite" - single SQLite database with a row per chat member,
+"journal" - snapshot file per chat with an append-only journal of changes,
+"binary" - compact binary file per chat, existing JSON files are read if there is no binary one yet.
+"""
+
+TGBOT_SQLITE_PATH = env.str('TGBOT_SQLITE_PATH', default=os.path.join(TGBOT_DATA_DIR, 'bot-data.sqlite3'))
+
+TGBOT_JOURNAL_COMPACT_RECORDS = env.int('TGBOT_JOURNAL_COMPACT_RECORDS', default=1000)
+""" Number of journal records after which chat journal is folded into a new snapshot. """
+
+TGBOT_MANIFEST_SAVE_INTERVAL = env.float('TGBOT_MANIFEST_SAVE_INTERVAL', default=10.0)
+""" Minimum seconds between writes of the chats manifest (titles, enabled flags, member counts of all chats).
+New chats are added to the manifest file right away.
+"""
+
+TGBOT_UPDATE_QUEUE_SIZE = env.int('TGBOT_UPDATE_QUEUE_SIZE', default=1000)
+""" Maximum number of received updates waiting for the dispatcher. 
+Polling pauses and webhook responds with 503 (so Telegram retries later) while the queue is full.
+"""
+
+TGBOT_CHAT_CACHE_SIZE = env.int('TGBOT_CHAT_CACHE_SIZE', default=10000)
+""" Maximum number of chats kept in memory, least recently active chats are reloaded from storage when needed.
+0 means no limit.
+"""
+
+TGBOT_CHAT_CACHE_BYTES = env.int('TGBOT_CHAT_CACHE_BYTES', default=256 * 1024 * 1024)
+""" Approximate limit of memory taken by chats kept in memory, in bytes. 0 means no limit. """
+
+TGBOT_ROSTER_CACHE_SIZE = env.int('TGBOT_ROSTER_CACHE_SIZE', default=1000)
+""" Number of recently checked roster messages whose mentioned usernames are kept parsed, 0 disables it. """
+
+TGBOT_IMPORT_MAX_BYTES = env.int('TGBOT_IMPORT_MAX_BYTES', default=20 * 1024 * 1024)
+""" Largest roster file accepted by /import, Bot API does not let bots download files over 20 MB. """
+
+TGBOT_REPORT_SPREAD = env.float('TGBOT_REPORT_SPREAD', default=900.0)
+""" Seconds over which daily reports of chats scheduled for the same time are spread, by chat ID. """
+
+TGBOT_REPORT_JITTER = env.float('TGBOT_REPORT_JITTER', default=60.0)
+""" Maximum random delay of every daily report in seconds, on top of its spread. """
+
+TGBOT_MEMBERSHIP_BATCH_WINDOW = env.float('TGBOT_MEMBERSHIP_BATCH_WINDOW', default=1.0)
+""" Seconds to collect members joining and leaving a chat before chat data is updated and saved once.
+Set to 0 to apply every event right away.
+"""
+
+TGBOT_RECONCILE_WORKERS = env.int('TGBOT_RECONCILE_WORKERS', default=4)
+""" Threads checking remembered members with getChatMember during /reconcile, shared by all chats. """
+
+TGBOT_RECONCILE_RATE = env.float('TGBOT_RECONCILE_RATE', default=20.0)
+""" Maximum getChatMember calls per second made by /reconcile in all chats together. """
+
+TGBOT_RECONCILE_CHUNK_SIZE = env.int('TGBOT_RECONCILE_CHUNK_SIZE', default=200)
+""" Members checked between updates of chat data, progress of /reconcile is saved after every chunk. """
+
+TGBOT_METRICS_LISTEN = env.str('TGBOT_METRICS_LISTEN', default='127.0.0.1')
+TGBOT_METRICS_PORT = env.int('TGBOT_METRICS_PORT', default=0)
+""" Port of HTTP endpoint serving metrics in Prometheus text format at /metrics, 0 disables it.
+In supervisor mode, worker N listens on TGBOT_METRICS_PORT + N.
+"""
+
+TGBOT_PROFILE_SECONDS = env.float('TGBOT_PROFILE_SECONDS', default=30.0)
+""" Default duration of profiling sessions started with /profile command. """
+
+TGBOT_PROFILE_SAMPLE_INTERVAL = env.float('TGBOT_PROFILE_SAMPLE_INTERVAL', default=0.005)
+""" Seconds between stack samples of the sampling profiler. """
+
+TGBOT_PROFILE_TOP = env.int('TGBOT_PROFILE_TOP', default=20)
+""" Number of functions in profile summary sent to the chat, the whole profile is written to TGBOT_DATA_DIR. """
+
+TGBOT_WEBHOOK_LISTEN = env.str('TGBOT_WEBHOOK_LISTEN', default='127.0.0.1')
+TGBOT_WEBHOOK_PORT = env.int('TGBOT_WEBHOOK_PORT', default=8080)
+TGBOT_WEBHOOK_PATH = env.str('TGBOT_WEBHOOK_PATH', default='/webhook')
+
+TGBOT_WEBHOOK_URL = env.str('TGBOT_WEBHOOK_URL', default=None)
+""" Public URL of the webhook, passed to Telegram with setWebhook on start.
+Leave it empty if webhook is registered elsewhere, e.g. when several bot instances are behind a load balancer.
+"""
+
+TGBOT_WEBHOOK_SECRET_TOKEN = env.str('TGBOT_WEBHOOK_SECRET_TOKEN', default=None)
+""" Updates without this value in X-Telegram-Bot-Api-Secret-Token header are rejected. """
+
+TGBOT_WEBHOOK_MAX_CONNECTIONS = env.int('TGBOT_WEBHOOK_MAX_CONNECTIONS', default=40)
+""" Maximum number of simultaneous connections Telegram opens to the webhook, 1-100. """
+
+TGBOT_WORKERS = env.int('TGBOT_WORKERS', default=8)
+""" Number of threads that run handlers. 
+Updates of the same chat are processed one at a time in order, different chats are processed in parallel.
+"""
+
+TGBOT_SHARDS = env.int('TGBOT_SHARDS', default=2)
+""" Number of worker processes in supervisor mode (start_sharded.py), chats are split between them by ID.
+Changing it moves chats to other workers, which is fine for per-chat storage files,
+but requires merging per-shard databases of "sqlite" storage backend.
+"""
+
+TGBOT_SEND_RATE = env.float('TGBOT_SEND_RATE', default=30)
+""" Maximum number of queued messages sent per second to all chats. 
+Telegram allows about 30 messages per second in total.
+https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+"""
+
+TGBOT_CHAT_SEND_RATE = env.float('TGBOT_CHAT_SEND_RATE', default=20)
+""" Maximum number of queued messages sent per minute to one chat, Telegram allows 20 in groups. """
+
+TGBOT_CHAT_SEND_BURST = env.int('TGBOT_CHAT_SEND_BURST', default=5)
+""" Number of queued messages which can be sent to a chat at once, before per-chat rate applies. """
@@ -0,0 +1,230 @@
+"""
+Supervisor mode: one intake process receives updates and routes them by chat to worker processes.
+
+Every worker runs the usual dispatcher and handlers for its shard of chats,
+so chat data of a chat is only ever read and written by a single process.
+"""
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+from typing import List, Optional
+
+from telegram import Bot
+from telegram.error import TelegramError
+
+from . import settings
+from .webhook import ALLOWED_UPDATES, QUEUE_TIMEOUT, WebhookServer, register_webhook
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=settings.LOG_LEVEL,
+)
+logger = logging.getLogger(__name__)
+
+WORKER_STOP = None
+""" Sentinel put into worker queue to stop worker after updates queued before it. """
+
+POLLING_TIMEOUT = 10
+
+WORKER_START_TIMEOUT = 60
+
+_CHAT_UPDATE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                       'my_chat_member', 'chat_member')
+
+
+def extract_chat_id(data: dict) -> Optional[int]:
+    """Return ID of the chat update belongs to, or user ID for updates without chat."""
+    for field in _CHAT_UPDATE_FIELDS:
+        if field in data:
+            return data[field]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query:
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return None
+
+
+def run_worker(shard: int, updates: multiprocessing.Queue, ready: threading.Event) -> None:
+    """Process updates of one shard until stop sentinel is received."""
+    # supervisor decides when workers stop, Ctrl-C in terminal is delivered to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from telegram import Update
+    from . import main, storage
+
+    storage.set_backend(storage.build_backend(shard=shard), shard=shard)
+    updater = main.build_updater()
+    dispatcher = updater.dispatcher
+
+    main.start_background_tasks(shard=shard, job_queue=updater.job_queue)
+    updater.job_queue.start()
+    ready.set()
+    logger.info(f'Worker {shard} started')
+
+    while True:
+        data = updates.get()
+        if data is WORKER_STOP:
+            break
+        dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+
+    updater.job_queue.stop()
+    main.stop_background_tasks()
+    logger.info(f'Worker {shard} stopped')
+
+
+class Supervisor:
+    """Start worker processes, route updates to them and restart them."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self._ready_events: List[Optional[threading.Event]] = [None] * workers
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def _start_worker(self, shard: int) -> None:
+        ready = self._context.Event()
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self._queues[shard], ready),
+            name=f'worker-{shard}',
+        )
+        process.start()
+        self._processes[shard] = process
+        self._ready_events[shard] = ready
+
+    def start(self) -> None:
+        for shard in range(len(self._queues)):
+            self._start_worker(shard)
+
+    def route(self, data: dict, timeout: float = None) -> bool:
+        """Put update into queue of its shard. Return False if the queue stays full for timeout seconds."""
+        chat_id = extract_chat_id(data)
+        shard = chat_id % len(self._queues) if chat_id is not None else 0
+        try:
+            self._queues[shard].put(data, timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def restart_worker(self, shard: int) -> None:
+        """
+        Stop worker after it processes already queued updates, and start a new one on the same queue.
+        Updates received meanwhile wait in the queue. Return when the new worker is ready.
+        """
+        with self._lock:
+            process = self._processes[shard]
+            if process is not None and process.is_alive():
+                self._queues[shard].put(WORKER_STOP)
+                process.join()
+            self._start_worker(shard)
+            if not self._ready_events[shard].wait(WORKER_START_TIMEOUT):
+                logger.error(f'Worker {shard} did not start in {WORKER_START_TIMEOUT} seconds')
+                return
+            logger.info(f'Worker {shard} restarted')
+
+    def restart_all(self) -> None:
+        """Restart workers one by one, so other shards keep processing updates."""
+        for shard in range(len(self._queues)):
+            self.restart_worker(shard)
+
+    def watch(self) -> None:
+        """Start a new worker in place of every worker that exited unexpectedly."""
+        with self._lock:
+            if self._stopping:
+                return
+            for shard, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f'Worker {shard} exited with code {process.exitcode}, starting a new one')
+                    self._start_worker(shard)
+
+    def stop(self) -> None:
+        """Stop all workers after they process queued updates."""
+        with self._lock:
+            self._stopping = True
+            for updates in self._queues:
+                updates.put(WORKER_STOP)
+            for process in self._processes:
+                if process is not None:
+                    process.join()
+
+
+def _poll_updates(bot: Bot, supervisor: Supervisor, stop_event: threading.Event) -> None:
+    """Receive updates with getUpdates and route them without decoding into Update objects."""
+    bot.delete_webhook()
+    offset = 0
+    parameters = {'timeout': POLLING_TIMEOUT, 'allowed_updates': ALLOWED_UPDATES}
+    while not stop_event.is_set():
+        try:
+            updates = bot.request.post(
+                f'{bot.base_url}/getUpdates',
+                {'offset': offset, **parameters},
+                timeout=POLLING_TIMEOUT + 5,
+            )
+        except TelegramError:
+            logger.exception('Could not get updates')
+            stop_event.wait(1)
+            continue
+        for data in updates:
+            offset = data['update_id'] + 1
+            supervisor.route(data)
+
+
+def main_sharded(intake: str = 'polling') -> None:
+    """Start supervisor with TGBOT_SHARDS worker processes and receive updates with polling or webhook."""
+    supervisor = Supervisor(workers=settings.TGBOT_SHARDS, queue_size=settings.TGBOT_UPDATE_QUEUE_SIZE)
+    supervisor.start()
+
+    stop_event = threading.Event()
+    restart_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop_event.set())
+    # SIGHUP restarts workers, e.g. to pick up new code
+    signal.signal(signal.SIGHUP, lambda *args: restart_event.set())
+
+    bot = Bot(settings.TGBOT_APIKEY, base_url=settings.TGBOT_API_BASE_URL)
+    if intake == 'webhook':
+        server = WebhookServer(
+            listen=settings.TGBOT_WEBHOOK_LISTEN,
+            port=settings.TGBOT_WEBHOOK_PORT,
+            path=settings.TGBOT_WEBHOOK_PATH,
+            secret_token=settings.TGBOT_WEBHOOK_SECRET_TOKEN,
+            handle_update=lambda data: supervisor.route(data, timeout=QUEUE_TIMEOUT),
+        )
+        server.start()
+        if settings.TGBOT_WEBHOOK_URL:
+            register_webhook(
+                bot=bot,
+                url=settings.TGBOT_WEBHOOK_URL,
+                secret_token=settings.TGBOT_WEBHOOK_SECRET_TOKEN,
+                max_connections=settings.TGBOT_WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        intake_thread = None
+    elif intake == 'polling':
+        server = None
+        intake_thread = threading.Thread(
+            target=_poll_updates, args=(bot, supervisor, stop_event), name='intake', daemon=True)
+        intake_thread.start()
+    else:
+        raise ValueError(f'Unknown intake: {intake}')
+
+    while not stop_event.wait(1):
+        if restart_event.is_set():
+            restart_event.clear()
+            supervisor.restart_all()
+        supervisor.watch()
+
+    if server is not None:
+        server.stop()
+    if intake_thread is not None:
+        intake_thread.join(POLLING_TIMEOUT + 5)
+    supervisor.stop()
@@ -0,0 +1,192 @@
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Set
+
+from . import metrics
+from .storage import MEMBERS_BY_USERNAME, TGBOT_DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    chat_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    user_id INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, username)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS members_user_id ON members (user_id);
+'''
+
+
+class SqliteStorage:
+    """
+    Storage backend that keeps all chats in a single SQLite database.
+
+    Chat data without members is stored as JSON in `chats` table,
+    and every member is a separate row in `members` table, so changed members are written one row at a time.
+    Chats written within `write_batch` are committed together, each one in its own savepoint.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._digests: Dict[int, bytes] = {}
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return connection of current thread, so threads do not wait for each other on a shared connection."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            # journals of savepoints in batched writes are kept in memory, not in temporary files
+            connection.execute('PRAGMA temp_store=MEMORY')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def write_batch(self) -> Iterator[None]:
+        """Commit chats written by this thread inside the block in one transaction, instead of one per chat."""
+        connection = self._connection()
+        self._local.batch_digests = {}
+        try:
+            with connection:
+                connection.execute('BEGIN')
+                yield
+            # chats are known to be written only once they are committed
+            self._digests.update(self._local.batch_digests)
+        finally:
+            self._local.batch_digests = None
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write a chat in its own transaction, or in a savepoint of the current batch."""
+        connection = self._connection()
+        if getattr(self._local, 'batch_digests', None) is None:
+            with connection:
+                yield connection
+            return
+        connection.execute('SAVEPOINT chat')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK TO chat')
+            raise
+        finally:
+            connection.execute('RELEASE chat')
+
+    def load(self, chat_id: int or str) -> dict:
+        connection = self._connection()
+        row = connection.execute('SELECT data FROM chats WHERE chat_id = ?', (int(chat_id),)).fetchone()
+        if row is None:
+            return {}
+        chat_data = json.loads(row[0])
+        members = chat_data[MEMBERS_BY_USERNAME] = {}
+        size = len(row[0])
+        for username, data in connection.execute('SELECT username, data FROM members WHERE chat_id = ?',
+                                                 (int(chat_id),)):
+            members[username] = json.loads(data)
+            size += len(username) + len(data)
+        metrics.storage_bytes.inc(size, operation='read')
+        return chat_data
+
+    def write(self, chat_id: int or str, chat_data: dict, changed_usernames: Optional[Set[str]]) -> bool:
+        """
+        Write chat row if it changed and rows of changed members.
+        If changed usernames are not known, replace all member rows of the chat.
+        Return True if anything was written.
+        """
+        chat_id = int(chat_id)
+        members = chat_data.get(MEMBERS_BY_USERNAME, {})
+        content = json.dumps({key: value for key, value in chat_data.items() if key != MEMBERS_BY_USERNAME})
+        digest = hashlib.sha1(content.encode()).digest()
+
+        if changed_usernames is None:
+            member_rows = [self._build_member_row(chat_id, username, user_data)
+                           for username, user_data in list(members.items()) if username is not None]
+            removed_usernames = []
+        else:
+            member_rows = []
+            removed_usernames = []
+            for username in changed_usernames:
+                if username is None:
+                    # users without username can not be stored as member rows
+                    continue
+                user_data = members.get(username)
+                if user_data is None:
+                    removed_usernames.append((chat_id, username))
+                else:
+                    member_rows.append(self._build_member_row(chat_id, username, user_data))
+
+        chat_changed = self._digests.get(chat_id) != digest
+        if not (chat_changed or member_rows or removed_usernames or changed_usernames is None):
+            return False
+
+        with self._transaction() as connection:
+            if chat_changed:
+                connection.execute(
+                    'INSERT INTO chats (chat_id, data) VALUES (?, ?) '
+                    'ON CONFLICT (chat_id) DO UPDATE SET data = excluded.data',
+                    (chat_id, content),
+                )
+            if changed_usernames is None:
+                connection.execute('DELETE FROM members WHERE chat_id = ?', (chat_id,))
+            connection.executemany('DELETE FROM members WHERE chat_id = ? AND username = ?', removed_usernames)
+            connection.executemany(
+                'INSERT INTO members (chat_id, username, user_id, data) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (chat_id, username) DO UPDATE SET user_id = excluded.user_id, data = excluded.data',
+                member_rows,
+            )
+        metrics.storage_bytes.inc(
+            (len(content) if chat_changed else 0) + sum(len(row[1]) + len(row[3]) for row in member_rows),
+            operation='write',
+        )
+        batch_digests = getattr(self._local, 'batch_digests', None)
+        (self._digests if batch_digests is None else batch_digests)[chat_id] = digest
+        return True
+
+    def iter_chat_ids(self) -> Iterable[int]:
+        return [chat_id for chat_id, in self._connection().execute('SELECT chat_id FROM chats')]
+
+    @staticmethod
+    def _build_member_row(chat_id: int, username: str, user_data: dict) -> tuple:
+        return chat_id, username, user_data.get('id'), json.dumps(user_data)
+
+    def close(self) -> None:
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+def import_json_chat_data(backend: SqliteStorage, data_dir: str = TGBOT_DATA_DIR) -> int:
+    """Import all chat-data_<id>.json files from data directory. Return number of imported chats."""
+    imported = 0
+    for filename in sorted(glob.glob(os.path.join(data_dir, 'chat-data_*.json'))):
+        match = re.fullmatch(r'chat-data_(-?\d+)\.json', os.path.basename(filename))
+        if not match:
+            continue
+        with open(filename) as fp:
+            chat_data = json.load(fp)
+        backend.write(chat_id=int(match.group(1)), chat_data=chat_data, changed_usernames=None)
+        imported += 1
+        logger.info(f'Imported {filename}')
+    return imported
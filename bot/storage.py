@@ -1,24 +1,507 @@
+import contextlib
+import hashlib
+import itertools
 import json
+import logging
 import os
+import re
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 
+from . import metrics
 from . import settings
 
-TGBOT_DATA_DIR = os.path.join(settings.BASE_DIR, 'bot_data')
+logger = logging.getLogger(__name__)
+
+TGBOT_DATA_DIR = settings.TGBOT_DATA_DIR
+
+MEMBERS_BY_USERNAME = 'members_by_username'
+""" Chat data key of members mapping, stored separately by backends that support per-member writes. """
+
+MANIFEST_VERSION = 2
 
 
 def build_chat_data_filename(chat_id: str or int) -> str:
     return os.path.join(TGBOT_DATA_DIR, f'chat-data_{chat_id}.json')
 
 
-def save_chat_data(chat_id: int or str, chat_data: dict) -> None:
-    filename = build_chat_data_filename(chat_id=chat_id)
-    with open(filename, 'w') as fp:
-        json.dump(chat_data, fp)
+def build_manifest_filename(shard: int = None) -> str:
+    if shard is None:
+        return os.path.join(TGBOT_DATA_DIR, 'chats-manifest.json')
+    return os.path.join(TGBOT_DATA_DIR, f'chats-manifest_shard{shard}.json')
 
 
-def restore_chat_data(chat_id: int or str) -> dict:
+def list_data_dir_chat_ids(filename_pattern: str) -> Set[int]:
+    """Return chat IDs from names of data directory files matching the pattern with a single chat ID group."""
+    if not os.path.isdir(TGBOT_DATA_DIR):
+        return set()
+    chat_ids = set()
+    for filename in os.listdir(TGBOT_DATA_DIR):
+        match = re.fullmatch(filename_pattern, filename)
+        if match:
+            chat_ids.add(int(match.group(1)))
+    return chat_ids
+
+
+def _write_atomically(filename: str, content: str or bytes) -> None:
+    """
+    Write content into a temporary file in the same directory and move it over filename,
+    so readers never see a partially written file.
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def load_chat_data_file(chat_id: int or str) -> dict:
+    """Return chat data from its JSON file, or empty dict if there is no such file."""
     filename = build_chat_data_filename(chat_id=chat_id)
     if not os.path.exists(filename):
         return {}
-    with open(filename) as fp:
-        return json.load(fp)
+    with open(filename, 'rb') as fp:
+        content = fp.read()
+    metrics.storage_bytes.inc(len(content), operation='read')
+    return json.loads(content)
+
+
+class JsonStorage:
+    """Storage backend that keeps one JSON file per chat in data directory."""
+
+    def __init__(self):
+        self._digests: Dict[int or str, bytes] = {}
+
+    def load(self, chat_id: int or str) -> dict:
+        return load_chat_data_file(chat_id=chat_id)
+
+    def iter_chat_ids(self) -> Iterable[int]:
+        return list_data_dir_chat_ids(r'chat-data_(-?\d+)\.json')
+
+    def write(self, chat_id: int or str, chat_data: dict, changed_usernames: Optional[Set[str]]) -> bool:
+        """
+        Write chat data unless it is identical to the last written one. Return True if file was written.
+        Whole file is rewritten, so changed usernames are ignored.
+        """
+        content = json.dumps(chat_data).encode()
+        digest = hashlib.sha1(content).digest()
+        if self._digests.get(chat_id) == digest:
+            return False
+        _write_atomically(build_chat_data_filename(chat_id=chat_id), content)
+        metrics.storage_bytes.inc(len(content), operation='write')
+        self._digests[chat_id] = digest
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+class ChatManifestEntry(NamedTuple):
+    title: Optional[str]
+    enabled: Optional[bool]
+    members: int
+    # daily report time HH:MM, None if chat has no scheduled report
+    report_time: Optional[str]
+    # Unix time of the last write of chat data, None if chat was not written since the manifest was rebuilt
+    modified: Optional[float]
+
+
+def build_manifest_entry(chat_data: dict, modified: Optional[float]) -> ChatManifestEntry:
+    from .models import ENABLED, REPORT, REPORT_TIME, TITLE
+    return ChatManifestEntry(
+        title=chat_data.get(TITLE),
+        enabled=chat_data.get(ENABLED),
+        members=len(chat_data.get(MEMBERS_BY_USERNAME, {})),
+        report_time=(chat_data.get(REPORT) or {}).get(REPORT_TIME),
+        modified=modified,
+    )
+
+
+class ChatManifest:
+    """
+    Metadata of all stored chats kept in a single small file, so startup and operations over all chats
+    do not have to list and load every chat.
+
+    Entries are updated when chat data is written, and the file is rewritten at most every `save_interval`
+    seconds, or right away when a new chat is added. A missing manifest, or one written for another backend
+    or number of shards, is rebuilt once by loading all chats accepted by `chat_filter`.
+    """
+
+    def __init__(self, filename: str, save_interval: float, chat_filter: Callable[[int], bool] = None,
+                 key: dict = None):
+        self.filename = filename
+        self.save_interval = save_interval
+        self.chat_filter = chat_filter
+        # storage the manifest was built for, manifest of other storage is rebuilt
+        self.key = key or {}
+        self._entries: Dict[int, ChatManifestEntry] = {}
+        self._loaded = False
+        self._dirty = False
+        # a chat was added, so the file is written without waiting for save interval
+        self._urgent = False
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self, backend) -> None:
+        """Read manifest file, or rebuild it from chats in backend. Does nothing if manifest is loaded already."""
+        with self._lock:
+            if self._loaded:
+                return
+            entries = self._read()
+            if entries is None:
+                entries = self._rebuild(backend)
+                self._dirty = self._urgent = True
+            # chats written before the manifest was loaded are more recent than the file
+            entries.update(self._entries)
+            self._entries = entries
+            self._loaded = True
+
+    def _read(self) -> Optional[Dict[int, ChatManifestEntry]]:
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename, 'rb') as fp:
+                content = json.loads(fp.read())
+        except (OSError, ValueError):
+            logger.exception('Could not read chats manifest, it will be rebuilt.')
+            return None
+        if content.get('version') != MANIFEST_VERSION or content.get('key') != self.key:
+            logger.info('Chats manifest was written for other storage, it will be rebuilt.')
+            return None
+        return {int(chat_id): ChatManifestEntry(**entry) for chat_id, entry in content['chats'].items()}
+
+    def _rebuild(self, backend) -> Dict[int, ChatManifestEntry]:
+        started_at = time.monotonic()
+        entries = {}
+        for chat_id in backend.iter_chat_ids():
+            if self.chat_filter is not None and not self.chat_filter(chat_id):
+                continue
+            try:
+                chat_data = backend.load(chat_id=chat_id)
+            except Exception:
+                logger.exception(f'Could not add chat {chat_id} to manifest.')
+                continue
+            if chat_data:
+                entries[int(chat_id)] = build_manifest_entry(chat_data, modified=None)
+        logger.info(f'Rebuilt chats manifest of {len(entries)} chats in {time.monotonic() - started_at:.2f} seconds')
+        return entries
+
+    def update(self, chat_id: int or str, chat_data: dict) -> None:
+        """Update entry of the chat after its data was written."""
+        entry = build_manifest_entry(chat_data, modified=time.time())
+        with self._lock:
+            chat_id = int(chat_id)
+            if chat_id not in self._entries:
+                self._urgent = True
+            self._entries[chat_id] = entry
+            self._dirty = True
+
+    def get(self, chat_id: int or str) -> Optional[ChatManifestEntry]:
+        with self._lock:
+            return self._entries.get(int(chat_id))
+
+    def items(self) -> List[Tuple[int, ChatManifestEntry]]:
+        with self._lock:
+            return list(self._entries.items())
+
+    def save(self, backend, force: bool = False) -> bool:
+        """Write manifest file if it changed and save interval passed, or force is True. Return True if written."""
+        self.load(backend)
+        with self._lock:
+            if not self._dirty:
+                return False
+            if not (force or self._urgent or time.monotonic() - self._saved_at >= self.save_interval):
+                return False
+            content = json.dumps({
+                'version': MANIFEST_VERSION,
+                'key': self.key,
+                'chats': {str(chat_id): entry._asdict() for chat_id, entry in self._entries.items()},
+            })
+            _write_atomically(self.filename, content)
+            metrics.storage_bytes.inc(len(content), operation='write')
+            self._dirty = self._urgent = False
+            self._saved_at = time.monotonic()
+        return True
+
+
+def build_manifest(backend, shard: int = None) -> ChatManifest:
+    """Create manifest of chats in backend, or only of chats of given shard in supervisor mode."""
+    return ChatManifest(
+        filename=build_manifest_filename(shard=shard),
+        save_interval=settings.TGBOT_MANIFEST_SAVE_INTERVAL,
+        chat_filter=None if shard is None else lambda chat_id: chat_id % settings.TGBOT_SHARDS == shard,
+        key={'backend': type(backend).__name__, 'shards': None if shard is None else settings.TGBOT_SHARDS},
+    )
+
+
+def _changed_during_iteration(error: Exception) -> bool:
+    """Return True if error was raised by iterating over a dict or set which a handler changed meanwhile."""
+    return isinstance(error, RuntimeError) and 'changed' in str(error) and 'during iteration' in str(error)
+
+
+class ChatDataWriter:
+    """
+    Write-behind buffer for chat data.
+
+    Chats are marked as dirty by handlers and written by a background thread every `interval` seconds,
+    so a burst of updates in one chat results in a single write.
+    Usernames of changed members are collected between writes, so backends can write only changed members.
+    Backends with `write_batch()` context manager write all chats of a flush inside it, e.g. in one transaction.
+    Entries of written chats are updated in the manifest, which is saved after them.
+    """
+
+    def __init__(self, backend, interval: float, manifest: ChatManifest):
+        self.backend = backend
+        self.interval = interval
+        self.manifest = manifest
+        # chat ID -> (chat data, generation of the latest change)
+        self._dirty: Dict[int or str, Tuple[dict, int]] = {}
+        # chat ID -> usernames of changed members, or None if whole chat data must be written
+        self._member_changes: Dict[int or str, Optional[Set[str]]] = {}
+        self._generations = itertools.count()
+        # chat ID -> number of flushes in a row which found chat data changed while writing it
+        self._retries: Dict[int or str, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def mark_dirty(self, chat_id: int or str, chat_data: dict, full: bool = False) -> None:
+        with self._lock:
+            self._dirty[chat_id] = (chat_data, next(self._generations))
+            if full:
+                self._member_changes[chat_id] = None
+
+    def note_member_change(self, chat_id: int or str, username: str) -> None:
+        with self._lock:
+            changed_usernames = self._member_changes.setdefault(chat_id, set())
+            if changed_usernames is not None:
+                changed_usernames.add(username)
+
+    def _restore_member_changes(self, chat_id: int or str, changed_usernames: Optional[Set[str]]) -> None:
+        """Put back member changes that were not written."""
+        with self._lock:
+            if chat_id not in self._member_changes:
+                self._member_changes[chat_id] = changed_usernames
+            elif changed_usernames is None or self._member_changes[chat_id] is None:
+                self._member_changes[chat_id] = None
+            else:
+                self._member_changes[chat_id].update(changed_usernames)
+
+    def pending(self, chat_id: int or str) -> Optional[dict]:
+        """Return chat data that is not written yet, or None."""
+        with self._lock:
+            entry = self._dirty.get(chat_id)
+        return entry[0] if entry else None
+
+    def flush(self, chat_id: int or str = None) -> int:
+        """Write all dirty chats, or only given one. Return number of written files."""
+        with self._flush_lock:
+            with self._lock:
+                if chat_id is None:
+                    entries = list(self._dirty.items())
+                else:
+                    entries = [(chat_id, self._dirty[chat_id])] if chat_id in self._dirty else []
+                member_changes = {chat_id: self._member_changes.pop(chat_id, set()) for chat_id, _ in entries}
+            # chat ID -> (chat data, generation, whether anything was written) of chats written in this flush
+            done = {}
+            write_batch = getattr(self.backend, 'write_batch', contextlib.nullcontext)
+            try:
+                with write_batch():
+                    for chat_id, (chat_data, generation) in entries:
+                        started_at = time.perf_counter()
+                        try:
+                            changed = self.backend.write(
+                                chat_id=chat_id,
+                                chat_data=chat_data,
+                                changed_usernames=member_changes[chat_id],
+                            )
+                        except Exception as error:
+                            self._restore_member_changes(chat_id=chat_id, changed_usernames=member_changes[chat_id])
+                            if _changed_during_iteration(error):
+                                # chat data was changed by a handler while being serialized - retry on next flush
+                                retries = self._retries[chat_id] = self._retries.get(chat_id, 0) + 1
+                                logger.warning(f'Data of chat {chat_id} changed while being written, '
+                                               f'retrying on next flush ({retries} in a row).')
+                                metrics.storage_write_retries_total.inc()
+                            else:
+                                logger.exception(f'Could not write data of chat {chat_id}.')
+                                metrics.errors_total.inc(source='storage')
+                            continue
+                        finally:
+                            metrics.storage_duration.observe(time.perf_counter() - started_at, operation='write')
+                        self._retries.pop(chat_id, None)
+                        done[chat_id] = (chat_data, generation, changed)
+            except Exception:
+                # nothing of the batch was written, all its chats stay dirty
+                logger.exception(f'Could not write data of {len(done)} chats.')
+                metrics.errors_total.inc(source='storage')
+                for chat_id in done:
+                    self._restore_member_changes(chat_id=chat_id, changed_usernames=member_changes[chat_id])
+                return 0
+            for chat_id, (chat_data, generation, changed) in done.items():
+                if changed:
+                    self.manifest.update(chat_id=chat_id, chat_data=chat_data)
+                with self._lock:
+                    # keep chat dirty if it was changed again while being written
+                    if self._dirty.get(chat_id, (None, None))[1] == generation:
+                        del self._dirty[chat_id]
+            self._save_manifest()
+            return sum(1 for _, _, changed in done.values() if changed)
+
+    def _save_manifest(self, force: bool = False) -> None:
+        try:
+            self.manifest.save(backend=self.backend, force=force)
+        except Exception:
+            logger.exception('Could not write chats manifest.')
+            metrics.errors_total.inc(source='storage')
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='chat-data-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop background thread and write everything that is left."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._save_manifest(force=True)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Chat data flush failed.')
+
+
+def build_backend(name: str = settings.TGBOT_STORAGE_BACKEND, shard: int = None):
+    """
+    Create storage backend by name.
+    Backends that keep many chats in one file use a separate file per shard if shard is given,
+    so sharded worker processes never write the same file.
+    """
+    if name == 'json':
+        return JsonStorage()
+    elif name == 'sqlite':
+        from .sqlite_storage import SqliteStorage
+        path = settings.TGBOT_SQLITE_PATH
+        if shard is not None:
+            root, ext = os.path.splitext(path)
+            path = f'{root}_shard{shard}{ext}'
+        return SqliteStorage(path=path)
+    elif name == 'binary':
+        from .binary_storage import BinaryStorage
+        return BinaryStorage()
+    elif name == 'journal':
+        from .journal_storage import JournalStorage
+        return JournalStorage(compact_records=settings.TGBOT_JOURNAL_COMPACT_RECORDS)
+    else:
+        raise ValueError(f'Unknown storage backend: {name}')
+
+
+_backend = build_backend()
+_writer = ChatDataWriter(
+    backend=_backend,
+    interval=settings.TGBOT_STORAGE_FLUSH_INTERVAL,
+    manifest=build_manifest(backend=_backend),
+)
+
+
+def save_chat_data(chat_id: int or str, chat_data: dict) -> None:
+    """Write whole chat data immediately."""
+    _writer.mark_dirty(chat_id=chat_id, chat_data=chat_data, full=True)
+    _writer.flush(chat_id=chat_id)
+
+
+def schedule_save_chat_data(chat_id: int or str, chat_data: dict) -> None:
+    """Write chat data on next flush, or immediately if write-behind is not running."""
+    _writer.mark_dirty(chat_id=chat_id, chat_data=chat_data)
+    if not _writer.running:
+        _writer.flush(chat_id=chat_id)
+
+
+def note_member_change(chat_id: int or str, username: str) -> None:
+    """Tell storage that member was remembered or forgotten, so only this member is written on next save."""
+    _writer.note_member_change(chat_id=chat_id, username=username)
+
+
+def flush_chat_data(chat_id: int or str) -> None:
+    """Write pending chat data of the chat immediately."""
+    _writer.flush(chat_id=chat_id)
+
+
+def iter_chat_ids() -> Iterable[int]:
+    """Return IDs of all chats in storage."""
+    return _writer.backend.iter_chat_ids()
+
+
+def load_manifest() -> None:
+    """Read chats manifest, or rebuild it from storage if there is none yet."""
+    _writer.manifest.load(backend=_writer.backend)
+
+
+def iter_chat_manifest() -> List[Tuple[int, ChatManifestEntry]]:
+    """Return manifest entries of all stored chats by chat ID, without loading chat data."""
+    load_manifest()
+    return _writer.manifest.items()
+
+
+def get_chat_manifest(chat_id: int or str) -> Optional[ChatManifestEntry]:
+    """Return manifest entry of the chat, or None if chat is not stored."""
+    load_manifest()
+    return _writer.manifest.get(chat_id=chat_id)
+
+
+def restore_chat_data(chat_id: int or str) -> dict:
+    pending = _writer.pending(chat_id=chat_id)
+    if pending is not None:
+        return pending
+    started_at = time.perf_counter()
+    try:
+        return _writer.backend.load(chat_id=chat_id)
+    except Exception:
+        metrics.errors_total.inc(source='storage')
+        raise
+    finally:
+        metrics.storage_duration.observe(time.perf_counter() - started_at, operation='read')
+
+
+def set_backend(backend, shard: int = None) -> None:
+    """
+    Replace storage backend, must be called before any chat data is restored.
+    In supervisor mode, the manifest of worker's shard is used.
+    """
+    _writer.backend = backend
+    _writer.manifest = build_manifest(backend=backend, shard=shard)
+
+
+def start_write_behind() -> None:
+    """Start background writing of chat data, unless it is disabled with zero flush interval."""
+    if settings.TGBOT_STORAGE_FLUSH_INTERVAL > 0:
+        _writer.start()
+
+
+def stop_write_behind() -> None:
+    """Stop background writing, flush all pending chat data and close storage backend."""
+    _writer.stop()
+    _writer.backend.close()
@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from . import storage
+from .models import MEMBER_ID
+
+logger = logging.getLogger(__name__)
+
+
+class UserIndex:
+    """
+    Index of remembered members with known user IDs across all tracked chats:
+    user ID -> {chat ID: username in that chat}, and username -> user ID.
+
+    Kept up to date by handlers when members are remembered or forgotten. On start, only chats
+    with members are taken from storage manifest: a chat is indexed when a handler loads it,
+    and all chats that are left are loaded on the first lookup across chats.
+    """
+
+    def __init__(self):
+        self._memberships: Dict[int, Dict[int, str]] = {}
+        self._user_ids: Dict[str, int] = {}
+        # stored chats whose members are not indexed yet
+        self._pending_chats: Set[int] = set()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def add(self, chat_id: int, username: str, user_id: int) -> None:
+        with self._lock:
+            self._add(chat_id=chat_id, username=username, user_id=user_id)
+
+    def _add(self, chat_id: int, username: str, user_id: int) -> None:
+        self._memberships.setdefault(user_id, {})[chat_id] = username
+        self._user_ids[username.lower()] = user_id
+
+    def discard(self, chat_id: int, user_id: int) -> None:
+        with self._lock:
+            chats = self._memberships.get(user_id)
+            if chats is None:
+                return
+            chats.pop(chat_id, None)
+            if not chats:
+                del self._memberships[user_id]
+
+    def username_in_chat(self, user_id: int, chat_id: int) -> Optional[str]:
+        with self._lock:
+            return self._memberships.get(user_id, {}).get(chat_id)
+
+    def chats_of(self, user_id: int) -> Dict[int, str]:
+        """Return usernames of the user by IDs of chats where user is remembered."""
+        self._index_pending_chats()
+        with self._lock:
+            return dict(self._memberships.get(user_id, {}))
+
+    def user_id_of(self, username: str) -> Optional[int]:
+        """Return ID of the user who was remembered with this username last."""
+        self._index_pending_chats()
+        with self._lock:
+            return self._user_ids.get(username.lower())
+
+    def index_chat(self, chat_id: int, chat_data: dict) -> None:
+        """Add members of a chat loaded from storage, unless the chat is indexed already."""
+        with self._lock:
+            if chat_id not in self._pending_chats:
+                return
+            self._pending_chats.discard(chat_id)
+            for username, member_data in chat_data.get(storage.MEMBERS_BY_USERNAME, {}).items():
+                if username and member_data.get(MEMBER_ID) is not None:
+                    self._add(chat_id=chat_id, username=username, user_id=member_data[MEMBER_ID])
+
+    def build(self) -> None:
+        """Take chats with members from storage manifest, they are indexed when they are loaded."""
+        chat_ids = {chat_id for chat_id, entry in storage.iter_chat_manifest() if entry.members}
+        with self._lock:
+            self._pending_chats.update(chat_ids)
+        logger.info(f'{len(chat_ids)} chats with members will be indexed on first use')
+
+    def _index_pending_chats(self) -> None:
+        """Load and index all chats that were not loaded by handlers yet."""
+        if not self._pending_chats:
+            return
+        with self._build_lock:
+            started_at = time.monotonic()
+            with self._lock:
+                chat_ids = list(self._pending_chats)
+            for chat_id in chat_ids:
+                with self._lock:
+                    if chat_id not in self._pending_chats:
+                        continue
+                try:
+                    chat_data = storage.restore_chat_data(chat_id=chat_id)
+                    self.index_chat(chat_id=chat_id, chat_data=chat_data)
+                except Exception:
+                    logger.exception(f'Could not index members of chat {chat_id}.')
+                    with self._lock:
+                        self._pending_chats.discard(chat_id)
+            if chat_ids:
+                logger.info(f'Indexed members of {len(chat_ids)} chats in {time.monotonic() - started_at:.2f} seconds')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'users': len(self._memberships),
+                'usernames': len(self._user_ids),
+                'pending_chats': len(self._pending_chats),
+            }
+
+
+user_index = UserIndex()
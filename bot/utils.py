@@ -1,26 +1,70 @@
+import html
 import re
-from typing import List, Iterable, Iterator
+from typing import Callable, List, Iterable, Iterator, Optional
 
+from telegram import Message, MessageEntity
 
-def _find_all_usernames(string: str) -> List[str]:
+_HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+
+_USERNAME_PATTERN = re.compile(r'\B@(?=\w{5,64}\b)([a-zA-Z0-9]+(?:_[a-zA-Z0-9]+)*)')
+""" Username after "@" which is not a part of a word (e.g. email).
+Credit to https://stackoverflow.com/a/63308482/6233648
+"""
+
+
+def iter_unique(iterable: Iterable) -> Iterator:
+    """Yield elements of iterable in the same order, skipping the ones that were already yielded."""
+    seen = set()
+    for el in iterable:
+        if el not in seen:
+            seen.add(el)
+            yield el
+
+
+def iter_text_usernames(text: str) -> Iterator[str]:
+    """Yield usernames without "@" in order of appearance in text, in a single pass over it."""
+    for match in _USERNAME_PATTERN.finditer(text):
+        yield match.group(1)
+
+
+def iter_message_usernames(message: Message) -> Iterator[str]:
     """
-    Returns list of all usernames in format ["@username1", "@username2", ...]
-    Credit to https://stackoverflow.com/a/63308482/6233648
+    Yield usernames without "@" mentioned in message text or caption.
+    Mention entities parsed by Telegram are used if there are any, text is scanned otherwise.
     """
-    tg_nick_pattern = r'.*\B@(?=\w{5,64}\b)[a-zA-Z0-9]+(?:_[a-zA-Z0-9]+)*.*'
-    return re.findall(tg_nick_pattern, string)
+    text = message.text if message.text is not None else message.caption
+    if text is None:
+        return
+    entities = message.entities if message.text is not None else message.caption_entities
+    mentions = [entity for entity in entities if entity.type == MessageEntity.MENTION]
+    if not mentions:
+        yield from iter_text_usernames(text)
+    elif text.isascii():
+        for entity in mentions:
+            yield text[entity.offset + 1:entity.offset + entity.length]
+    else:
+        # entity offsets are in UTF-16 code units, unlike Message.parse_entity encode the text only once
+        encoded_text = text.encode('utf-16-le')
+        for entity in mentions:
+            yield encoded_text[(entity.offset + 1) * 2:(entity.offset + entity.length) * 2].decode('utf-16-le')
+
+
+def extract_usernames_from_messages(*messages: Optional[Message]) -> Iterator[str]:
+    """Yield every username mentioned in given messages once, skipping None messages."""
+    return iter_unique(
+        username
+        for message in messages
+        if message is not None
+        for username in iter_message_usernames(message)
+    )
 
 
 def extract_usernames_from_args(arguments: List[str], clean: bool = False) -> List[str]:
-    """Returns list of usernames extracted from command arguments."""
+    """Returns list of unique usernames extracted from command arguments."""
     return [
-        full_username_list[0][1:] if clean else full_username_list[0]
-        for full_username_list in (
-            # take first and only element of a list
-            _find_all_usernames(arg)
-            for arg in arguments
-        )
-        if full_username_list
+        username if clean else f'@{username}'
+        for username in iter_unique(iter_text_usernames(' '.join(arguments)))
     ]
 
 
@@ -31,5 +75,49 @@ def iter_pack(iterable: Iterable, size: int) -> Iterator:
         if (i + 1) % size == 0:
             yield iter(pack_buffer)
             pack_buffer = []
-    else:
+    if pack_buffer:
         yield iter(pack_buffer)
+
+
+def html_text_length(html_text: str) -> int:
+    """Return length of text after parsing HTML markup, in UTF-16 code units as Telegram counts it."""
+    text = html.unescape(_HTML_TAG_PATTERN.sub('', html_text))
+    return len(text.encode('utf-16-le')) // 2
+
+
+def iter_mention_messages(
+        usernames: Iterable[str],
+        build_header: Callable[[int, int], str],
+        footer: str,
+        max_mentions: int,
+        max_length: int,
+) -> Iterator[str]:
+    """
+    Yield HTML messages which mention all usernames, packing as many mentions into each message
+    as both mentions count and message length limits allow.
+
+    Each message is `build_header(mentions_count, message_number)`, mentions separated by spaces,
+    a new line and the footer. Usernames are consumed one by one, so they are never materialized at once.
+    """
+    footer_length = html_text_length(footer)
+    message_number = 1
+    # header of a message with maximal number of mentions is the longest possible one
+    header_length = html_text_length(build_header(max_mentions, message_number))
+    mentions = []
+    mentions_length = 0
+    for username in usernames:
+        mention = f'@{username}'
+        length = len(mention) + 1  # separating space or new line after the last mention
+        if mentions and (
+                len(mentions) >= max_mentions
+                or header_length + mentions_length + length + footer_length > max_length
+        ):
+            yield build_header(len(mentions), message_number) + ' '.join(mentions) + '\n' + footer
+            message_number += 1
+            header_length = html_text_length(build_header(max_mentions, message_number))
+            mentions = []
+            mentions_length = 0
+        mentions.append(mention)
+        mentions_length += length
+    if mentions:
+        yield build_header(len(mentions), message_number) + ' '.join(mentions) + '\n' + footer
@@ -0,0 +1,107 @@
+import hmac
+import json
+import logging
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+from telegram import Bot
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+QUEUE_TIMEOUT = 1.0
+""" Seconds to wait for a place in full update queue before responding with an error. """
+
+ALLOWED_UPDATES = ['message', 'edited_message', 'callback_query', 'chat_member']
+""" Update types requested from Telegram, chat_member updates are sent only if requested explicitly. """
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: '_WebhookHTTPServer'
+
+    def do_POST(self) -> None:
+        if self.path != self.server.path:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        secret_token = self.server.secret_token
+        if secret_token and not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), secret_token):
+            self.send_error(HTTPStatus.FORBIDDEN)
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST)
+            return
+
+        if self.server.handle_update(data):
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            # Telegram retries delivery of the update later
+            self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class _WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # default listen backlog of 5 drops connections under concurrent requests
+    request_queue_size = 128
+
+    def __init__(self, address: tuple, path: str, secret_token: Optional[str],
+                 handle_update: Callable[[dict], bool]):
+        super().__init__(address, _WebhookRequestHandler)
+        self.path = path
+        self.secret_token = secret_token
+        self.handle_update = handle_update
+
+
+class WebhookServer:
+    """
+    Embedded HTTP server which receives updates from Telegram.
+
+    Every update is passed as a decoded JSON dict to `handle_update`,
+    which returns False if update can not be accepted now (e.g. intake queue is full).
+    """
+
+    def __init__(self, listen: str, port: int, path: str, secret_token: Optional[str],
+                 handle_update: Callable[[dict], bool]):
+        self._httpd = _WebhookHTTPServer(
+            address=(listen, port),
+            path=path,
+            secret_token=secret_token,
+            handle_update=handle_update,
+        )
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info(f'Webhook is listening on {self._httpd.server_address}')
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def register_webhook(bot: Bot, url: str, secret_token: Optional[str], max_connections: int,
+                     allowed_updates: List[str] = None) -> None:
+    """Tell Telegram to deliver updates to the webhook."""
+    api_kwargs = {}
+    if secret_token:
+        # PTB 13 does not support this setWebhook parameter yet
+        api_kwargs['secret_token'] = secret_token
+    bot.set_webhook(url=url, max_connections=max_connections, allowed_updates=allowed_updates, api_kwargs=api_kwargs)
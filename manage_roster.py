@@ -0,0 +1,82 @@
+"""
+Import and export rosters of stored chats without the bot, directly in the configured storage.
+Stop the bot first, otherwise it overwrites imported members of chats it keeps in memory.
+
+Import takes the same CSV or text files as /import, export writes the same CSV file as /export.
+
+Usage:
+    python manage_roster.py import -1001234567890 roster.csv
+    python manage_roster.py export -1001234567890 --output members.csv
+"""
+import argparse
+import logging
+import sys
+
+from bot import settings, storage
+from bot.models import BEGAN_AT
+from bot.roster_io import imported_member_data, iter_roster_file, write_roster_csv
+
+
+def restore_stored_chat_data(chat_id: int) -> dict:
+    chat_data = storage.restore_chat_data(chat_id=chat_id)
+    if BEGAN_AT not in chat_data:
+        sys.exit(f'Chat {chat_id} is not stored, call /start in it first.')
+    return chat_data
+
+
+def import_roster(chat_id: int, filename: str) -> (int, int):
+    """Remember members listed in the file, return numbers of new or changed and of listed members."""
+    chat_data = restore_stored_chat_data(chat_id=chat_id)
+    members = chat_data[storage.MEMBERS_BY_USERNAME]
+    imported = listed = 0
+    with open(filename, 'rb') as fp:
+        for username, user_id in iter_roster_file(fp):
+            listed += 1
+            member_data = imported_member_data(stored=members.get(username), user_id=user_id)
+            if member_data is not None:
+                members[username] = member_data
+                imported += 1
+    if imported:
+        storage.save_chat_data(chat_id=chat_id, chat_data=chat_data)
+    return imported, listed
+
+
+def export_roster(chat_id: int, filename: str = None) -> int:
+    """Write remembered members into the file, or to standard output. Return their number."""
+    members = restore_stored_chat_data(chat_id=chat_id)[storage.MEMBERS_BY_USERNAME]
+    if filename is None:
+        exported = write_roster_csv(members=members, fp=sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        return exported
+    with open(filename, 'wb') as fp:
+        return write_roster_csv(members=members, fp=fp)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sharded', action='store_true',
+                        help=f'bot runs in supervisor mode, use storage of the chat\'s shard of {settings.TGBOT_SHARDS}')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    import_parser = subparsers.add_parser('import', help='remember members listed in a CSV or text file')
+    import_parser.add_argument('chat_id', type=int)
+    import_parser.add_argument('filename')
+    export_parser = subparsers.add_parser('export', help='write remembered members as CSV')
+    export_parser.add_argument('chat_id', type=int)
+    export_parser.add_argument('--output', help='file to write, standard output by default')
+    args = parser.parse_args()
+
+    if args.sharded:
+        shard = args.chat_id % settings.TGBOT_SHARDS
+        storage.set_backend(storage.build_backend(shard=shard), shard=shard)
+    try:
+        if args.action == 'import':
+            imported, listed = import_roster(chat_id=args.chat_id, filename=args.filename)
+            print(f'Remembered {imported} new or changed members of {listed} listed in {args.filename}',
+                  file=sys.stderr)
+        else:
+            exported = export_roster(chat_id=args.chat_id, filename=args.output)
+            print(f'Exported {exported} members', file=sys.stderr)
+    finally:
+        # write the manifest and close storage
+        storage.stop_write_behind()
@@ -0,0 +1,11 @@
+import logging
+
+from bot import settings
+from bot.sqlite_storage import SqliteStorage, import_json_chat_data
+
+if __name__ == '__main__':
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    backend = SqliteStorage(path=settings.TGBOT_SQLITE_PATH)
+    imported = import_json_chat_data(backend=backend)
+    backend.close()
+    print(f'Imported {imported} chats into {settings.TGBOT_SQLITE_PATH}')
@@ -0,0 +1,6 @@
+import sys
+
+from bot.sharding import main_sharded
+
+if __name__ == '__main__':
+    main_sharded(intake=sys.argv[1] if len(sys.argv) > 1 else 'polling')
@@ -0,0 +1,4 @@
+from bot.main import main_webhook
+
+if __name__ == '__main__':
+    main_webhook()
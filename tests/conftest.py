@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+import pytest
+
+# bot settings are read when bot modules are imported, so they are configured before any test module imports them
+os.environ.update({
+    'TGBOT_APIKEY': '123456:FAKE-TOKEN',
+    'TGBOT_ADMIN_USERNAMES': 'admin_user',
+    'TGBOT_DATA_DIR': tempfile.mkdtemp(prefix='tgbot-tests-'),
+    'TGBOT_STORAGE_FLUSH_INTERVAL': '0',
+    'TGBOT_MEMBERSHIP_BATCH_WINDOW': '0',
+    # messages to the fake Bot API are not rate limited by tests
+    'TGBOT_CHAT_SEND_RATE': '60000',
+})
+
+
+@pytest.fixture(autouse=True)
+def outbound_sender():
+    """Send replies queued by handlers, the queue is drained when the test is over."""
+    from bot import outbound
+    outbound.sender.start()
+    yield outbound.sender
+    outbound.sender.stop()
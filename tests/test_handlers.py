@@ -0,0 +1,49 @@
+from telegram import Bot, Update
+
+from benchmarks import updates
+from benchmarks.fake_telegram import RecordingRequest, TOKEN
+from bot import handlers, main, outbound
+from bot.handlers import CHAT_DATA
+
+ADMIN = updates.build_user(1, 'admin_user')
+
+
+def test_debug_reply_is_queued(monkeypatch):
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat = updates.build_chat(-1000000000081)
+    queued = []
+    enqueue = outbound.sender.enqueue
+    monkeypatch.setattr(outbound.sender, 'enqueue', lambda chat_id, send, kwargs: (
+        queued.append(kwargs.get('text')), enqueue(chat_id=chat_id, send=send, kwargs=kwargs)))
+
+    dispatcher.process_update(Update.de_json(updates.build_command_update(chat, ADMIN, 'debug'), bot))
+
+    assert request.api.wait_for(
+        lambda method, data: method == 'sendMessage' and data['text'].startswith('Chat ID')) is not None
+    assert any(text.startswith('Chat ID') for text in queued)
+
+
+def test_check_in_without_username_is_not_remembered(monkeypatch):
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat = updates.build_chat(-1000000000082)
+    anonymous = updates.build_user(2)
+    dispatcher.process_update(Update.de_json(updates.build_command_update(chat, ADMIN, 'start'), bot))
+    assert request.api.wait_for(lambda method, data: method == 'sendMessage') is not None
+    saved = []
+    monkeypatch.setattr(handlers, '_save_chat_data', lambda update, context: saved.append(update.effective_chat.id))
+
+    for _ in range(2):
+        dispatcher.process_update(Update.de_json(updates.build_command_update(chat, anonymous, 'check_in'), bot))
+
+    def replies():
+        return [data['text'] for _, method, data in request.api.calls
+                if method == 'sendMessage' and 'username' in data['text']]
+
+    assert request.api.wait_for(lambda method, data: len(replies()) == 2) is not None
+    assert all(text.startswith('Users without a username') for text in replies())
+    assert not saved
+    assert list(dispatcher.chat_data[chat['id']][CHAT_DATA.MEMBERS_BY_USERNAME]) == ['admin_user']
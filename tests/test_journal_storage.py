@@ -0,0 +1,29 @@
+import os
+
+from bot.journal_storage import JournalStorage, build_chat_journal_filename
+from bot.storage import MEMBERS_BY_USERNAME
+
+CHAT_ID = -1000000000083
+
+
+def test_incomplete_record_is_skipped_without_truncating_journal():
+    storage = JournalStorage(compact_records=1000)
+    chat_data = {'title': 'Chat', MEMBERS_BY_USERNAME: {}}
+    storage.write(chat_id=CHAT_ID, chat_data=chat_data, changed_usernames=None)
+    chat_data[MEMBERS_BY_USERNAME]['first'] = {'id': 1}
+    storage.write(chat_id=CHAT_ID, chat_data=chat_data, changed_usernames={'first'})
+    journal_filename = build_chat_journal_filename(chat_id=CHAT_ID, generation=1)
+    # a crash while appending leaves an incomplete record, or a load sees a record being appended
+    with open(journal_filename, 'ab') as fp:
+        fp.write(b'{"set": "torn", "da')
+    size = os.path.getsize(journal_filename)
+
+    assert JournalStorage(compact_records=1000).load(chat_id=CHAT_ID)[MEMBERS_BY_USERNAME] == {'first': {'id': 1}}
+    assert os.path.getsize(journal_filename) == size
+
+    chat_data[MEMBERS_BY_USERNAME]['second'] = {'id': 2}
+    storage.write(chat_id=CHAT_ID, chat_data=chat_data, changed_usernames={'second'})
+    assert JournalStorage(compact_records=1000).load(chat_id=CHAT_ID)[MEMBERS_BY_USERNAME] == {
+        'first': {'id': 1},
+        'second': {'id': 2},
+    }
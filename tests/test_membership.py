@@ -0,0 +1,46 @@
+import time
+
+from telegram import Bot, Update
+
+from benchmarks import updates
+from benchmarks.fake_telegram import RecordingRequest, TOKEN
+from bot import main
+
+ADMIN = updates.build_user(1, 'admin_user')
+
+
+def build_chat_member_update(chat: dict, user: dict, old_status: str, new_status: str) -> dict:
+    return {
+        'update_id': int(time.time() * 1000),
+        'chat_member': {
+            'chat': chat,
+            'from': ADMIN,
+            'date': int(time.time()),
+            'old_chat_member': {'user': user, 'status': old_status},
+            'new_chat_member': {'user': user, 'status': new_status},
+        },
+    }
+
+
+def test_chat_member_updates_are_applied():
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat = updates.build_chat(-1000000000080)
+    joined = updates.build_user(2, 'joined_user')
+    left = updates.build_user(3, 'left_user')
+
+    for update in (
+            updates.build_command_update(chat, ADMIN, 'start', '@left_user'),
+            updates.build_command_update(chat, ADMIN, 'enable'),
+            build_chat_member_update(chat, joined, old_status='left', new_status='member'),
+            build_chat_member_update(chat, left, old_status='member', new_status='kicked'),
+            updates.build_command_update(chat, ADMIN, 'list'),
+    ):
+        dispatcher.process_update(Update.de_json(update, bot))
+
+    assert request.api.wait_for(
+        lambda method, data: method == 'sendMessage' and data['text'].startswith('Listing')) is not None
+    listed = next(data['text'] for _, method, data in request.api.calls
+                  if method == 'sendMessage' and data['text'].startswith('Listing'))
+    assert listed.endswith('* admin_user\n* joined_user')
@@ -0,0 +1,14 @@
+from bot.outbound import OutboundQueue
+
+
+def test_second_start_does_not_add_threads():
+    queue = OutboundQueue(rate=30, chat_rate=1, chat_burst=1, threads=2)
+    queue.start()
+    threads = list(queue._threads)
+    queue.start()
+    try:
+        assert queue._threads == threads
+        assert all(thread.is_alive() for thread in threads)
+    finally:
+        queue.stop()
+    assert not any(thread.is_alive() for thread in threads)
@@ -0,0 +1,64 @@
+import json
+
+from telegram import Bot, Update
+
+from benchmarks import updates
+from benchmarks.fake_telegram import RecordingRequest, TOKEN
+from bot import main, pagination
+from bot.utils import html_text_length
+
+ADMIN = updates.build_user(1, 'admin_user')
+
+
+def test_pages_are_split_by_count_and_length():
+    usernames = ('a' * 10, 'b' * 10, 'c' * 10, 'd', 'e', 'f', 'g' * 40)
+    assert pagination.split_pages(usernames, page_size=3, max_length=25) == (0, 2, 5, 6)
+    assert pagination.split_pages((), page_size=3, max_length=25) == ()
+
+
+def _mention_messages(request: RecordingRequest) -> list:
+    return [data for _, method, data in request.api.calls
+            if method == 'sendMessage' and data['text'].startswith('Mentioning')]
+
+
+def test_mention_all_pages_fit_into_message_length_limit():
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat = updates.build_chat(-1000000000078)
+    # 200 mentions of the longest usernames do not fit into 4096 characters by mentions count alone
+    usernames = [f'member_{i:03}_'.ljust(32, 'x') for i in range(200)]
+
+    for command, args in (('start', [f'@{username}' for username in usernames]), ('mention_all', ())):
+        dispatcher.process_update(Update.de_json(updates.build_command_update(chat, ADMIN, command, *args), bot))
+    assert request.api.wait_for(lambda method, data: _mention_messages(request)) is not None
+    # every next page is sent when the button under the previous one is pressed
+    while 'reply_markup' in _mention_messages(request)[-1]:
+        sent = _mention_messages(request)
+        button = json.loads(sent[-1]['reply_markup'])['inline_keyboard'][0][0]
+        message = updates.build_message_update(chat=chat, user=ADMIN, text=sent[-1]['text'])['message']
+        dispatcher.process_update(Update.de_json(
+            updates.build_callback_query_update(ADMIN, message, button['callback_data']), bot))
+        assert request.api.wait_for(lambda method, data: len(_mention_messages(request)) > len(sent)) is not None
+
+    messages = _mention_messages(request)
+    assert len(messages) > 1
+    assert all(html_text_length(message['text']) <= 4096 for message in messages)
+    mentioned = [word[1:] for message in messages for word in message['text'].split() if word.startswith('@')]
+    assert mentioned == sorted(usernames + ['admin_user'], key=str.lower)
+
+
+def test_expired_page_button_is_answered():
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat = updates.build_chat(-1000000000079)
+    message = updates.build_message_update(chat=chat, user=ADMIN, text='Mentioning')['message']
+
+    dispatcher.process_update(Update.de_json(updates.build_command_update(chat, ADMIN, 'start'), bot))
+    dispatcher.process_update(Update.de_json(updates.build_callback_query_update(
+        ADMIN, message, pagination.build_callback_data(pagination.MENTION, 'deadbeef', 1)), bot))
+
+    assert request.api.wait_for(
+        lambda method, data: method == 'answerCallbackQuery' and 'expired' in data.get('text', '')) is not None
+    assert not _mention_messages(request)
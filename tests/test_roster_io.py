@@ -0,0 +1,43 @@
+import csv
+import io
+import tempfile
+
+import pytest
+from telegram import Bot, Update
+
+from benchmarks import updates
+from benchmarks.fake_telegram import RecordingRequest, TOKEN
+from bot import main, roster_io
+from bot.models import MEMBER_ID
+
+MEMBERS = {f'member_{i}': ({MEMBER_ID: 1000 + i} if i % 3 else {}) for i in range(5000)}
+
+
+@pytest.mark.parametrize('open_file', [
+    tempfile.TemporaryFile,
+    lambda: tempfile.SpooledTemporaryFile(max_size=1024),
+    io.BytesIO,
+], ids=['temporary', 'spooled', 'bytes'])
+def test_exported_roster_is_imported_back(open_file):
+    with open_file() as fp:
+        assert roster_io.write_roster_csv(members=MEMBERS, fp=fp) == len(MEMBERS)
+        fp.seek(0)
+        imported = dict(roster_io.iter_roster_file(fp))
+    assert imported == {username: member_data.get(MEMBER_ID) for username, member_data in MEMBERS.items()}
+
+
+def test_export_command_sends_csv_document():
+    request = RecordingRequest()
+    bot = Bot(TOKEN, request=request)
+    dispatcher = main.build_updater(bot=bot).dispatcher
+    chat = updates.build_chat(-1000000000077)
+    admin = updates.build_user(1, 'admin_user')
+
+    for command, args in (('start', ('@member_one', '@member_two')), ('export', ())):
+        dispatcher.process_update(Update.de_json(updates.build_command_update(chat, admin, command, *args), bot))
+    assert request.api.wait_for(lambda method, data: method == 'sendDocument') is not None
+
+    document = next(data for _, method, data in request.api.calls if method == 'sendDocument')['document']
+    rows = list(csv.reader(io.StringIO(document.input_file_content.decode())))
+    assert rows[0] == roster_io.EXPORT_HEADER
+    assert [row[0] for row in rows[1:]] == ['admin_user', 'member_one', 'member_two']
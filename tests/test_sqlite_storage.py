@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from bot.sqlite_storage import SqliteStorage
+from bot.storage import MEMBERS_BY_USERNAME
+
+
+def build_chat_data(title: str) -> dict:
+    return {'title': title, MEMBERS_BY_USERNAME: {'member': {'id': 1}}}
+
+
+def test_chats_written_in_batch_are_committed_together(tmp_path):
+    storage = SqliteStorage(path=os.path.join(tmp_path, 'bot-data.sqlite3'))
+    with pytest.raises(ValueError):
+        with storage.write_batch():
+            assert storage.write(chat_id=1, chat_data=build_chat_data('first'), changed_usernames=None)
+            raise ValueError('batch failed')
+    assert SqliteStorage(path=storage.path).load(chat_id=1) == {}
+
+    # chat which was rolled back with its batch is not considered written
+    with storage.write_batch():
+        assert storage.write(chat_id=1, chat_data=build_chat_data('first'), changed_usernames=None)
+        assert storage.write(chat_id=2, chat_data=build_chat_data('second'), changed_usernames=None)
+    reader = SqliteStorage(path=storage.path)
+    assert reader.load(chat_id=1) == build_chat_data('first')
+    assert reader.load(chat_id=2) == build_chat_data('second')
+    assert not storage.write(chat_id=2, chat_data=build_chat_data('second'), changed_usernames=set())
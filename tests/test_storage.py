@@ -0,0 +1,55 @@
+import os
+
+from bot import metrics
+from bot.storage import MEMBERS_BY_USERNAME, ChatDataWriter, ChatManifest
+
+
+class FailingBackend:
+    """Backend which raises given errors on first writes of a chat, then writes."""
+
+    def __init__(self, errors: list):
+        self.errors = errors
+        self.written = []
+
+    def write(self, chat_id: int, chat_data: dict, changed_usernames) -> bool:
+        if self.errors:
+            raise self.errors.pop(0)
+        self.written.append(chat_id)
+        return True
+
+    def iter_chat_ids(self) -> list:
+        return []
+
+
+def build_writer(backend: FailingBackend, tmp_path) -> ChatDataWriter:
+    manifest = ChatManifest(filename=os.path.join(tmp_path, 'chats-manifest.json'), save_interval=0)
+    return ChatDataWriter(backend=backend, interval=0, manifest=manifest)
+
+
+def test_chat_changed_while_written_is_retried_and_counted(tmp_path):
+    backend = FailingBackend([RuntimeError('dictionary changed size during iteration')])
+    writer = build_writer(backend, tmp_path)
+    retries_before = metrics.storage_write_retries_total.value()
+    errors_before = metrics.errors_total.value(source='storage')
+
+    writer.mark_dirty(chat_id=1, chat_data={'title': 'Chat', MEMBERS_BY_USERNAME: {}})
+    assert writer.flush() == 0
+    assert writer.flush() == 1
+    assert backend.written == [1]
+    assert metrics.storage_write_retries_total.value() == retries_before + 1
+    assert metrics.errors_total.value(source='storage') == errors_before
+
+
+def test_other_runtime_errors_of_backend_are_reported(tmp_path, caplog):
+    backend = FailingBackend([RuntimeError('backend is broken')])
+    writer = build_writer(backend, tmp_path)
+    retries_before = metrics.storage_write_retries_total.value()
+    errors_before = metrics.errors_total.value(source='storage')
+
+    writer.mark_dirty(chat_id=1, chat_data={'title': 'Chat', MEMBERS_BY_USERNAME: {}})
+    assert writer.flush() == 0
+    assert metrics.errors_total.value(source='storage') == errors_before + 1
+    assert metrics.storage_write_retries_total.value() == retries_before
+    assert 'Could not write data of chat 1' in caplog.text
+    # the chat stays dirty and is written by the next flush
+    assert writer.flush() == 1
@@ -0,0 +1,94 @@
+import random
+import re
+import string
+
+import pytest
+
+from bot.utils import html_text_length, iter_mention_messages
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+FOOTER = 'If <b>You</b> got mentioned by this message, please, click on /check_in command.'
+
+
+def build_header(mentions_count: int, message_number: int) -> str:
+    return (
+        f'Following <code>{mentions_count}</code> chat members are missing: '
+        f'(message <code>{message_number}</code>)\n'
+    )
+
+
+def random_usernames(rng: random.Random, count: int) -> list:
+    """Return unique valid usernames of 5 to 32 characters: letters, digits and single underscores."""
+    usernames = set()
+    while len(usernames) < count:
+        parts = [''.join(rng.choices(string.ascii_letters + string.digits, k=rng.randint(1, 12)))
+                 for _ in range(rng.randint(1, 3))]
+        username = '_'.join(parts)[:32].strip('_')
+        if len(username) >= 5:
+            usernames.add(username)
+    usernames = sorted(usernames)
+    rng.shuffle(usernames)
+    return usernames
+
+
+def parse_message(message: str) -> (int, int, list):
+    """Return mentions count and number from the header, and mentioned usernames of a message."""
+    header_match = re.match(r'Following <code>(\d+)</code> .*?\(message <code>(\d+)</code>\)\n', message)
+    assert header_match is not None
+    assert message.endswith('\n' + FOOTER)
+    body = message[header_match.end():-len(FOOTER) - 1]
+    return int(header_match.group(1)), int(header_match.group(2)), [mention[1:] for mention in body.split(' ')]
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('max_mentions, max_length', [
+    (1, TELEGRAM_MAX_MESSAGE_LENGTH),
+    (5, 300),
+    (20, TELEGRAM_MAX_MESSAGE_LENGTH),
+    (50, 1000),
+    (200, TELEGRAM_MAX_MESSAGE_LENGTH),
+])
+def test_mention_messages(seed, max_mentions, max_length):
+    rng = random.Random(seed)
+    usernames = random_usernames(rng, count=rng.randint(0, 600))
+
+    messages = list(iter_mention_messages(
+        usernames=iter(usernames),
+        build_header=build_header,
+        footer=FOOTER,
+        max_mentions=max_mentions,
+        max_length=max_length,
+    ))
+
+    mentioned = []
+    for message_number, message in enumerate(messages, start=1):
+        mentions_count, header_number, message_usernames = parse_message(message)
+        # no empty messages, trailing or otherwise, and headers tell the truth
+        assert message_usernames and mentions_count == len(message_usernames)
+        assert header_number == message_number
+        assert len(message_usernames) <= max_mentions
+        assert html_text_length(message) <= min(max_length, TELEGRAM_MAX_MESSAGE_LENGTH)
+        mentioned.extend(message_usernames)
+    # every username is mentioned once, in the given order
+    assert mentioned == usernames
+
+
+def test_no_messages_without_usernames():
+    assert list(iter_mention_messages(
+        usernames=[], build_header=build_header, footer=FOOTER, max_mentions=20, max_length=4096)) == []
+
+
+def test_length_is_counted_in_utf16_code_units():
+    # astral plane characters take two UTF-16 code units, as Telegram counts message length
+    footer = '\U0001F44B' * 100
+    messages = list(iter_mention_messages(
+        usernames=[f'user_{i:05}' for i in range(100)],
+        build_header=lambda mentions_count, message_number: '',
+        footer=footer,
+        max_mentions=100,
+        max_length=500,
+    ))
+    assert len(messages) > 1
+    assert all(html_text_length(message) <= 500 for message in messages)
+    assert html_text_length(footer) == 200